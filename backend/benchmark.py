@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import shapely
+import djikstra
+import metrics
+from djikstra import load_graph, snap_point, build_snap_overlay, combine_polylines, encode_coordinates, ENGINES
+from topK_dijkstra import k_shortest_paths
+from graph_utils import CAMPUS_POLYGON
+
+# Offline routing benchmark: times each stage of a route request separately on a seeded set of
+# origin-destination pairs inside the campus, so a change to an engine, the graph or a cache
+# can be judged against the numbers of a stored baseline.
+#
+#   python benchmark.py [engine] [pairs] [seed] [--save-baseline]
+#
+# writes benchmark_results.json and compares it with benchmark_baseline.json (or, with
+# --save-baseline, makes the results the new baseline). Exits with status 1 on a regression.
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+
+BENCHMARK_PAIRS = 200
+BENCHMARK_SEED = 0
+
+# Routes asked of k_shortest_paths per pair, like /api/directions?alternatives=3.
+BENCHMARK_ALTERNATIVES = 3
+
+# Cold load_graph calls timed (the graph cache is dropped before each).
+LOAD_REPEATS = 20
+
+# A stage regressed if its p50 or p95 is this fraction slower than the baseline's, and by more
+# than REGRESSION_FLOOR_MS (so sub-millisecond stages do not trip on timer noise).
+REGRESSION_TOLERANCE = 0.25
+REGRESSION_FLOOR_MS = 0.05
+
+STAGES = ("load_graph", "snap_point", "build_snap_overlay", "search", "k_shortest_paths",
+          "combine_polylines", "encode_coordinates")
+
+def random_pairs(count, seed=BENCHMARK_SEED):
+    """
+    Returns count origin-destination pairs of (lat, lon) points drawn uniformly from inside
+    graph_utils.CAMPUS_POLYGON, the same for the same seed.
+    """
+    rng = np.random.default_rng(seed)
+    min_lat, min_lon, max_lat, max_lon = CAMPUS_POLYGON.bounds
+    points = np.empty((0, 2))
+    while len(points) < 2 * count:
+        batch = rng.uniform((min_lat, min_lon), (max_lat, max_lon), size=(2 * count, 2))
+        # The polygon is stored as (lat, lon) vertices.
+        points = np.concatenate([points, batch[shapely.contains_xy(CAMPUS_POLYGON, batch[:, 0], batch[:, 1])]])
+    points = points[:2 * count].tolist()
+    return [(tuple(points[2 * k]), tuple(points[2 * k + 1])) for k in range(count)]
+
+def timed(samples, function, *args):
+    """
+    Calls function(*args), appends its run time in milliseconds to samples and returns its result.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    samples.append((time.perf_counter() - start) * 1000.0)
+    return result
+
+def summarize(samples):
+    """
+    Count, mean and p50/p95/p99 of a list of samples.
+    """
+    if not samples:
+        return {"count": 0}
+    samples = np.asarray(samples, dtype=np.float64)
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"count": len(samples), "mean": float(samples.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+def run_benchmark(engine="dijkstra", pairs=BENCHMARK_PAIRS, seed=BENCHMARK_SEED,
+                  alternatives=BENCHMARK_ALTERNATIVES, load_repeats=LOAD_REPEATS):
+    """
+    Times every stage of routing the seeded pairs with the named search engine (see
+    djikstra.ENGINES): load_graph (cold, from the snapshot), snap_point (twice per pair),
+    build_snap_overlay, the search itself, k_shortest_paths, combine_polylines and
+    encode_coordinates. Also records the nodes the engine's search settles for each route
+    (its metrics counters).
+    Returns the results as a JSON-ready dict: per-stage summaries in milliseconds, the nodes
+    settled, and what was run on.
+    """
+    # The first load may have to rebuild a stale snapshot; only loads from a current one are timed.
+    load_graph()
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(load_repeats):
+        djikstra.GRAPH_CACHE = None
+        graph = timed(samples["load_graph"], load_graph)
+    search = ENGINES[engine]
+    od_pairs = random_pairs(pairs, seed)
+
+    # One untimed query builds what the graph prepares on first use (search lists, segment
+    # index, contraction hierarchy, landmarks).
+    origin, destination = od_pairs[0]
+    overlay, (origin_node, destination_node) = build_snap_overlay(graph, [snap_point(origin, graph), snap_point(destination, graph)])
+    search(graph, origin_node, destination_node, overlay)
+    k_shortest_paths(graph, origin_node, destination_node, alternatives, overlay)
+
+    settled = []
+    unreachable = 0
+    for origin, destination in od_pairs:
+        origin_snap = timed(samples["snap_point"], snap_point, origin, graph)
+        destination_snap = timed(samples["snap_point"], snap_point, destination, graph)
+        overlay, (origin_node, destination_node) = timed(samples["build_snap_overlay"], build_snap_overlay,
+                                                         graph, [origin_snap, destination_snap])
+        with metrics.query("benchmark") as record:
+            cost, path, arcs = timed(samples["search"], search, graph, origin_node, destination_node, overlay)
+        if path is None:
+            unreachable += 1
+            continue
+        settled.append(record["counts"]["nodes_settled"])
+        timed(samples["k_shortest_paths"], k_shortest_paths, graph, origin_node, destination_node, alternatives, overlay)
+        polyline = timed(samples["combine_polylines"], combine_polylines, graph, arcs, overlay)
+        timed(samples["encode_coordinates"], encode_coordinates, polyline)
+
+    return {
+        "meta": {"engine": engine, "pairs": pairs, "seed": seed, "alternatives": alternatives,
+                 "unreachable": unreachable, "graph_version": graph.version,
+                 "nodes": graph.node_count, "edges": graph.edge_count,
+                 "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "timestamp": datetime.now().isoformat(timespec="seconds")},
+        "stages_ms": {stage: summarize(samples[stage]) for stage in STAGES},
+        "nodes_settled": summarize(settled),
+    }
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compares benchmark results with a baseline run, stage by stage.
+    Returns (report lines, names of the stages that regressed).
+    """
+    lines = []
+    regressed = []
+    for key in ("engine", "pairs", "seed", "alternatives", "graph_version"):
+        if results["meta"].get(key) != baseline["meta"].get(key):
+            lines.append(f"note: {key} differs from the baseline ({baseline['meta'].get(key)} -> {results['meta'].get(key)})")
+    for stage, now in results["stages_ms"].items():
+        before = baseline["stages_ms"].get(stage, {})
+        if not now.get("count") or not before.get("count"):
+            continue
+        slower = [f"{q} {before[q]:.3f} -> {now[q]:.3f} ms" for q in ("p50", "p95")
+                  if now[q] > before[q] * (1 + tolerance) and now[q] - before[q] > REGRESSION_FLOOR_MS]
+        change = now["p50"] / before["p50"] - 1 if before["p50"] > 0 else 0.0
+        lines.append(f"{stage:20s} p50 {before['p50']:9.3f} -> {now['p50']:9.3f} ms ({change:+.0%})"
+                     + ("  REGRESSION: " + ", ".join(slower) if slower else ""))
+        if slower:
+            regressed.append(stage)
+    now, before = results["nodes_settled"], baseline.get("nodes_settled", {})
+    if now.get("count") and before.get("count"):
+        lines.append(f"{'nodes_settled':20s} p50 {before['p50']:9.0f} -> {now['p50']:9.0f}")
+    return lines, regressed
+
+def print_results(results):
+    print(f"{'stage':20s} {'count':>6s} {'p50 ms':>10s} {'p95 ms':>10s} {'p99 ms':>10s}")
+    for stage, summary in list(results["stages_ms"].items()) + [("nodes_settled", results["nodes_settled"])]:
+        if summary["count"]:
+            print(f"{stage:20s} {summary['count']:6d} {summary['p50']:10.3f} {summary['p95']:10.3f} {summary['p99']:10.3f}")
+
+def main():
+    save_baseline = "--save-baseline" in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != "--save-baseline"]
+    if len(args) > 3 or (args and args[0] not in ENGINES):
+        print("Usage: python benchmark.py [engine] [pairs] [seed] [--save-baseline]")
+        print("Engines:", ", ".join(ENGINES))
+        sys.exit(1)
+    engine = args[0] if args else "dijkstra"
+    pairs = int(args[1]) if len(args) > 1 else BENCHMARK_PAIRS
+    seed = int(args[2]) if len(args) > 2 else BENCHMARK_SEED
+
+    results = run_benchmark(engine, pairs, seed)
+    print_results(results)
+    path = BASELINE_PATH if save_baseline else RESULTS_PATH
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {path}")
+    if save_baseline or not os.path.exists(BASELINE_PATH):
+        return
+    with open(BASELINE_PATH, "r") as f:
+        baseline = json.load(f)
+    lines, regressed = compare(results, baseline)
+    print(f"Compared with {BASELINE_PATH}:")
+    for line in lines:
+        print(line)
+    if regressed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import threading
+import weakref
+import numpy as np
+import graph_snapshot
+import route_cost
+import spatial_index
+
+# Temporary closures (construction fences, broken elevators, snow-blocked ramps) applied to the
+# routing graph at query time, without rebuilding it.
+#
+# A closure names OSM ways, OSM nodes (every edge through the node is affected) and/or a small
+# polygon (every edge crossing it is affected). It either closes those edges or, with a
+# penalty, only makes them that many meters more expensive. The closures in force are turned
+# into one extra cost per edge and an arc cost list with it added, which the search loops read
+# instead of the graph's own (see djikstra.search_lists), so a relaxation costs the same with
+# or without closures.
+CLOSURES_PATH = "closures.json"
+
+# Most vertices accepted for one closure polygon.
+MAX_POLYGON_POINTS = 64
+
+class ClosureError(ValueError):
+    """
+    Raised for a closure that cannot be applied (nothing to close, or a malformed polygon).
+    """
+
+def normalize_closure(closure):
+    """
+    Validates a closure given as a dict with "id" and any of "ways" (OSM way ids), "nodes"
+    (OSM node ids), "polygon" (list of [lat, lon] in degrees), plus optional "penalty" (meters;
+    None closes the edges) and "reason". Returns it in canonical form.
+    Raises ClosureError if it is malformed.
+    """
+    closure_id = str(closure.get("id") or "").strip()
+    if not closure_id:
+        raise ClosureError("A closure needs an id.")
+    try:
+        ways = sorted({int(way) for way in closure.get("ways") or ()})
+        nodes = sorted({int(node) for node in closure.get("nodes") or ()})
+        polygon = [[float(lat), float(lon)] for lat, lon in closure.get("polygon") or ()]
+        penalty = closure.get("penalty")
+        penalty = None if penalty is None else float(penalty)
+    except (TypeError, ValueError) as e:
+        raise ClosureError("ways and nodes must be ids, polygon a list of [lat, lon] pairs, penalty a number.") from e
+    if polygon and not 3 <= len(polygon) <= MAX_POLYGON_POINTS:
+        raise ClosureError(f"A closure polygon needs between 3 and {MAX_POLYGON_POINTS} points.")
+    if not np.isfinite(np.array(polygon, dtype=np.float64)).all():
+        raise ClosureError("Polygon coordinates must be finite.")
+    if penalty is not None and not 0 <= penalty < float('inf'):
+        raise ClosureError("penalty must be zero or more meters.")
+    if not (ways or nodes or polygon):
+        raise ClosureError("A closure needs ways, nodes or a polygon.")
+    return {"id": closure_id, "ways": ways, "nodes": nodes, "polygon": polygon,
+            "penalty": penalty, "reason": str(closure.get("reason") or "")}
+
+def closed_edges(graph, closure):
+    """
+    Returns the ids (ascending) of the graph edges a normalized closure applies to.
+    """
+    found = [np.zeros(0, dtype=np.int64)]
+    if closure["ways"]:
+        found.append(np.flatnonzero(np.isin(graph.edge_way, closure["ways"])))
+    if closure["nodes"]:
+        coord_edge = np.repeat(np.arange(graph.edge_count), graph.edge_geom_count)
+        found.append(coord_edge[np.isin(graph.coord_ids, closure["nodes"])])
+    if closure["polygon"]:
+        found.append(_edges_in_polygon(graph, np.array(closure["polygon"], dtype=np.float64)))
+    return np.unique(np.concatenate(found))
+
+def _edges_in_polygon(graph, polygon):
+    """
+    Edges with a segment inside or crossing polygon (an array of (lat, lon) rows).
+    Candidate segments come from the graph's segment index.
+    """
+    index = graph.segment_index
+    (min_lat, min_lon), (max_lat, max_lon) = polygon.min(axis=0), polygon.max(axis=0)
+    ids = spatial_index.segments_in_box(index, min_lat, min_lon, max_lat, max_lon)
+    if not len(ids):
+        return np.zeros(0, dtype=np.int64)
+    a_lat, a_lon = index["a_lat"][ids], index["a_lon"][ids]
+    b_lat, b_lon = index["b_lat"][ids], index["b_lon"][ids]
+    # Crossing tests are unaffected by scaling longitudes, so they run on degrees directly.
+    touches = _inside(a_lat, a_lon, polygon) | _inside(b_lat, b_lon, polygon)
+    for (p_lat, p_lon), (q_lat, q_lon) in zip(polygon, np.roll(polygon, 1, axis=0)):
+        touches |= _crosses(a_lat, a_lon, b_lat, b_lon, p_lat, p_lon, q_lat, q_lon)
+    return graph.arc_edge[graph.seg_arc[ids[touches]]].astype(np.int64)
+
+def _inside(lat, lon, polygon):
+    """
+    Even-odd test of which points lie inside polygon.
+    """
+    inside = np.zeros(len(lat), dtype=bool)
+    for (y1, x1), (y2, x2) in zip(polygon, np.roll(polygon, 1, axis=0)):
+        if y1 == y2:
+            continue
+        straddles = (y1 > lat) != (y2 > lat)
+        inside ^= straddles & (lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+def _crosses(a_lat, a_lon, b_lat, b_lon, p_lat, p_lon, q_lat, q_lon):
+    """
+    Which segments A -> B touch the segment P -> Q.
+    """
+    def orientation(o_lat, o_lon, s_lat, s_lon, t_lat, t_lon):
+        return (s_lon - o_lon) * (t_lat - o_lat) - (s_lat - o_lat) * (t_lon - o_lon)
+    d1 = orientation(p_lat, p_lon, q_lat, q_lon, a_lat, a_lon)
+    d2 = orientation(p_lat, p_lon, q_lat, q_lon, b_lat, b_lon)
+    d3 = orientation(a_lat, a_lon, b_lat, b_lon, p_lat, p_lon)
+    d4 = orientation(a_lat, a_lon, b_lat, b_lon, q_lat, q_lon)
+    # The bounding boxes must overlap too, or collinear segments far apart would count.
+    boxes_overlap = ((np.minimum(a_lat, b_lat) <= max(p_lat, q_lat)) & (np.maximum(a_lat, b_lat) >= min(p_lat, q_lat)) &
+                     (np.minimum(a_lon, b_lon) <= max(p_lon, q_lon)) & (np.maximum(a_lon, b_lon) >= min(p_lon, q_lon)))
+    return (d1 * d2 <= 0) & (d3 * d4 <= 0) & boxes_overlap
+
+def closures_key(closures):
+    """
+    Identifies a set of closures (the same in every process), or "" for none.
+    """
+    if not closures:
+        return ""
+    canonical = json.dumps([closures[closure_id] for closure_id in sorted(closures)], sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class ClosureSet:
+    """
+    The closures in force, by id, and what they do to each graph: an extra cost per edge (inf
+    for a closed edge) and, per cost profile, the arc cost list with it added, computed once per
+    graph and set of closures. With a path, the closures are kept in that JSON file, and every
+    snapshot() picks up changes written by other server processes (see refresh). Safe to use
+    from the server's worker threads. key identifies the current closures and goes into route cache keys; a request reads both at
+    once with snapshot().
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._current = ("", {})  # (key, closures by id), replaced as a whole
+        self._stamp = None
+        self._lock = threading.Lock()
+        self._applied = weakref.WeakKeyDictionary()  # graph -> (key, edge extra, {profile: arc cost list})
+        if path is not None:
+            self.refresh()
+
+    @property
+    def key(self):
+        return self._current[0]
+
+    def _install(self, closures):
+        self._current = (closures_key(closures), closures)
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            closures = self._current[1]
+            json.dump([closures[closure_id] for closure_id in sorted(closures)], f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._stamp = graph_snapshot.source_stamp((self.path,))
+
+    def refresh(self):
+        """
+        Rereads the closures file if it changed since it was last read or written.
+        Returns True if the closures changed.
+        """
+        if self.path is None:
+            return False
+        # One stat call when nothing changed, so this can run for every request.
+        if graph_snapshot.source_stamp((self.path,)) == self._stamp:
+            return False
+        with self._lock:
+            stamp = graph_snapshot.source_stamp((self.path,))
+            if stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            closures = {}
+            if stamp[0] is not None:
+                with open(self.path, "r") as f:
+                    for closure in json.load(f):
+                        closure = normalize_closure(closure)
+                        closures[closure["id"]] = closure
+            key = self.key
+            self._install(closures)
+            return self.key != key
+
+    def put(self, closure):
+        """
+        Adds a closure, replacing any with the same id, and returns it normalized.
+        Raises ClosureError if it is malformed.
+        """
+        closure = normalize_closure(closure)
+        # Start from the closures other processes wrote, not over them.
+        self.snapshot()
+        with self._lock:
+            self._install({**self._current[1], closure["id"]: closure})
+            self._save()
+        return closure
+
+    def remove(self, closure_id):
+        """
+        Lifts a closure. Returns False if there was none with that id.
+        """
+        self.snapshot()
+        with self._lock:
+            closures = self._current[1]
+            if closure_id not in closures:
+                return False
+            self._install({k: v for k, v in closures.items() if k != closure_id})
+            self._save()
+            return True
+
+    def closures(self):
+        """
+        Returns the closures in force, ordered by id.
+        """
+        return self.snapshot().closures()
+
+    def snapshot(self):
+        """
+        Returns the closures in force as a ClosureSnapshot, whose key and costs stay those of
+        the same closures however the set changes meanwhile. Rereads the closures file first if
+        another server process changed it.
+        """
+        try:
+            self.refresh()
+        except Exception as e:
+            # refresh keeps the stamp of a file it cannot read, so it is only tried once.
+            print("Could not read the closures:", e)
+        return ClosureSnapshot(self, *self._current)
+
+    def state(self):
+        """
+        Returns (key, closures), to hand the closures to another process (see replace).
+        """
+        snapshot = self.snapshot()
+        return snapshot.key, snapshot.closures()
+
+    def replace(self, key, closures):
+        """
+        Takes over the closures of another ClosureSet's state(), unless they are already in force.
+        """
+        if key == self.key:
+            return
+        with self._lock:
+            self._install({closure["id"]: closure for closure in closures})
+
+    def costs(self, graph, profile=route_cost.DEFAULT_PROFILE):
+        """
+        Returns (extra cost per edge as an array, arc cost list) for graph under a cost profile
+        with the closures in force, or None if there are none.
+        """
+        return self.snapshot().costs(graph, profile)
+
+    def _costs(self, graph, profile, key, closures):
+        if not closures:
+            return None
+        applied = self._applied.get(graph)
+        if applied is None or applied[0] != key:
+            extra = np.zeros(graph.edge_count)
+            for closure in closures.values():
+                penalty = float('inf') if closure["penalty"] is None else closure["penalty"]
+                extra[closed_edges(graph, closure)] += penalty
+            applied = (key, extra, {})
+            self._applied[graph] = applied
+        key, extra, arc_costs = applied
+        arc_cost = arc_costs.get(profile)
+        if arc_cost is None:
+            arc_cost = (graph.profile_costs(profile)["arc_cost"] + extra[graph.arc_edge]).tolist()
+            arc_costs[profile] = arc_cost
+        return extra, arc_cost
+
+class ClosureSnapshot:
+    """
+    The closures of a ClosureSet at one moment (see ClosureSet.snapshot), with the same
+    key and costs interface. Routes priced with its costs are cached under its key.
+    """
+
+    def __init__(self, closure_set, key, closures):
+        self.key = key
+        self._closure_set = closure_set
+        self._closures = closures
+
+    def closures(self):
+        """
+        Returns the closures, ordered by id.
+        """
+        closures = self._closures
+        return [closures[closure_id] for closure_id in sorted(closures)]
+
+    def costs(self, graph, profile=route_cost.DEFAULT_PROFILE):
+        """
+        Same as ClosureSet.costs, for these closures.
+        """
+        return self._closure_set._costs(graph, profile, self.key, self._closures)
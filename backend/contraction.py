@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import heapq
+import weakref
+import numpy as np
+import graph_snapshot
+
+# Contraction hierarchy over a RoutingGraph, for the "ch" search engine in djikstra.py.
+#
+# Nodes are contracted one at a time, least important first; whenever removing a node would
+# lengthen a shortest path between two of its remaining neighbors, a shortcut arc replaces the
+# path through it. A query then only has to search upwards (towards more important nodes) from
+# both ends. Every hierarchy arc is either an original arc of the graph or a shortcut made of
+# two hierarchy arcs, so a route found in the hierarchy unpacks back into original arcs.
+HIERARCHY_PATH = "contraction.snapshot"
+HIERARCHY_VERSION = 1
+
+# Witness searches give up after settling this many nodes; a missed witness only costs an
+# unneeded shortcut, never a wrong route.
+WITNESS_SETTLE_LIMIT = 200
+
+# Global cache: graph -> hierarchy, for every graph still in use (an old graph keeps its
+# hierarchy while requests that started before a reload finish on it).
+HIERARCHY_CACHE = weakref.WeakKeyDictionary()
+
+def hierarchy_fingerprint(graph):
+    """
+    Identifies the graph a hierarchy file was built for.
+    """
+    return graph_snapshot.graph_fingerprint(graph, f"contraction-{HIERARCHY_VERSION}")
+
+def build_hierarchy(graph):
+    """
+    Contracts every node of the graph.
+    Returns a dict of arrays:
+      rank: contraction order of each node (higher is more important).
+      ch_source, ch_target, ch_cost: the hierarchy arcs. The first ones are the cheapest
+        original arc between each pair of nodes (ch_first is that arc, ch_second is -1); the
+        rest are shortcuts over the hierarchy arcs ch_first then ch_second.
+      up_offsets, up_arcs: CSR of the arcs leaving each node towards a higher rank.
+      down_offsets, down_arcs: CSR of the arcs entering each node from a higher rank.
+    """
+    node_count = graph.node_count
+    offsets, targets, arc_cost = graph.offsets.tolist(), graph.targets.tolist(), graph.arc_cost.tolist()
+    ch_source, ch_target, ch_cost, ch_first, ch_second = [], [], [], [], []
+    # out_arcs[u][v] / in_arcs[v][u]: the cheapest hierarchy arc u -> v among uncontracted nodes.
+    out_arcs = [{} for _ in range(node_count)]
+    in_arcs = [{} for _ in range(node_count)]
+
+    def add_arc(u, v, cost, first, second):
+        current = out_arcs[u].get(v)
+        if current is not None and ch_cost[current] <= cost:
+            return
+        ch_source.append(u)
+        ch_target.append(v)
+        ch_cost.append(cost)
+        ch_first.append(first)
+        ch_second.append(second)
+        out_arcs[u][v] = in_arcs[v][u] = len(ch_cost) - 1
+
+    for u in range(node_count):
+        for arc in range(offsets[u], offsets[u + 1]):
+            if targets[arc] != u:
+                add_arc(u, targets[arc], arc_cost[arc], arc, -1)
+
+    def shortcuts_needed(v):
+        # (u, w, arc u -> v, arc v -> w) for every path u -> v -> w without a witness.
+        needed = []
+        for u, arc_in in in_arcs[v].items():
+            limit = max((ch_cost[arc_in] + ch_cost[arc_out] for w, arc_out in out_arcs[v].items() if w != u),
+                        default=None)
+            if limit is None:
+                continue
+            reached = _witness_search(u, v, limit, out_arcs, ch_cost)
+            for w, arc_out in out_arcs[v].items():
+                if w != u and reached.get(w, float('inf')) > ch_cost[arc_in] + ch_cost[arc_out]:
+                    needed.append((u, w, arc_in, arc_out))
+        return needed
+
+    contracted_neighbors = [0] * node_count
+
+    def priority(v):
+        # Edge difference, plus how many neighbors are already gone to spread contraction evenly.
+        return len(shortcuts_needed(v)) - len(in_arcs[v]) - len(out_arcs[v]) + contracted_neighbors[v]
+
+    queue = [(priority(v), v) for v in range(node_count)]
+    heapq.heapify(queue)
+    rank = np.empty(node_count, dtype=np.int32)
+    next_rank = 0
+    while queue:
+        _, v = heapq.heappop(queue)
+        # Lazy update: contract v only if it is still the least important node.
+        current = priority(v)
+        if queue and current > queue[0][0]:
+            heapq.heappush(queue, (current, v))
+            continue
+        for u, w, arc_in, arc_out in shortcuts_needed(v):
+            add_arc(u, w, ch_cost[arc_in] + ch_cost[arc_out], arc_in, arc_out)
+        for u in in_arcs[v]:
+            del out_arcs[u][v]
+            contracted_neighbors[u] += 1
+        for w in out_arcs[v]:
+            del in_arcs[w][v]
+            contracted_neighbors[w] += 1
+        rank[v] = next_rank
+        next_rank += 1
+
+    ch_source = np.array(ch_source, dtype=np.int32)
+    ch_target = np.array(ch_target, dtype=np.int32)
+    upward = rank[ch_target] > rank[ch_source]
+    up_offsets, up_arcs = _csr(ch_source[upward], np.flatnonzero(upward), node_count)
+    down_offsets, down_arcs = _csr(ch_target[~upward], np.flatnonzero(~upward), node_count)
+    return {
+        "rank": rank,
+        "ch_source": ch_source, "ch_target": ch_target, "ch_cost": np.array(ch_cost),
+        "ch_first": np.array(ch_first, dtype=np.int32), "ch_second": np.array(ch_second, dtype=np.int32),
+        "up_offsets": up_offsets, "up_arcs": up_arcs,
+        "down_offsets": down_offsets, "down_arcs": down_arcs,
+    }
+
+def _witness_search(source, skip, limit, out_arcs, ch_cost):
+    """
+    Dijkstra from source over the uncontracted nodes, avoiding skip, up to cost limit.
+    Returns the distances found.
+    """
+    dist = {source: 0.0}
+    queue = [(0.0, source)]
+    settled = 0
+    while queue and settled < WITNESS_SETTLE_LIMIT:
+        current_dist, current = heapq.heappop(queue)
+        if current_dist > dist[current]:
+            continue
+        if current_dist > limit:
+            break
+        settled += 1
+        for neighbor, arc in out_arcs[current].items():
+            if neighbor == skip:
+                continue
+            alt = current_dist + ch_cost[arc]
+            if alt < dist.get(neighbor, float('inf')):
+                dist[neighbor] = alt
+                heapq.heappush(queue, (alt, neighbor))
+    return dist
+
+def _csr(keys, values, node_count):
+    """
+    Groups values by key (a node index) into (offsets, values sorted by key).
+    """
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=node_count), out=offsets[1:])
+    return offsets, values[order].astype(np.int32)
+
+def unpack_arc(hierarchy, arc, out):
+    """
+    Appends the original arcs making up hierarchy arc arc to out, in travel order.
+    """
+    first, second = hierarchy["ch_first"], hierarchy["ch_second"]
+    stack = [arc]
+    while stack:
+        arc = stack.pop()
+        if second[arc] < 0:
+            out.append(first[arc])
+        else:
+            stack.append(second[arc])
+            stack.append(first[arc])
+    return out
+
+def load_hierarchy(graph):
+    """
+    Returns the contraction hierarchy of graph, with its arrays as Python lists for the search
+    loop. It is read from HIERARCHY_PATH when that was built for the same topology and costs,
+    and built (and saved) otherwise.
+    """
+    if graph in HIERARCHY_CACHE:
+        return HIERARCHY_CACHE[graph]
+    fingerprint = hierarchy_fingerprint(graph)
+    arrays = graph_snapshot.read_arrays(HIERARCHY_PATH, expected_hash=fingerprint)
+    if arrays is None:
+        arrays = build_hierarchy(graph)
+        try:
+            graph_snapshot.write_arrays(arrays, fingerprint, HIERARCHY_PATH)
+        except OSError as e:
+            print("Could not write contraction hierarchy:", e)
+    hierarchy = {name: array.tolist() for name, array in arrays.items()}
+    HIERARCHY_CACHE[graph] = hierarchy
+    return hierarchy
+
+def main():
+    # Rebuild the contraction hierarchy for the current routing graph.
+    import time
+    import djikstra
+    graph = djikstra.load_graph()
+    start = time.perf_counter()
+    arrays = build_hierarchy(graph)
+    elapsed = time.perf_counter() - start
+    graph_snapshot.write_arrays(arrays, hierarchy_fingerprint(graph), HIERARCHY_PATH)
+    shortcuts = int((arrays["ch_second"] >= 0).sum())
+    print(f"Wrote {HIERARCHY_PATH} ({len(arrays['ch_cost'])} arcs, {shortcuts} shortcuts, built in {elapsed:.1f} s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import metrics
+from djikstra import (load_graph, snap_point, build_snap_overlay, combine_polylines, simplify_polyline,
+                      zoom_tolerance, encode_coordinates, ENGINES)
+from topK_dijkstra import k_shortest_paths
+from route_cache import snap_position_key
+from route_cost import DEFAULT_PROFILE
+
+# The directions computation behind /api/directions, kept free of web framework code so that
+# the worker processes of routing_pool.py can run it too.
+
+class RoutingError(Exception):
+    """
+    A directions request that cannot be answered; status is the HTTP status code to report.
+    """
+
+    def __init__(self, status, detail):
+        # Both go to Exception so the error survives pickling back from a worker process.
+        super().__init__(status, detail)
+        self.status = status
+        self.detail = detail
+
+def find_routes(start_coords, end_coords, engine="dijkstra", alternatives=1, cache=None,
+                precision=5, simplify_tolerance=0.0, zoom=None, closures=None, profile=DEFAULT_PROFILE):
+    """
+    Snaps both coordinates onto the routing graph and finds the best route between them, or the
+    best alternatives routes (Yen's algorithm) if alternatives > 1, priced with the named cost
+    profile (route_cost.PROFILES).
+    cache is an optional route_cache.RouteCache shared between calls, and closures an optional
+    closures.ClosureSet whose closures the routes avoid (read once, see ClosureSet.snapshot).
+    Polylines are encoded with precision decimal digits, after dropping the vertices within
+    simplify_tolerance meters of the simplified line, or within what a map at zoom level zoom
+    can show, whichever allows more.
+    Returns a list of (encoded polyline, distance) per route, best first.
+    Raises RoutingError if the graph cannot be loaded, a point cannot be snapped, or there is
+    no route.
+    The query is counted in metrics.REGISTRY.
+    """
+    # The cache key and the overlay must see the same closures, even if they change meanwhile.
+    closures = closures.snapshot() if closures is not None else None
+    with metrics.query("directions", engine=engine, profile=profile, alternatives=alternatives) as record:
+        try:
+            with metrics.stage("load_graph"):
+                graph = load_graph()
+        except Exception as e:
+            raise RoutingError(500, "Failed to load routing data") from e
+        if zoom is not None:
+            simplify_tolerance = max(simplify_tolerance, zoom_tolerance(graph, zoom))
+
+        # Snap the provided start and end onto the graph.
+        with metrics.stage("snap_point"):
+            origin_snapped = snap_point(start_coords, graph)
+            destination_snapped = snap_point(end_coords, graph)
+        if origin_snapped is None or destination_snapped is None:
+            raise RoutingError(404, "Could not snap provided coordinates onto the routing graph.")
+
+        # Nearby clicks on the same walkways share cached routes.
+        cache_key = (engine, profile, alternatives, precision, simplify_tolerance, closures.key if closures is not None else "",
+                     snap_position_key(graph, origin_snapped), snap_position_key(graph, destination_snapped))
+        computed = cache.get(graph.version, cache_key) if cache is not None else None
+        record["cached"] = computed is not None
+        if computed is None:
+            computed = compute_routes(graph, origin_snapped, destination_snapped, engine, alternatives,
+                                      precision, simplify_tolerance, closures, profile)
+            if cache is not None:
+                cache.put(graph.version, cache_key, computed)
+        return computed
+
+def compute_routes(graph, origin_snapped, destination_snapped, engine, alternatives,
+                   precision=5, simplify_tolerance=0.0, closures=None, profile=DEFAULT_PROFILE):
+    """
+    Routes between two snapped positions, as a list of (encoded polyline, distance), best first.
+    Raises RoutingError(404) if there is no route.
+    """
+    # The snapped points (and the closures) only exist in this request's overlay; the cached
+    # graph is left untouched.
+    with metrics.stage("build_snap_overlay"):
+        overlay, (origin_node, destination_node) = build_snap_overlay(graph, [origin_snapped, destination_snapped],
+                                                                      closures, profile)
+
+    # Run the selected search engine between the snapped nodes, or Yen's algorithm for alternatives.
+    if alternatives > 1:
+        with metrics.stage("k_shortest_paths"):
+            paths = k_shortest_paths(graph, origin_node, destination_node, alternatives, overlay)
+    else:
+        with metrics.stage("search"):
+            paths = [ENGINES[engine](graph, origin_node, destination_node, overlay)]
+    if not paths or paths[0][1] is None:
+        raise RoutingError(404, "No path found.")
+
+    computed = []
+    for total_distance, path, edges_in_path in paths:
+        # Combine the polyline segments and encode them using the Google Polyline Algorithm.
+        with metrics.stage("combine_polylines"):
+            full_polyline = combine_polylines(graph, edges_in_path, overlay)
+        if len(full_polyline) == 0:
+            raise RoutingError(404, "No polyline found for the route.")
+
+        # full_polyline holds (lat, lon) rows in degrees.
+        with metrics.stage("simplify_polyline"):
+            full_polyline = simplify_polyline(full_polyline, simplify_tolerance)
+        with metrics.stage("encode_coordinates"):
+            computed.append((encode_coordinates(full_polyline, precision), total_distance))
+    return computed
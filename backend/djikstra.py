@@ -1,201 +1,785 @@
 #!/usr/bin/env python3
 import json
+import os
 import heapq
 import math
+import threading
+import numpy as np
+import contraction
+import elevation
+import geodesy
+import graph_snapshot
+import landmarks
+import metrics
 import route_cost
+import routing_graph
+import shared_graph
+import spatial_index
 
-# Global cache variables for the graph and nodes.
+# Global cache variable for the routing graph (a routing_graph.RoutingGraph).
 GRAPH_CACHE = None
-NODES_CACHE = None
-
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Compute the haversine distance (in meters) between two points given in degrees.
-    """
-    R = 6371000  # Earth's radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def project_point_onto_segment(P, A, B):
-    """
-    Projects point P onto segment AB.
-    P, A, B are tuples (lat, lon) in degrees.
-    Uses an equirectangular approximation (with scaling by cos(P.lat)).
-    Returns (projected_point, t) where t is the parameter (clamped to [0,1]).
-    """
-    lat_rad = math.radians(P[0])
-    cos_lat = math.cos(lat_rad)
-    def to_xy(point):
-        lat, lon = point
-        return (lon * cos_lat, lat)
-    Pxy = to_xy(P)
-    Axy = to_xy(A)
-    Bxy = to_xy(B)
-    Ax, Ay = Axy
-    Bx, By = Bxy
-    Px, Py = Pxy
-    dx = Bx - Ax
-    dy = By - Ay
-    if dx == 0 and dy == 0:
-        return A, 0
-    t = ((Px - Ax) * dx + (Py - Ay) * dy) / (dx * dx + dy * dy)
-    t = max(0, min(1, t))
-    Qx = Ax + t * dx
-    Qy = Ay + t * dy
-    Qlon = Qx / cos_lat
-    Qlat = Qy
-    return (Qlat, Qlon), t
+
+# Held while reload_graph prepares a new graph, so concurrent reloads build it only once.
+RELOAD_LOCK = threading.Lock()
+
+# Ground size in meters of one pixel of a 256-pixel Web Mercator tile at zoom 0, on the equator.
+MERCATOR_METERS_PER_PIXEL = 156543.03392
+
+# Meters by which snapped pieces of an edge may add up to less than the edge before the
+# precomputed engines (contraction_search, alt_search) stop trusting their tables
+# (rounding of the snapped points).
+CHAIN_TOLERANCE = 1e-6
 
 def compute_polyline_distance(polyline):
     """
     Given a polyline (list of vertices with "lat" and "lon" as integers),
     compute the total distance in meters.
     """
-    total = 0.0
-    for i in range(len(polyline) - 1):
-        A = polyline[i]
-        B = polyline[i+1]
-        A_lat = A["lat"] / 1e9
-        A_lon = A["lon"] / 1e9
-        B_lat = B["lat"] / 1e9
-        B_lon = B["lon"] / 1e9
-        total += haversine(A_lat, A_lon, B_lat, B_lon)
-    return total
+    lat = np.array([pt["lat"] for pt in polyline], dtype=np.int64) / 1e9
+    lon = np.array([pt["lon"] for pt in polyline], dtype=np.int64) / 1e9
+    return geodesy.polyline_length(lat, lon)
+
+def geometry_distance(geometry):
+    """
+    Given a polyline as an array of (lat, lon) rows in degrees, compute the total distance in meters.
+    """
+    return geodesy.polyline_length(geometry[:, 0], geometry[:, 1])
 
-def remove_edge_from_graph(graph, u, v, poly):
+def build_graph(stair_index=None):
     """
-    Removes from graph[u] the edge going to v that has polyline equal to poly.
+    Parses formatted_data.json and builds the routing graph (see routing_graph.RoutingGraph).
+    Each junction vertex (identified by its "id") is a node.
+    Each edge can be walked in both directions; both directions share one copy of its polyline.
+    Staircase membership is worked out here once per edge (with stair_index, by default the
+    cached one of route_cost), and heights and grades are sampled from elevation.npz, so the
+    search only reads graph.arc_cost.
     """
-    if u in graph:
-        new_edges = []
-        for edge in graph[u]:
-            neighbor, weight, p = edge
-            if neighbor == v and p == poly:
-                continue
-            new_edges.append(edge)
-        graph[u] = new_edges
+    with open("formatted_data.json", "r") as f:
+        segments = json.load(f)
+    if stair_index is None:
+        stair_index = route_cost.get_stair_index()
+    return routing_graph.build_routing_graph(segments, stair_index, elevation.load_dem())
 
-def add_edge_to_graph(graph, u, v, poly, distance):
+def open_graph(source, stair_index=None):
     """
-    Adds an edge from u to v with the given polyline and weight.
+    Returns a new routing graph for the source files with the given hash: memory-mapped from
+    the snapshot when that matches, otherwise built from the JSON (see build_graph) and saved
+    as the new snapshot. graph.version is set to source.
     """
-    graph.setdefault(u, []).append((v, distance, poly))
+    graph = graph_snapshot.read_snapshot(expected_hash=source)
+    if graph is None:
+        graph = build_graph(stair_index)
+        try:
+            graph_snapshot.write_snapshot(graph, source)
+        except OSError as e:
+            print("Could not write graph snapshot:", e)
+    graph.version = source
+    return graph
 
 def load_graph():
     """
-    Loads formatted_data.json and builds an undirected graph.
-    Each junction vertex (identified by its "id") is a node.
-    Each edge becomes bidirectional with a weight (distance) and its polyline.
-    For the reverse direction, the polyline is stored in reverse.
-    Uses caching to avoid reloading the graph on subsequent calls.
+    Returns the routing graph, using caching to avoid reloading it on subsequent calls.
+    The graph is memory-mapped from the binary snapshot (graph_snapshot.py) when that was built
+    from the current source files (formatted_data.json, stairs.json, elevation.npz); otherwise
+    it is rebuilt from them and the snapshot is rewritten for the next start-up.
+    When a launcher has published the graph for its workers (shared_graph.py), the process maps
+    that read-only instead.
+    graph.version is set to the hash of those source files.
     """
-    global GRAPH_CACHE, NODES_CACHE
-    if GRAPH_CACHE is not None and NODES_CACHE is not None:
-        return GRAPH_CACHE, NODES_CACHE
-    with open("formatted_data.json", "r") as f:
-        segments = json.load(f)
-    graph = {}   # node_id -> list of (neighbor_id, distance, polyline)
-    nodes = {}   # node_id -> (lat, lon) in degrees
-    for seg in segments:
-        for edge in seg["edges"]:
-            start = edge["start"]
-            end = edge["end"]
-            start_id = start["id"]
-            end_id = end["id"]
-            d = edge["distance"]
-            if start_id not in nodes:
-                nodes[start_id] = (start["lat"] / 1e9, start["lon"] / 1e9)
-            if end_id not in nodes:
-                nodes[end_id] = (end["lat"] / 1e9, end["lon"] / 1e9)
-            graph.setdefault(start_id, []).append((end_id, d, edge["polyline"]))
-            graph.setdefault(end_id, []).append((start_id, d, list(reversed(edge["polyline"]))))
-    GRAPH_CACHE = graph
-    NODES_CACHE = nodes
-    return graph, nodes
-
-def dijkstra(graph, start, goal):
-    """
-    Standard Dijkstra algorithm.
-    Returns a tuple: (total_distance, list_of_node_ids, list_of_polyline_segments used).
-    """
-    dist = {node: float('inf') for node in graph}
-    previous = {node: None for node in graph}
-    edge_used = {node: None for node in graph}
-    dist[start] = 0
-    queue = [(0, start)]
+    global GRAPH_CACHE
+    if GRAPH_CACHE is not None:
+        return GRAPH_CACHE
+    shared_path = os.environ.get(shared_graph.SHARED_GRAPH_ENV)
+    if shared_path:
+        attached = shared_graph.attach_graph(shared_path)
+        if attached is not None:
+            source, graph = attached
+            graph.version = source
+            GRAPH_CACHE = graph
+            return GRAPH_CACHE
+        print(f"Shared graph {shared_path} not found; loading the graph in this process.")
+    GRAPH_CACHE = open_graph(graph_snapshot.source_hash())
+    return GRAPH_CACHE
+
+def reload_graph(force=False):
+    """
+    Rebuilds the routing graph from the current source files (see load_graph) and swaps
+    it in, read-copy-update style: the new graph (with its search lists, contraction hierarchy
+    and landmarks) is fully prepared first and then replaces GRAPH_CACHE in one assignment.
+    Requests that already hold the old graph finish on it; the old graph is freed once the
+    last of them lets go.
+    Nothing is rebuilt when the sources hash to the current version, unless force is set.
+    Returns (graph, True if a new graph was swapped in).
+    """
+    global GRAPH_CACHE
+    with RELOAD_LOCK:
+        source = graph_snapshot.source_hash()
+        current = GRAPH_CACHE
+        if current is not None and current.version == source and not force:
+            return current, False
+        staircases = route_cost.read_staircases()
+        stair_index = route_cost.build_stair_index(staircases)
+        route_cost.install_model_profile()
+        graph = open_graph(source, stair_index)
+        graph.search_lists()
+        for profile in route_cost.PROFILES:
+            graph.profile_costs(profile)
+        contraction.load_hierarchy(graph)
+        landmarks.load_landmarks(graph)
+        # A graph published by a launcher describes the old sources; worker processes started
+        # from now on load the current ones.
+        os.environ.pop(shared_graph.SHARED_GRAPH_ENV, None)
+        route_cost.install_staircases(staircases, stair_index)
+        GRAPH_CACHE = graph
+        return graph, True
+
+def search_lists(graph, overlay=None):
+    """
+    Returns graph.search_lists(), with the arc costs of the overlay (its cost profile and the
+    closures in force, see build_snap_overlay) in place of the graph's own when it has any.
+    """
+    lists = graph.search_lists()
+    if overlay and overlay.get("arc_cost") is not None:
+        return lists[0], lists[1], overlay["arc_cost"], lists[3]
+    return lists
+
+def dijkstra(graph, start, goal, overlay=None):
+    """
+    Standard Dijkstra algorithm over a RoutingGraph.
+    Each arc costs its distance plus the staircase penalty (graph.arc_cost).
+    If an overlay from build_snap_overlay is given, its virtual nodes and arcs are searched
+    as if they were part of the graph, and its arc costs (cost profile, closures) are used.
+    Returns a tuple: (total_distance, list_of_node_indices, list_of_arc_ids used).
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    dist = {start: 0.0}
+    previous = {start: None}  # node -> (previous node, arc used to reach it)
+    queue = [(0.0, start)]
+    # Every push is popped or still queued at the end, so only pops are counted.
+    pops = stale = relaxed = 0
     while queue:
         current_dist, current = heapq.heappop(queue)
+        pops += 1
         if current == goal:
             break
         if current_dist > dist[current]:
+            stale += 1
             continue
-        for neighbor, weight, poly in graph[current]:
-            alt = current_dist + weight + route_cost.compute_edge_cost(poly)
-            print(alt)
-            if alt < dist[neighbor]:
+        if current < node_count:
+            first, last = offsets[current], offsets[current + 1]
+            relaxed += last - first
+            for arc in range(first, last):
+                neighbor = targets[arc]
+                alt = current_dist + arc_cost[arc]
+                if alt < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = alt
+                    previous[neighbor] = (current, arc)
+                    heapq.heappush(queue, (alt, neighbor))
+        for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+            relaxed += 1
+            alt = current_dist + weight
+            if alt < dist.get(neighbor, float('inf')):
                 dist[neighbor] = alt
-                previous[neighbor] = current
-                edge_used[neighbor] = poly
+                previous[neighbor] = (current, arc)
                 heapq.heappush(queue, (alt, neighbor))
-    if dist[goal] == float('inf'):
+    metrics.count(heap_pushes=pops + len(queue), heap_pops=pops, nodes_settled=pops - stale, edges_relaxed=relaxed)
+    if goal not in dist:
+        return None, None, None
+    path = [goal]
+    arcs_in_path = []
+    step = previous[goal]
+    while step is not None:
+        node, arc = step
+        path.append(node)
+        arcs_in_path.append(arc)
+        step = previous[node]
+    path.reverse()
+    arcs_in_path.reverse()
+    return dist[goal], path, arcs_in_path
+
+def bidirectional_dijkstra(graph, start, goal, overlay=None):
+    """
+    Bidirectional Dijkstra: one search grows from start over outgoing arcs, the other from goal
+    over incoming arcs (the twins of each node's outgoing arcs, at the twin's cost).
+    The side with the smaller queue head is expanded next, and the search stops once the two
+    queue heads together cannot beat the best start -> goal cost seen at a meeting node.
+    Same arguments and return value as dijkstra.
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    overlay_arcs = overlay["arcs"] if overlay else {}
+    if start == goal:
+        return 0.0, [start], []
+    dist = ({start: 0.0}, {goal: 0.0})
+    # Forward: node -> (previous node, arc). Backward: node -> (next node, arc from node to it).
+    link = ({start: None}, {goal: None})
+    queues = ([(0.0, start)], [(0.0, goal)])
+    settled = (set(), set())
+    best = float('inf')
+    meeting = None
+    pops = relaxed = 0
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        current_dist, current = heapq.heappop(queues[side])
+        pops += 1
+        if current in settled[side]:
+            continue
+        settled[side].add(current)
+        this_dist, other_dist = dist[side], dist[1 - side]
+        this_link, queue = link[side], queues[side]
+        if current < node_count:
+            arcs = range(offsets[current], offsets[current + 1])
+        else:
+            arcs = ()
+        relaxed += len(arcs)
+        for arc in arcs:
+            # The backward search walks the twin arc, neighbor -> current.
+            used = arc if side == 0 else arc_twin[arc]
+            neighbor = targets[arc]
+            alt = current_dist + arc_cost[used]
+            if alt < this_dist.get(neighbor, float('inf')):
+                this_dist[neighbor] = alt
+                this_link[neighbor] = (current, used)
+                heapq.heappush(queue, (alt, neighbor))
+                if neighbor in other_dist and alt + other_dist[neighbor] < best:
+                    best = alt + other_dist[neighbor]
+                    meeting = neighbor
+        for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+            relaxed += 1
+            # Both directions of a virtual arc cost the same.
+            used = arc if side == 0 else overlay_arcs[arc]["twin"]
+            alt = current_dist + weight
+            if alt < this_dist.get(neighbor, float('inf')):
+                this_dist[neighbor] = alt
+                this_link[neighbor] = (current, used)
+                heapq.heappush(queue, (alt, neighbor))
+                if neighbor in other_dist and alt + other_dist[neighbor] < best:
+                    best = alt + other_dist[neighbor]
+                    meeting = neighbor
+    metrics.count(heap_pushes=pops + len(queues[0]) + len(queues[1]), heap_pops=pops,
+                  nodes_settled=len(settled[0]) + len(settled[1]), edges_relaxed=relaxed)
+    if meeting is None:
+        return None, None, None
+    path = [meeting]
+    arcs_in_path = []
+    step = link[0][meeting]
+    while step is not None:
+        node, arc = step
+        path.append(node)
+        arcs_in_path.append(arc)
+        step = link[0][node]
+    path.reverse()
+    arcs_in_path.reverse()
+    step = link[1][meeting]
+    while step is not None:
+        node, arc = step
+        path.append(node)
+        arcs_in_path.append(arc)
+        step = link[1][node]
+    return best, path, arcs_in_path
+
+def astar_heuristic(graph, goal, overlay=None):
+    """
+    Lower bounds on the cost from every node to goal, for astar.
+    Walking costs at least the planar distance, except on shortcut edges, whose junctions the
+    source data places further apart than the edge costs under the overlay's cost profile
+    (RoutingGraph.profile_costs, plus any such virtual arc); closures only add to costs.
+    Their endpoints are portals: a route either reaches goal without a shortcut, or walks to a
+    portal first. The portals' own bounds come from the shortest paths in the small graph of
+    portals, goal and shortcuts, with planar distances between them.
+    This keeps the heuristic consistent, so every node is settled once.
+    Returns (list of bounds for the graph's nodes, dict of bounds for virtual nodes).
+    """
+    scale = routing_graph.HEURISTIC_SCALE
+    virtual_xy = {}
+    costs = graph.profile_costs(overlay["profile"] if overlay else route_cost.DEFAULT_PROFILE)
+    edge_penalty = costs["edge_penalty"]
+    shortcuts = [(int(graph.edge_u[e]), int(graph.edge_v[e]), float(graph.edge_distance[e] + edge_penalty[e]))
+                 for e in costs["shortcut_edges"].tolist()]
+    if overlay:
+        for node, (lat, lon) in overlay["nodes"].items():
+            virtual_xy[node] = graph.project(lat, lon)
+        for a, entries in overlay["adjacency"].items():
+            for arc, b, cost in entries:
+                (ax, ay), (bx, by) = _planar(graph, virtual_xy, a), _planar(graph, virtual_xy, b)
+                if cost < scale * math.hypot(ax - bx, ay - by):
+                    shortcuts.append((a, b, cost))
+    # Floyd-Warshall over goal (first) and the portals.
+    nodes = [goal] + sorted({n for a, b, cost in shortcuts for n in (a, b)} - {goal})
+    xy = [_planar(graph, virtual_xy, node) for node in nodes]
+    lower = [[scale * math.hypot(x1 - x2, y1 - y2) for x2, y2 in xy] for x1, y1 in xy]
+    position = {node: i for i, node in enumerate(nodes)}
+    for a, b, cost in shortcuts:
+        i, j = position[a], position[b]
+        lower[i][j] = lower[j][i] = min(lower[i][j], cost)
+    for k in range(len(nodes)):
+        for i in range(len(nodes)):
+            for j in range(len(nodes)):
+                if lower[i][k] + lower[k][j] < lower[i][j]:
+                    lower[i][j] = lower[i][k] + lower[k][j]
+    bound = np.full(graph.node_count, np.inf)
+    for (x, y), rest in zip(xy, (row[0] for row in lower)):
+        np.minimum(bound, scale * np.hypot(graph.node_x - x, graph.node_y - y) + rest, out=bound)
+    virtual_bound = {}
+    for node, (vx, vy) in virtual_xy.items():
+        virtual_bound[node] = min(scale * math.hypot(vx - x, vy - y) + row[0] for (x, y), row in zip(xy, lower))
+    return bound.tolist(), virtual_bound
+
+def _planar(graph, virtual_xy, node):
+    """
+    Planar position of a graph or virtual node.
+    """
+    if node < graph.node_count:
+        return float(graph.node_x[node]), float(graph.node_y[node])
+    return virtual_xy[node]
+
+def astar(graph, start, goal, overlay=None):
+    """
+    A* search: Dijkstra ordered by cost so far plus astar_heuristic's lower bound on the cost
+    left, which steers the search towards goal. Arc costs include the staircase penalty and are
+    never below the planar length the bound is built from, so the result is exact.
+    Same arguments and return value as dijkstra.
+    """
+    bound, virtual_bound = astar_heuristic(graph, goal, overlay)
+    return _astar_search(graph, start, goal, overlay, bound, virtual_bound)
+
+def alt_search(graph, start, goal, overlay=None):
+    """
+    A* search with landmark lower bounds (see landmarks.py), which account for the staircase
+    penalty and detours the way planar distance cannot.
+    Virtual nodes get landmark distances through their overlay arcs, which is exact only while
+    the overlay leaves graph distances alone; otherwise the query is answered by astar instead.
+    The landmark tables hold the graph's own costs, so they bound the overlay's costs from below
+    as long as its cost profile is dearer (RoutingGraph.profile_costs) and closures only make
+    arcs dearer; for a cheaper profile the query is answered by astar too.
+    Same arguments and return value as dijkstra.
+    """
+    if overlay and (not graph.profile_costs(overlay["profile"])["dearer"] or
+                    not _overlay_keeps_distances(graph, overlay)):
+        return astar(graph, start, goal, overlay)
+    tables = landmarks.load_landmarks(graph)
+    from_table, to_table = tables["from_landmark"], tables["to_landmark"]
+    node_count = graph.node_count
+    virtual_from, virtual_to = {}, {}
+    if overlay:
+        for node in overlay["nodes"]:
+            virtual_from[node] = np.full(len(from_table), np.inf)
+            virtual_to[node] = np.full(len(to_table), np.inf)
+        # Relax the overlay arcs until the virtual columns settle; chains are short.
+        for _ in range(len(virtual_from) + 1):
+            changed = False
+            for a, entries in overlay["adjacency"].items():
+                for arc, b, _ in entries:
+                    cost = overlay["arcs"][arc]["base_cost"]
+                    if b >= node_count:
+                        source = from_table[:, a] if a < node_count else virtual_from[a]
+                        candidate = np.minimum(virtual_from[b], source + cost)
+                        changed |= bool((candidate < virtual_from[b]).any())
+                        virtual_from[b] = candidate
+                    if a >= node_count:
+                        rest = to_table[:, b] if b < node_count else virtual_to[b]
+                        candidate = np.minimum(virtual_to[a], rest + cost)
+                        changed |= bool((candidate < virtual_to[a]).any())
+                        virtual_to[a] = candidate
+            if not changed:
+                break
+    if goal < node_count:
+        from_goal, to_goal = from_table[:, goal].astype(np.float64), to_table[:, goal].astype(np.float64)
+    else:
+        from_goal, to_goal = virtual_from[goal], virtual_to[goal]
+    bound = landmarks.lower_bounds(tables, from_goal, to_goal, from_table, to_table).tolist()
+    virtual_bound = {}
+    if virtual_from:
+        nodes = list(virtual_from)
+        values = landmarks.lower_bounds(tables, from_goal, to_goal,
+                                        np.stack([virtual_from[n] for n in nodes], axis=1),
+                                        np.stack([virtual_to[n] for n in nodes], axis=1))
+        virtual_bound = dict(zip(nodes, values.tolist()))
+    return _astar_search(graph, start, goal, overlay, bound, virtual_bound)
+
+def _astar_search(graph, start, goal, overlay, bound, virtual_bound):
+    """
+    The A* loop shared by astar and alt_search; bound and virtual_bound are lower bounds on the
+    cost left to goal from each graph node and virtual node.
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    dist = {start: 0.0}
+    previous = {start: None}  # node -> (previous node, arc used to reach it)
+    start_bound = bound[start] if start < node_count else virtual_bound[start]
+    queue = [(start_bound, 0.0, start)]
+    pops = stale = relaxed = 0
+    while queue:
+        estimate, current_dist, current = heapq.heappop(queue)
+        pops += 1
+        if current == goal or estimate == float('inf'):
+            # An infinite bound proves goal out of reach from everything left in the queue.
+            break
+        if current_dist > dist[current]:
+            stale += 1
+            continue
+        if current < node_count:
+            first, last = offsets[current], offsets[current + 1]
+            relaxed += last - first
+            for arc in range(first, last):
+                neighbor = targets[arc]
+                alt = current_dist + arc_cost[arc]
+                if alt < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = alt
+                    previous[neighbor] = (current, arc)
+                    heapq.heappush(queue, (alt + bound[neighbor], alt, neighbor))
+        for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+            relaxed += 1
+            alt = current_dist + weight
+            if alt < dist.get(neighbor, float('inf')):
+                dist[neighbor] = alt
+                previous[neighbor] = (current, arc)
+                rest = bound[neighbor] if neighbor < node_count else virtual_bound[neighbor]
+                heapq.heappush(queue, (alt + rest, alt, neighbor))
+    metrics.count(heap_pushes=pops + len(queue), heap_pops=pops, nodes_settled=pops - stale, edges_relaxed=relaxed)
+    if goal not in dist:
         return None, None, None
-    path = []
-    edges_in_path = []
-    node = goal
-    while node is not None:
+    path = [goal]
+    arcs_in_path = []
+    step = previous[goal]
+    while step is not None:
+        node, arc = step
         path.append(node)
-        node = previous[node]
+        arcs_in_path.append(arc)
+        step = previous[node]
     path.reverse()
-    for i in range(1, len(path)):
-        edges_in_path.append(edge_used[path[i]])
-    return dist[goal], path, edges_in_path
+    arcs_in_path.reverse()
+    return dist[goal], path, arcs_in_path
+
+def contraction_search(graph, start, goal, overlay=None):
+    """
+    Point-to-point query on the graph's contraction hierarchy (see contraction.py): both
+    searches only follow arcs towards more important nodes and meet at the top of the route,
+    which is then unpacked back into the graph's arcs.
+    Snapped (virtual) nodes count as the least important nodes, so each search first walks its
+    overlay arcs. That only holds while no chain of virtual arcs is cheaper than the edge it was
+    cut from, and while the overlay keeps the graph's own arc costs (the hierarchy's shortcuts
+    are made of them, so other cost profiles and closures are not seen);
+    otherwise the query is answered by bidirectional_dijkstra instead.
+    Same arguments and return value as dijkstra.
+    """
+    hierarchy = contraction.load_hierarchy(graph)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    overlay_arcs = overlay["arcs"] if overlay else {}
+    if overlay and (overlay.get("arc_cost") is not None or
+                    overlay_arcs and not _overlay_keeps_distances(graph, overlay)):
+        return bidirectional_dijkstra(graph, start, goal, overlay)
+    offsets = (hierarchy["up_offsets"], hierarchy["down_offsets"])
+    arc_lists = (hierarchy["up_arcs"], hierarchy["down_arcs"])
+    ends = (hierarchy["ch_target"], hierarchy["ch_source"])
+    ch_cost = hierarchy["ch_cost"]
+    dist = ({start: 0.0}, {goal: 0.0})
+    # node -> (node it was reached from, arc, whether the arc is a virtual one); the backward
+    # search records arcs in travel direction, i.e. leaving the node.
+    link = ({start: None}, {goal: None})
+    queues = ([(0.0, start)], [(0.0, goal)])
+    best = float('inf')
+    meeting = None
+    # Queue entries dropped unpopped once a side reaches best still count as pushes.
+    pops = stale = relaxed = dropped = 0
+    while queues[0] or queues[1]:
+        # Unlike plain bidirectional search, each side runs until its own queue reaches best.
+        side = 0 if queues[0] and (not queues[1] or queues[0][0][0] <= queues[1][0][0]) else 1
+        current_dist, current = heapq.heappop(queues[side])
+        pops += 1
+        if current_dist >= best:
+            stale += 1
+            dropped += len(queues[side])
+            queues[side].clear()
+            continue
+        this_dist, other_dist = dist[side], dist[1 - side]
+        if current_dist > this_dist[current]:
+            stale += 1
+            continue
+        if current in other_dist and current_dist + other_dist[current] < best:
+            best = current_dist + other_dist[current]
+            meeting = current
+        this_link, queue = link[side], queues[side]
+        if current < node_count:
+            side_ends = ends[side]
+            side_arcs = arc_lists[side][offsets[side][current]:offsets[side][current + 1]]
+            relaxed += len(side_arcs)
+            for arc in side_arcs:
+                neighbor = side_ends[arc]
+                alt = current_dist + ch_cost[arc]
+                if alt < this_dist.get(neighbor, float('inf')):
+                    this_dist[neighbor] = alt
+                    this_link[neighbor] = (current, arc, False)
+                    heapq.heappush(queue, (alt, neighbor))
+        else:
+            for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+                relaxed += 1
+                alt = current_dist + weight
+                if alt < this_dist.get(neighbor, float('inf')):
+                    this_dist[neighbor] = alt
+                    this_link[neighbor] = (current, arc if side == 0 else overlay_arcs[arc]["twin"], True)
+                    heapq.heappush(queue, (alt, neighbor))
+    metrics.count(heap_pushes=pops + dropped, heap_pops=pops, nodes_settled=pops - stale, edges_relaxed=relaxed)
+    if meeting is None:
+        return None, None, None
+    # Top-level arcs from start up to the meeting node, then down to goal, as (arc, virtual, head).
+    top = []
+    node = meeting
+    while link[0][node] is not None:
+        previous, arc, virtual = link[0][node]
+        top.append((arc, virtual, node))
+        node = previous
+    top.reverse()
+    node = meeting
+    while link[1][node] is not None:
+        following, arc, virtual = link[1][node]
+        top.append((arc, virtual, following))
+        node = following
+    # Unpack shortcuts and add the cost up arc by arc, as dijkstra does.
+    arc_cost = graph.search_lists()[2]
+    path = [start]
+    arcs_in_path = []
+    total = 0.0
+    for arc, virtual, head in top:
+        if virtual:
+            total += overlay_arcs[arc]["cost"]
+            path.append(head)
+            arcs_in_path.append(arc)
+            continue
+        for piece in contraction.unpack_arc(hierarchy, arc, []):
+            total += arc_cost[piece]
+            path.append(int(graph.targets[piece]))
+            arcs_in_path.append(piece)
+    return total, path, arcs_in_path
 
-def combine_polylines(polylines):
+def _overlay_keeps_distances(graph, overlay):
     """
-    Combines a list of polyline segments (each a list of vertices) into one continuous polyline,
+    True if no chain of virtual arcs between the endpoints of an edge costs less than the edge
+    (both at the graph's own costs), so that the overlay leaves every distance between graph
+    nodes as it was.
+    """
+    chains = {}
+    for a, entries in overlay["adjacency"].items():
+        for arc, b, cost in entries:
+            chains.setdefault(overlay["arcs"][arc]["edge"], []).append(overlay["arcs"][arc]["base_cost"])
+    for edge, costs in chains.items():
+        # Each chain is listed in both directions.
+        if sum(costs) / 2 < float(graph.edge_distance[edge] + graph.edge_penalty[edge]) - CHAIN_TOLERANCE:
+            return False
+    return True
+
+# Search engines selectable by name; all take (graph, start, goal, overlay) and return
+# (total_distance, list_of_node_indices, list_of_arc_ids).
+ENGINES = {
+    "dijkstra": dijkstra,
+    "bidirectional": bidirectional_dijkstra,
+    "astar": astar,
+    "ch": contraction_search,
+    "alt": alt_search,
+}
+
+def dijkstra_many(graph, start, goals, overlay=None):
+    """
+    One Dijkstra search tree from start, grown until every node in goals is settled (or
+    everything reachable is).
+    Returns {goal: total_distance} for the goals that can be reached.
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    remaining = set(goals)
+    found = {}
+    dist = {start: 0.0}
+    queue = [(0.0, start)]
+    pops = stale = relaxed = 0
+    while queue and remaining:
+        current_dist, current = heapq.heappop(queue)
+        pops += 1
+        if current_dist > dist[current]:
+            stale += 1
+            continue
+        if current in remaining:
+            remaining.discard(current)
+            found[current] = current_dist
+        if current < node_count:
+            first, last = offsets[current], offsets[current + 1]
+            relaxed += last - first
+            for arc in range(first, last):
+                neighbor = targets[arc]
+                alt = current_dist + arc_cost[arc]
+                if alt < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = alt
+                    heapq.heappush(queue, (alt, neighbor))
+        for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+            relaxed += 1
+            alt = current_dist + weight
+            if alt < dist.get(neighbor, float('inf')):
+                dist[neighbor] = alt
+                heapq.heappush(queue, (alt, neighbor))
+    metrics.count(heap_pushes=pops + len(queue), heap_pops=pops, nodes_settled=pops - stale, edges_relaxed=relaxed)
+    return found
+
+def dijkstra_within(graph, start, budget, overlay=None):
+    """
+    One Dijkstra search tree from start, grown until the next node would cost more than budget.
+    Returns {node: total_distance} for every node (graph or virtual) within budget.
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    settled = {}
+    dist = {start: 0.0}
+    queue = [(0.0, start)]
+    pops = relaxed = 0
+    while queue:
+        current_dist, current = heapq.heappop(queue)
+        pops += 1
+        if current_dist > budget:
+            break
+        if current in settled:
+            continue
+        settled[current] = current_dist
+        if current < node_count:
+            first, last = offsets[current], offsets[current + 1]
+            relaxed += last - first
+            for arc in range(first, last):
+                neighbor = targets[arc]
+                alt = current_dist + arc_cost[arc]
+                if alt <= budget and alt < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = alt
+                    heapq.heappush(queue, (alt, neighbor))
+        for arc, neighbor, weight in overlay_adjacency.get(current, ()):
+            relaxed += 1
+            alt = current_dist + weight
+            if alt <= budget and alt < dist.get(neighbor, float('inf')):
+                dist[neighbor] = alt
+                heapq.heappush(queue, (alt, neighbor))
+    metrics.count(heap_pushes=pops + len(queue), heap_pops=pops, nodes_settled=len(settled), edges_relaxed=relaxed)
+    return settled
+
+def distance_matrix(graph, origin_snaps, destination_snaps=None, closures=None, profile=route_cost.DEFAULT_PROFILE):
+    """
+    Walking distances (arc costs under the cost profile, stair penalty included) from every
+    origin to every destination, given as snapped positions from snap_point, avoiding the
+    closures in force in the optional closures.ClosureSet. All points share one overlay, and
+    each origin needs a single search tree. Without destination_snaps the destinations are the
+    origins, which then join the overlay only once.
+    Returns a list of rows, one per origin, of distances (None where unreachable).
+    """
+    snaps = list(origin_snaps) + (list(destination_snaps) if destination_snaps is not None else [])
+    overlay, virtual_ids = build_snap_overlay(graph, snaps, closures, profile)
+    origins = virtual_ids[:len(origin_snaps)]
+    destinations = virtual_ids[len(origin_snaps):] if destination_snaps is not None else origins
+    rows = []
+    for origin in origins:
+        found = dijkstra_many(graph, origin, destinations, overlay)
+        rows.append([found.get(destination) for destination in destinations])
+    return rows
+
+def combine_polylines(graph, arcs, overlay=None):
+    """
+    Combines the geometry of a list of arcs into one continuous polyline,
     removing duplicate junction vertices.
+    Returns an array of (lat, lon) rows in degrees.
+    """
+    if not arcs:
+        return np.empty((0, 2))
+    pieces = []
+    for k, arc in enumerate(arcs):
+        if arc < graph.arc_count:
+            geometry = graph.arc_geometry(arc)
+        else:
+            geometry = overlay["arcs"][arc]["geometry"]
+        pieces.append(geometry if k == 0 else geometry[1:])
+    return np.concatenate(pieces)
+
+def simplify_polyline(polyline, tolerance):
+    """
+    Simplifies a polyline (array of (lat, lon) rows in degrees) with the Douglas-Peucker
+    algorithm: vertices are dropped as long as the result stays within tolerance meters of every
+    dropped vertex. The first and last vertex are always kept. Returns the kept rows.
+    All pieces still to be split are handled together, one level of the recursion per pass.
+    """
+    n = len(polyline)
+    if n < 3 or not tolerance > 0:
+        return polyline
+    x, y = geodesy.equirectangular(polyline[:, 0], polyline[:, 1], float(polyline[:, 0].mean()))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    first, last = np.array([0]), np.array([n - 1])
+    while len(first):
+        inner = last - first - 1
+        first, last, inner = first[inner > 0], last[inner > 0], inner[inner > 0]
+        if not len(first):
+            break
+        # Every inner vertex of every piece, with the piece it belongs to.
+        piece = np.repeat(np.arange(len(first)), inner)
+        starts = np.cumsum(inner) - inner
+        vertex = first[piece] + 1 + np.arange(len(piece)) - starts[piece]
+        # Distance of each inner vertex from the segment joining its piece's ends.
+        ax, ay = x[first][piece], y[first][piece]
+        dx, dy = x[last][piece] - ax, y[last][piece] - ay
+        px, py = x[vertex] - ax, y[vertex] - ay
+        length_sq = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(length_sq > 0, np.clip((px * dx + py * dy) / length_sq, 0, 1), 0.0)
+        distances = np.hypot(px - t * dx, py - t * dy)
+        # The farthest vertex of each piece (the first one on ties), split there if too far.
+        farthest = np.maximum.reduceat(distances, starts)
+        is_farthest = distances == farthest[piece]
+        split = vertex[is_farthest][np.unique(piece[is_farthest], return_index=True)[1]]
+        far = farthest > tolerance
+        split, first, last = split[far], first[far], last[far]
+        keep[split] = True
+        first, last = np.concatenate([first, split]), np.concatenate([split, last])
+    return polyline[keep]
+
+def zoom_tolerance(graph, zoom):
+    """
+    Returns the simplification tolerance in meters for a map shown at the given Web Mercator
+    zoom level: half a pixel on the ground at the graph's latitude, which no one can see.
     """
-    if not polylines:
-        return []
-    combined = polylines[0][:]
-    for poly in polylines[1:]:
-        combined.extend(poly[1:])
-    return combined
+    cos_lat = graph.projection[0] / graph.projection[1]
+    return float(MERCATOR_METERS_PER_PIXEL * cos_lat / 2 ** zoom / 2)
+
+def encode_coordinates(coordinates, precision=5):
+    """
+    Encodes an array of (lat, lon) rows in degrees using the Google Encoded Polyline Algorithm,
+    with precision decimal digits (5 is what Google Maps expects).
+    Every value is expanded into its 5-bit chunks at once and the characters are written into
+    one buffer, instead of building the string one chunk at a time.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    if len(coordinates) == 0:
+        return ""
+    # Each step is rounded on its own (not the difference of rounded positions), as the
+    # encoder always has, so responses stay byte for byte the same.
+    steps = np.diff(coordinates, axis=0, prepend=np.zeros((1, 2)))
+    values = np.rint(steps * 10.0 ** precision).astype(np.int64).ravel()
+    values = np.where(values < 0, ~(values << 1), values << 1)
+    width = max(1, (int(values.max()).bit_length() + 4) // 5)
+    shifts = 5 * np.arange(width)
+    chunks = (values[:, None] >> shifts) & 0x1f
+    # Number of chunks each value needs; every chunk but its last has the continuation bit.
+    counts = 1 + (values[:, None] >= (1 << shifts[1:])).sum(axis=1)
+    position = np.arange(width)
+    chunks |= np.where(position < counts[:, None] - 1, 0x20, 0)
+    buffer = (chunks + 63).astype(np.uint8)
+    return buffer[position < counts[:, None]].tobytes().decode("ascii")
 
 def encode_polyline(points):
     """
     Encodes a polyline using the Google Encoded Polyline Algorithm.
     Points is a list of dicts with "lat" and "lon" (in degrees).
     """
-    def encode_coordinate(coordinate):
-        coordinate = int(round(coordinate * 1e5))
-        coordinate = coordinate << 1
-        if coordinate < 0:
-            coordinate = ~coordinate
-        encoded = ""
-        while coordinate >= 0x20:
-            encoded += chr((0x20 | (coordinate & 0x1f)) + 63)
-            coordinate >>= 5
-        encoded += chr(coordinate + 63)
-        return encoded
-    result = ""
-    prev_lat = 0
-    prev_lon = 0
-    for point in points:
-        lat = point["lat"]
-        lon = point["lon"]
-        d_lat = lat - prev_lat
-        d_lon = lon - prev_lon
-        result += encode_coordinate(d_lat)
-        result += encode_coordinate(d_lon)
-        prev_lat = lat
-        prev_lon = lon
-    return result
+    return encode_coordinates([(point["lat"], point["lon"]) for point in points])
 
 def load_nodes():
     """
@@ -205,71 +789,127 @@ def load_nodes():
         nodes_list = json.load(f)
     return nodes_list
 
-def snap_point(P, graph, nodes):
+def snap_point(P, graph):
     """
     Snaps point P (tuple (lat, lon) in degrees) onto the closest point on any edge in the graph.
-    The function iterates over each unique edge, finds the projection onto each segment,
-    and selects the one with minimum haversine distance.
-    It then splits that edge by inserting a new node at the projected point,
-    updating the graph (both directions) accordingly.
-    Returns the new node's id.
-    """
-    best_distance = float('inf')
-    best_edge_info = None  # Will hold (u, v, poly, segment_index, t)
-    # Iterate over unique edges (consider only u < v to avoid duplicates).
-    for u in graph:
-        for (v, weight, poly) in graph[u]:
-            if u < v:
-                for i in range(len(poly) - 1):
-                    A = poly[i]
-                    B = poly[i+1]
-                    A_lat = A["lat"] / 1e9
-                    A_lon = A["lon"] / 1e9
-                    B_lat = B["lat"] / 1e9
-                    B_lon = B["lon"] / 1e9
-                    proj, t = project_point_onto_segment(P, (A_lat, A_lon), (B_lat, B_lon))
-                    d = haversine(P[0], P[1], proj[0], proj[1])
-                    if d < best_distance:
-                        best_distance = d
-                        best_edge_info = (u, v, poly, i, t)
-    if best_edge_info is None:
+    The segment index only returns the segments near P that are (almost) tied for the minimum
+    haversine distance; those are re-checked here and the first of them in the order a full
+    scan of the graph would visit them wins, so the chosen point is the same as a full scan.
+    The graph is not modified. Returns a dict describing the snapped position (edge, segment
+    index and t along the edge's stored direction, and the point), to be passed to
+    build_snap_overlay, or None if the graph has no edges or P is not a finite point.
+    """
+    if not (math.isfinite(P[0]) and math.isfinite(P[1])):
+        return None
+    index = graph.segment_index
+    candidates = spatial_index.nearest_segments(index, P)
+    metrics.count(snap_candidates=len(candidates))
+    if not candidates:
         return None
-    u, v, poly, i, t = best_edge_info
-    # Compute snapped point on the segment between poly[i] and poly[i+1].
-    A = poly[i]
-    B = poly[i+1]
-    A_lat = A["lat"] / 1e9
-    A_lon = A["lon"] / 1e9
-    B_lat = B["lat"] / 1e9
-    B_lon = B["lon"] / 1e9
-    snapped_lat = A_lat + t * (B_lat - A_lat)
-    snapped_lon = A_lon + t * (B_lon - A_lon)
-    snapped_lat_int = round(snapped_lat * 1e9)
-    snapped_lon_int = round(snapped_lon * 1e9)
-    new_id = max(nodes.keys()) + 1 if nodes else 1
-    new_node = {"id": new_id, "lat": snapped_lat_int, "lon": snapped_lon_int}
-    # Add new node to our nodes dictionary.
-    nodes[new_id] = (snapped_lat, snapped_lon)
-    # Split the original polyline into two segments.
-    new_vertex = {"id": new_id, "lat": snapped_lat_int, "lon": snapped_lon_int}
-    new_polyline1 = poly[:i+1] + [new_vertex]
-    new_polyline2 = [new_vertex] + poly[i+1:]
-    d1 = compute_polyline_distance(new_polyline1)
-    d2 = compute_polyline_distance(new_polyline2)
-    # Remove the original edge from both directions.
-    remove_edge_from_graph(graph, u, v, poly)
-    remove_edge_from_graph(graph, v, u, list(reversed(poly)))
-    # Add the two new edges (and their reverse counterparts).
-    add_edge_to_graph(graph, u, new_id, new_polyline1, d1)
-    add_edge_to_graph(graph, new_id, u, list(reversed(new_polyline1)), d1)
-    add_edge_to_graph(graph, new_id, v, new_polyline2, d2)
-    add_edge_to_graph(graph, v, new_id, list(reversed(new_polyline2)), d2)
-    return new_id
+    a_lat, a_lon = index["a_lat"][candidates], index["a_lon"][candidates]
+    b_lat, b_lon = index["b_lat"][candidates], index["b_lon"][candidates]
+    Q_lat, Q_lon, ts = geodesy.project_onto_segments(P[0], P[1], a_lat, a_lon, b_lat, b_lon)
+    # Segment ids follow the scan order, and argmin keeps the first of equal distances.
+    k = int(np.argmin(geodesy.haversine(P[0], P[1], Q_lat, Q_lon)))
+    seg_id, t = candidates[k], float(ts[k])
+    A = (float(a_lat[k]), float(a_lon[k]))
+    B = (float(b_lat[k]), float(b_lon[k]))
+    # Compute snapped point on the segment between A and B.
+    snapped_lat = A[0] + t * (B[0] - A[0])
+    snapped_lon = A[1] + t * (B[1] - A[1])
+    arc = int(graph.seg_arc[seg_id])
+    i = int(graph.seg_pos[seg_id])
+    edge = int(graph.arc_edge[arc])
+    if graph.arc_reverse[arc]:
+        # The segment was indexed walking the edge backwards.
+        i = int(graph.edge_geom_count[edge]) - 2 - i
+        t = 1 - t
+    return {"edge": edge, "index": i, "t": t, "lat": snapped_lat, "lon": snapped_lon}
+
+def build_snap_overlay(graph, snaps, closures=None, profile=route_cost.DEFAULT_PROFILE):
+    """
+    Builds a query-scoped overlay for a list of snapped positions (from snap_point).
+    Each snap becomes a virtual node (numbered from graph.node_count, in the order given) joined
+    by virtual arcs to the endpoints of the edge it lies on. Snaps on the same edge are chained
+    in order along it, so a route between them can stay on that edge.
+    The search prices arcs with the named cost profile (route_cost.PROFILES), and with a
+    closures.ClosureSet the closures in force apply to it too: unless both are the defaults, the
+    overlay carries the precomputed arc cost list to use (see search_lists), and the virtual
+    arcs are priced the same way.
+    The shared graph is never modified; pass the overlay to dijkstra together with it.
+    Returns (overlay, list_of_virtual_node_ids).
+    """
+    costs = closures.costs(graph, profile) if closures is not None else None
+    edge_extra = costs[0] if costs is not None else None
+    if costs is not None:
+        arc_cost = costs[1]
+    elif profile != route_cost.DEFAULT_PROFILE:
+        arc_cost = graph.profile_costs(profile)["arc_cost_list"]
+    else:
+        arc_cost = None
+    overlay = {"nodes": {}, "adjacency": {}, "arcs": {}, "profile": profile, "arc_cost": arc_cost}
+    virtual_ids = []
+    by_edge = {}
+    for k, snap in enumerate(snaps):
+        node = graph.node_count + k
+        virtual_ids.append(node)
+        overlay["nodes"][node] = (snap["lat"], snap["lon"])
+        by_edge.setdefault(snap["edge"], []).append((snap["index"], snap["t"], node, snap))
+    for edge, edge_snaps in by_edge.items():
+        edge_snaps.sort(key=lambda item: (item[0], item[1]))
+        prev_node, prev_index, prev_point = int(graph.edge_u[edge]), 0, None
+        for i, t, node, snap in edge_snaps:
+            # Snapped vertices are stored at the same 1e-9 degree precision as the OSM data.
+            point = (round(snap["lat"] * 1e9) / 1e9, round(snap["lon"] * 1e9) / 1e9)
+            _add_overlay_arcs(graph, overlay, edge, prev_node, node, prev_point, prev_index, i + 1, point, edge_extra)
+            prev_node, prev_index, prev_point = node, i + 1, point
+        _add_overlay_arcs(graph, overlay, edge, prev_node, int(graph.edge_v[edge]),
+                          prev_point, prev_index, int(graph.edge_geom_count[edge]), None, edge_extra)
+    return overlay, virtual_ids
+
+def _add_overlay_arcs(graph, overlay, edge, a, b, first_point, lo, hi, last_point, edge_extra=None):
+    """
+    Adds virtual arcs a <-> b to the overlay. Their geometry is vertices lo..hi-1 of the edge,
+    optionally preceded by first_point and followed by last_point (snapped points).
+    The piece is tagged for stairs like a graph edge, has the edge's grade, and is priced with
+    the overlay's cost profile,
+    plus the edge's closure extra (edge_extra, from ClosureSet.costs). base_cost is its price
+    with the graph's own costs, for the engines whose tables were made from those.
+    """
+    start = int(graph.edge_geom_start[edge])
+    parts = [graph.coords[start + lo:start + hi]]
+    ids = graph.coord_ids[start + lo:start + hi].tolist()
+    if first_point:
+        parts.insert(0, np.array([first_point]))
+        ids.insert(0, None)
+    if last_point:
+        parts.append(np.array([last_point]))
+        ids.append(None)
+    geometry = np.concatenate(parts)
+    distance = geometry_distance(geometry)
+    stairs = False
+    if graph.edge_stairs[edge]:
+        poly = [{"id": pt_id, "lat": round(lat * 1e9), "lon": round(lon * 1e9)}
+                for pt_id, (lat, lon) in zip(ids, geometry.tolist())]
+        stairs = route_cost.poly_touches_stairs(poly, route_cost.get_stair_index())
+    grade = graph.edge_grade[edge]
+    base_cost = distance + float(route_cost.edge_penalties(stairs, distance, grade))
+    cost = distance + float(route_cost.edge_penalties(stairs, distance, grade, overlay["profile"]))
+    if edge_extra is not None:
+        cost += float(edge_extra[edge])
+    forward = graph.arc_count + len(overlay["arcs"])
+    backward = forward + 1
+    overlay["arcs"][forward] = {"edge": edge, "geometry": geometry, "distance": distance, "stairs": stairs,
+                                "cost": cost, "base_cost": base_cost, "twin": backward}
+    overlay["arcs"][backward] = {"edge": edge, "geometry": geometry[::-1], "distance": distance, "stairs": stairs,
+                                 "cost": cost, "base_cost": base_cost, "twin": forward}
+    overlay["adjacency"].setdefault(a, []).append((forward, b, cost))
+    overlay["adjacency"].setdefault(b, []).append((backward, a, cost))
 
 def main():
-    # Load the graph (from formatted_data.json) and nodes (from formatted_data.json)
-    graph, graph_nodes = load_graph()
-    if not graph:
+    # Load the graph (from formatted_data.json)
+    graph = load_graph()
+    if graph.edge_count == 0:
         print("Graph is empty.")
         return
     # Load the full list of nodes from nodes.json (if needed for other purposes)
@@ -279,24 +919,23 @@ def main():
     origin = (40.914320, -73.121101)
     destination = (40.915454, -73.119767)
     # Snap the origin and destination onto the graph.
-    origin_node = snap_point(origin, graph, graph_nodes)
-    destination_node = snap_point(destination, graph, graph_nodes)
-    if origin_node is None or destination_node is None:
+    origin_snap = snap_point(origin, graph)
+    destination_snap = snap_point(destination, graph)
+    if origin_snap is None or destination_snap is None:
         print("Could not snap origin or destination to the graph.")
         return
+    overlay, (origin_node, destination_node) = build_snap_overlay(graph, [origin_snap, destination_snap])
     print(f"Using snapped origin node: {origin_node}")
     print(f"Using snapped destination node: {destination_node}")
     # Run Dijkstra's algorithm between the snapped nodes.
-    total_distance, path, edges_in_path = dijkstra(graph, origin_node, destination_node)
+    total_distance, path, edges_in_path = dijkstra(graph, origin_node, destination_node, overlay)
     if path is None:
         print("No path found.")
         return
     print(f"Total distance: {total_distance:.2f} meters")
-    full_polyline = combine_polylines(edges_in_path)
+    full_polyline = combine_polylines(graph, edges_in_path, overlay)
     print("Polyline for the best path (lat, lon):")
-    # Convert each vertex to degrees.
-    points = [{"lat": point["lat"] / 1e9, "lon": point["lon"] / 1e9} for point in full_polyline]
-    encoded = encode_polyline(points)
+    encoded = encode_coordinates(full_polyline)
     print(encoded)
     # Write the encoded polyline to best_path_polyline.json.
     with open("best_path_polyline.json", "w") as f:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import math
+import os
+import sys
+import numpy as np
+import geodesy
+
+# Local elevation model (DEM), so node elevations, edge grades and route slopes come from memory
+# instead of Google Elevation API requests.
+#
+# elevation.npz holds a regular grid of heights in meters ("heights", rows by columns) and its
+# georeference: "origin", the latitude and longitude of heights[0, 0], and "spacing", the degrees
+# between consecutive rows and between consecutive columns. It is made once, offline, with
+# build_dem (python elevation.py ...); without it every elevation is unknown and the campus is
+# treated as flat.
+DEM_PATH = "elevation.npz"
+
+# Locations per Google Elevation API request while building a DEM (the API's limit).
+ELEVATION_BATCH = 512
+
+# Default grid spacing of build_dem, in meters.
+DEM_SPACING = 10.0
+
+# Cached DEM so elevation.npz is only read once per process (False until loaded, None if missing).
+DEM_CACHE = False
+
+def load_dem(path=DEM_PATH):
+    """
+    Reads a DEM saved by build_dem. Returns a dict with the heights, origin and spacing arrays,
+    or None if there is no such file.
+    """
+    try:
+        with np.load(path) as data:
+            return {"heights": data["heights"].astype(np.float64), "origin": data["origin"].astype(np.float64),
+                    "spacing": data["spacing"].astype(np.float64)}
+    except FileNotFoundError:
+        return None
+
+def get_dem():
+    """
+    Returns the DEM of elevation.npz (or None), reading it on first use.
+    """
+    global DEM_CACHE
+    if DEM_CACHE is False:
+        DEM_CACHE = load_dem()
+    return DEM_CACHE
+
+def sample(dem, lat, lon):
+    """
+    Heights in meters at the points (lat, lon), by bilinear interpolation between the four
+    surrounding grid points. Broadcasts like geodesy.haversine.
+    Points outside the grid, and every point when dem is None, get NaN.
+    """
+    lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+    if dem is None:
+        return np.full(lat.shape, np.nan)
+    heights = dem["heights"]
+    rows, cols = heights.shape
+    row = (lat - dem["origin"][0]) / dem["spacing"][0]
+    col = (lon - dem["origin"][1]) / dem["spacing"][1]
+    inside = (row >= 0) & (row <= rows - 1) & (col >= 0) & (col <= cols - 1)
+    # The last row and column interpolate from the cell before them (with weight 1 on the edge).
+    i = np.clip(np.floor(np.nan_to_num(row)), 0, rows - 2).astype(np.int64)
+    j = np.clip(np.floor(np.nan_to_num(col)), 0, cols - 2).astype(np.int64)
+    di = np.clip(row - i, 0, 1)
+    dj = np.clip(col - j, 0, 1)
+    z = ((1 - di) * ((1 - dj) * heights[i, j] + dj * heights[i, j + 1]) +
+         di * ((1 - dj) * heights[i + 1, j] + dj * heights[i + 1, j + 1]))
+    return np.where(inside, z, np.nan)
+
+def edge_grades(coords, coord_elevation, edge_geom_start, edge_geom_count):
+    """
+    Steepest grade (rise over run, unsigned) between consecutive vertices of each edge, given
+    the shared coordinate buffer of a routing graph and the height of every vertex in it.
+    Segments with an unknown height or no length count as flat.
+    """
+    lengths = np.zeros(len(coords))
+    rises = np.zeros(len(coords))
+    if len(coords) > 1:
+        lengths[:-1] = geodesy.consecutive_haversine(coords[:, 0], coords[:, 1])
+        rises[:-1] = np.abs(np.diff(coord_elevation))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grades = np.where(lengths > 0, rises / lengths, 0.0)
+    grades = np.nan_to_num(grades, nan=0.0, posinf=0.0)
+    # Segment k joins vertices k and k + 1; the last vertex of an edge starts no segment of it.
+    grades[edge_geom_start + edge_geom_count - 1] = 0.0
+    return np.maximum.reduceat(grades, edge_geom_start) if len(edge_geom_start) else np.zeros(0)
+
+def build_dem(min_lat, min_lon, max_lat, max_lon, spacing=DEM_SPACING, path=DEM_PATH):
+    """
+    Samples heights on a grid over the box from the Google Elevation API, about spacing meters
+    apart, and saves them as a DEM. Run once offline; routing only ever reads the saved file.
+    """
+    from google_maps_util import gmaps  # Needs the Google Maps API key, which routing does not.
+    step_lat = spacing / geodesy.METERS_PER_DEGREE
+    step_lon = spacing / (geodesy.METERS_PER_DEGREE * math.cos(math.radians((min_lat + max_lat) / 2)))
+    rows = int(math.ceil((max_lat - min_lat) / step_lat)) + 1
+    cols = int(math.ceil((max_lon - min_lon) / step_lon)) + 1
+    lat, lon = np.meshgrid(min_lat + step_lat * np.arange(rows), min_lon + step_lon * np.arange(cols), indexing="ij")
+    locations = list(zip(lat.ravel().tolist(), lon.ravel().tolist()))
+    heights = []
+    for start in range(0, len(locations), ELEVATION_BATCH):
+        results = gmaps.elevation(locations[start:start + ELEVATION_BATCH])
+        heights.extend(result["elevation"] for result in results)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, heights=np.array(heights, dtype=np.float32).reshape(rows, cols),
+                 origin=np.array([min_lat, min_lon]), spacing=np.array([step_lat, step_lon]))
+    os.replace(tmp_path, path)
+    return rows, cols
+
+def main():
+    if len(sys.argv) not in (5, 6):
+        print("Usage: python elevation.py min_lat min_lon max_lat max_lon [spacing_meters]")
+        sys.exit(1)
+    box = [float(arg) for arg in sys.argv[1:5]]
+    spacing = float(sys.argv[5]) if len(sys.argv) == 6 else DEM_SPACING
+    rows, cols = build_dem(*box, spacing)
+    print(f"Saved a {rows} x {cols} elevation grid to {DEM_PATH}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,7 @@
 #!/usr/bin/env python3
 import json
-import math
-
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Compute the haversine distance (in meters) between two points.
-    """
-    R = 6371000  # Earth radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+import numpy as np
+import geodesy
 
 def main():
     # Load the original ways_output.json
@@ -35,6 +23,9 @@ def main():
         if len(junction_indices) < 2:
             continue
 
+        # Divide by 1e9 to convert the stored integer lat/lon to proper degrees.
+        lat = np.array([ref["lat"] for ref in way["refs"]], dtype=np.int64) / 1e9
+        lon = np.array([ref["lon"] for ref in way["refs"]], dtype=np.int64) / 1e9
         edges = []
         total_distance = 0.0
         # For each consecutive pair of junction indices, extract an edge.
@@ -45,14 +36,8 @@ def main():
             if end_idx <= start_idx:
                 continue
             sub_polyline = way["refs"][start_idx:end_idx + 1]
-            edge_distance = 0.0
             # Sum the distances between consecutive vertices along the sub-polyline.
-            for j in range(len(sub_polyline) - 1):
-                p1 = sub_polyline[j]
-                p2 = sub_polyline[j + 1]
-                # Divide by 1e9 to convert the stored integer lat/lon to proper degrees.
-                d = haversine(p1["lat"] / 1e9, p1["lon"] / 1e9, p2["lat"] / 1e9, p2["lon"] / 1e9)
-                edge_distance += d
+            edge_distance = geodesy.polyline_length(lat[start_idx:end_idx + 1], lon[start_idx:end_idx + 1])
             total_distance += edge_distance
             edges.append({
                 "start": sub_polyline[0],
@@ -0,0 +1,78 @@
+import numpy as np
+
+# Distance and projection math shared by the data build, the routing graph and the request
+# code. Every function takes coordinates in degrees, as Python floats or NumPy arrays, and
+# broadcasts like a NumPy ufunc, so a whole polyline or candidate list is handled in one call.
+
+R = 6371000  # Earth's radius in meters
+
+# Meters per degree of latitude (and of longitude at the equator).
+METERS_PER_DEGREE = R * np.pi / 180
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Haversine distance in meters between the points (lat1, lon1) and (lat2, lon2), element by
+    element; a single point on either side is compared against every point on the other.
+    """
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = np.radians(np.subtract(lat2, lat1))
+    dlambda = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def pairwise_haversine(lat1, lon1, lat2, lon2):
+    """
+    Haversine distances in meters between every point of the first set and every point of
+    the second, as a (len(lat1), len(lat2)) array.
+    """
+    lat1, lon1 = np.asarray(lat1, dtype=np.float64), np.asarray(lon1, dtype=np.float64)
+    return haversine(lat1[:, None], lon1[:, None], lat2, lon2)
+
+def consecutive_haversine(lat, lon):
+    """
+    Lengths in meters of the segments of a polyline, as an array one shorter than its vertices.
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    return haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+def polyline_length(lat, lon):
+    """
+    Total length in meters of a polyline.
+    """
+    if len(lat) < 2:
+        return 0.0
+    return float(consecutive_haversine(lat, lon).sum())
+
+def equirectangular(lat, lon, reference_lat):
+    """
+    Planar (x, y) position in meters, with longitudes scaled for reference_lat.
+    Distances come out exact along meridians and at reference_lat, and too short elsewhere
+    by the cosine ratio between the two latitudes.
+    """
+    x = np.multiply(lon, METERS_PER_DEGREE * np.cos(np.radians(reference_lat)))
+    y = np.multiply(lat, METERS_PER_DEGREE)
+    return x, y
+
+def project_onto_segments(lat, lon, a_lat, a_lon, b_lat, b_lon):
+    """
+    Projects the point (lat, lon) onto each segment A -> B, working in degrees with longitudes
+    scaled by cos(lat) (an equirectangular approximation around the point).
+    Returns (projected latitudes, projected longitudes, t) as arrays, t being the position
+    along each segment clamped to [0, 1]; a segment of zero length projects onto A with t = 0.
+    """
+    cos_lat = np.cos(np.radians(lat))
+    Px = lon * cos_lat
+    Py = lat
+    Ax = np.multiply(a_lon, cos_lat)
+    Ay = np.asarray(a_lat, dtype=np.float64)
+    dx = np.multiply(b_lon, cos_lat) - Ax
+    dy = b_lat - Ay
+    length_sq = dx * dx + dy * dy
+    degenerate = length_sq == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((Px - Ax) * dx + (Py - Ay) * dy) / length_sq
+    t = np.where(degenerate, 0.0, np.clip(t, 0, 1))
+    Q_lat = np.where(degenerate, a_lat, Ay + t * dy)
+    Q_lon = np.where(degenerate, a_lon, (Ax + t * dx) / cos_lat)
+    return Q_lat, Q_lon, t
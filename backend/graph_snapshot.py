@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import routing_graph
+
+# Binary snapshot of the routing graph, so server start-up can mmap it instead of reparsing
+# formatted_data.json.
+#
+# Layout: 8-byte magic, uint32 format version, uint32 header length, a JSON header
+# ({"source_hash": ..., "arrays": [{"name", "dtype", "shape", "offset"}, ...]}), then the raw
+# array data, each array starting on an ALIGNMENT-byte boundary.
+SNAPSHOT_PATH = "routing_graph.snapshot"
+SNAPSHOT_MAGIC = b"SBUGRAPH"
+SNAPSHOT_VERSION = 4
+ALIGNMENT = 64
+
+# Files the routing graph is built from; any change to them invalidates the snapshot.
+# The elevation model (see elevation.py) and the route model weights (the "model" cost
+# profile, see route_cost.MODEL_WEIGHTS_PATH) are optional.
+SOURCE_FILES = ("formatted_data.json", "stairs.json", "elevation.npz", "models/route_model_weights.json")
+
+_PREAMBLE = struct.Struct("<8sII")
+
+def source_hash(paths=SOURCE_FILES):
+    """
+    Returns a SHA-256 hex digest over the contents of the source files (a missing file counts
+    as empty).
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        except FileNotFoundError:
+            pass
+    return digest.hexdigest()
+
+def source_stamp(paths=SOURCE_FILES):
+    """
+    Returns the modification time and size of each source file (None for a missing file),
+    a cheap way to notice that they may have changed.
+    """
+    stamp = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+            stamp.append((info.st_mtime_ns, info.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def graph_fingerprint(graph, salt=""):
+    """
+    Returns a SHA-256 hex digest of a graph's topology and arc costs, for files derived from
+    them (salt tells the kinds of files apart).
+    """
+    digest = hashlib.sha256(salt.encode())
+    for array in (graph.offsets, graph.targets, graph.arc_cost):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def graph_arrays(graph):
+    """
+    Returns every array of a RoutingGraph by name; segment index arrays get an "index." prefix.
+    """
+    arrays = {name: getattr(graph, name) for name in graph.FIELDS}
+    for name, array in graph.segment_index.items():
+        arrays["index." + name] = array
+    return arrays
+
+def graph_from_arrays(arrays):
+    """
+    Inverse of graph_arrays.
+    """
+    index = {name[len("index."):]: array for name, array in arrays.items() if name.startswith("index.")}
+    return routing_graph.RoutingGraph(arrays, index)
+
+def pack_layout(arrays, source):
+    """
+    Works out where each array goes in a snapshot.
+    Returns (preamble_and_header bytes, list of (offset, array), total size in bytes).
+    """
+    def align(n):
+        return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    entries = []
+    # The header holds the offsets, so size it first with placeholder offsets of the final width.
+    for name, array in arrays.items():
+        entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": 0})
+    placeholder = json.dumps({"source_hash": source, "arrays": entries}).encode()
+    offset = align(_PREAMBLE.size + len(placeholder) + 16 * len(entries))
+    placed = []
+    for entry, array in zip(entries, arrays.values()):
+        entry["offset"] = offset
+        placed.append((offset, np.ascontiguousarray(array)))
+        offset = align(offset + array.nbytes)
+    header = json.dumps({"source_hash": source, "arrays": entries}).encode()
+    return _PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)) + header, placed, offset
+
+def unpack_arrays(buffer):
+    """
+    Reads a snapshot laid out by pack_layout from any buffer (bytes, mmap, shared memory).
+    Returns (source_hash, dict of read-only NumPy views into the buffer), or None if the
+    buffer is not a snapshot of the current format version.
+    """
+    if len(buffer) < _PREAMBLE.size:
+        return None
+    magic, version, header_len = _PREAMBLE.unpack_from(buffer, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_len]))
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+        array.flags.writeable = False
+        arrays[entry["name"]] = array
+    return header["source_hash"], arrays
+
+def write_arrays(arrays, source, path):
+    """
+    Writes named arrays to path in the snapshot format. The file is written next to it first and
+    then renamed over it, so a process that mmaps the old file keeps a consistent view.
+    """
+    prefix, placed, total = pack_layout(arrays, source)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(prefix)
+        for offset, array in placed:
+            f.seek(offset)
+            f.write(array.tobytes())
+        f.truncate(total)
+    os.replace(tmp_path, path)
+
+def read_arrays(path, expected_hash=None):
+    """
+    Maps a file written by write_arrays into memory and returns its arrays as read-only views.
+    Returns None if the file is missing, has another format version, or its source hash
+    differs from expected_hash.
+    """
+    try:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    unpacked = unpack_arrays(buffer)
+    if unpacked is None:
+        return None
+    source, arrays = unpacked
+    if expected_hash is not None and source != expected_hash:
+        return None
+    return arrays
+
+def write_snapshot(graph, source, path=SNAPSHOT_PATH):
+    """
+    Writes the graph to path (see write_arrays).
+    """
+    write_arrays(graph_arrays(graph), source, path)
+
+def read_snapshot(path=SNAPSHOT_PATH, expected_hash=None):
+    """
+    Maps a snapshot file into memory and returns the RoutingGraph backed by it, without parsing
+    any JSON data. Returns None if the file is missing, has another format version, or was
+    built from sources whose hash differs from expected_hash.
+    """
+    arrays = read_arrays(path, expected_hash)
+    if arrays is None:
+        return None
+    return graph_from_arrays(arrays)
+
+def main():
+    # Rebuild the snapshot from the source files.
+    import djikstra
+    source = source_hash()
+    graph = djikstra.build_graph()
+    write_snapshot(graph, source)
+    print(f"Wrote {SNAPSHOT_PATH} ({graph.node_count} nodes, {graph.edge_count} edges, source {source[:12]})")
+
+if __name__ == "__main__":
+    main()
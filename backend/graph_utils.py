@@ -1,15 +1,9 @@
-import math
-import googlemaps 
 import networkx as nx
-import pandas as pd
 import numpy as np
-import polyline
 import requests
 import folium
 from shapely.geometry import Polygon, LineString, Point
-from config import GOOGLE_MAPS_API_KEY
-
-gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
+import geodesy
 
 ###############################################################################
 # 1) CONFIGURATION
@@ -34,6 +28,7 @@ CAMPUS_POLYGON = Polygon([
     (40.925398, -73.117393)   # Closing the loop (must match the first point)
 ])
 
+
 ###############################################################################
 # 2) FETCH WALKWAYS FROM OPENSTREETMAP (OSM) USING OVERPASS API
 ###############################################################################
@@ -47,58 +42,61 @@ way["highway"="footway"]({CAMPUS_POLYGON.bounds[1]},{CAMPUS_POLYGON.bounds[0]},
 out geom;
 """
 
-# Request data from Overpass API
-response = requests.get(overpass_url, params={"data": query})
-
-if response.status_code == 200:
-    data = response.json()
-    all_walkways = []
-
-    # Process each way (walkway) found
-    for element in data["elements"]:
-        if "geometry" in element:
-            coords = [(point["lat"], point["lon"]) for point in element["geometry"]]
-            all_walkways.append(LineString(coords))
-
-    print(f"Fetched {len(all_walkways)} walkways from OpenStreetMap.")
-else:
-    print("Overpass API request failed.")
-    all_walkways = []
+def fetch_walkways():
+    """
+    Requests every footway in the campus bounding box from the Overpass API.
+    Returns them as a list of LineStrings of (lat, lon), empty if the request fails.
+    """
+    response = requests.get(overpass_url, params={"data": query})
+
+    if response.status_code == 200:
+        data = response.json()
+        all_walkways = []
+
+        # Process each way (walkway) found
+        for element in data["elements"]:
+            if "geometry" in element:
+                coords = [(point["lat"], point["lon"]) for point in element["geometry"]]
+                all_walkways.append(LineString(coords))
+
+        print(f"Fetched {len(all_walkways)} walkways from OpenStreetMap.")
+    else:
+        print("Overpass API request failed.")
+        all_walkways = []
+    return all_walkways
 
 ###############################################################################
 # 3) FILTER WALKWAYS INSIDE CAMPUS POLYGON
 ###############################################################################
-inside_walkways = []
-for walkway in all_walkways:
-    intersection = CAMPUS_POLYGON.intersection(walkway)
-    if not intersection.is_empty:
-        if intersection.geom_type == "LineString":
-            inside_walkways.append(intersection)
-        elif intersection.geom_type == "MultiLineString":
-            inside_walkways.extend(intersection.geoms)
-
-print(f"Found {len(inside_walkways)} walkway segment(s) inside the campus.")
+def filter_walkways(all_walkways):
+    """
+    Clips walkways to the campus polygon. Returns the pieces inside it as LineStrings.
+    """
+    inside_walkways = []
+    for walkway in all_walkways:
+        intersection = CAMPUS_POLYGON.intersection(walkway)
+        if not intersection.is_empty:
+            if intersection.geom_type == "LineString":
+                inside_walkways.append(intersection)
+            elif intersection.geom_type == "MultiLineString":
+                inside_walkways.extend(intersection.geoms)
+
+    print(f"Found {len(inside_walkways)} walkway segment(s) inside the campus.")
+    return inside_walkways
 
 ###############################################################################
 # 4) INTERPOLATE NODES ALONG WALKWAYS
 ###############################################################################
-def haversine(coord1, coord2):
-    R = 6371000  # Earth radius in meters
-    lat1, lon1 = math.radians(coord1[0]), math.radians(coord1[1])
-    lat2, lon2 = math.radians(coord2[0]), math.radians(coord2[1])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-    return 2 * R * math.asin(math.sqrt(a))
-
 def interpolate_points(points, spacing=2.0):
     if not points:
         return []
     
+    lat, lon = np.array(points).T
+    lengths = geodesy.consecutive_haversine(lat, lon).tolist()
     interpolated = [points[0]]
     for i in range(1, len(points)):
         start, end = points[i - 1], points[i]
-        dist = haversine(start, end)
+        dist = lengths[i - 1]
         if dist > spacing:
             num_steps = int(dist // spacing)
             for j in range(1, num_steps + 1):
@@ -110,66 +108,89 @@ def interpolate_points(points, spacing=2.0):
             interpolated.append(end)
     return interpolated
 
-# Collect interpolated walkway nodes
-walkway_nodes = []
-for segment in inside_walkways:
-    walkway_nodes.extend(interpolate_points(list(segment.coords), spacing=2.0))
+def walkway_nodes_along(inside_walkways):
+    """
+    Collects interpolated walkway nodes, about 2 meters apart, along every walkway.
+    """
+    walkway_nodes = []
+    for segment in inside_walkways:
+        walkway_nodes.extend(interpolate_points(list(segment.coords), spacing=2.0))
 
-print(f"Generated {len(walkway_nodes)} nodes along the walkway(s) inside campus.")
+    print(f"Generated {len(walkway_nodes)} nodes along the walkway(s) inside campus.")
+    return walkway_nodes
 
 ###############################################################################
 # 5) BUILD NETWORK GRAPH OF WALKWAYS
 ###############################################################################
-G = nx.Graph()
-
-for coord in walkway_nodes:
-    G.add_node(coord)
-
-# Connect nodes along each walkway
-for segment in inside_walkways:
-    segment_nodes = interpolate_points(list(segment.coords), spacing=2.0)
-    for i in range(len(segment_nodes) - 1):
-        c1, c2 = segment_nodes[i], segment_nodes[i + 1]
-        G.add_edge(c1, c2, weight=haversine(c1, c2))
-
-print(f"Graph constructed with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges.")
+def build_walkway_graph(inside_walkways, walkway_nodes):
+    """
+    Builds a networkx graph of the walkway nodes, consecutive nodes of a walkway joined by an
+    edge weighted with their distance in meters.
+    """
+    G = nx.Graph()
+
+    for coord in walkway_nodes:
+        G.add_node(coord)
+
+    # Connect nodes along each walkway
+    for segment in inside_walkways:
+        segment_nodes = interpolate_points(list(segment.coords), spacing=2.0)
+        lat, lon = np.array(segment_nodes).T
+        for c1, c2, weight in zip(segment_nodes, segment_nodes[1:], geodesy.consecutive_haversine(lat, lon).tolist()):
+            G.add_edge(c1, c2, weight=weight)
+
+    print(f"Graph constructed with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges.")
+    return G
 
 ###############################################################################
 # 6) VISUALIZE WALKWAYS WITH FOLIUM
 ###############################################################################
-# Center map at the campus centroid
-campus_center = CAMPUS_POLYGON.centroid
-m = folium.Map(location=[campus_center.y, campus_center.x], zoom_start=16)
-
-# Add campus boundary
-folium.Polygon(
-    locations=[(lat, lon) for lat, lon in CAMPUS_POLYGON.exterior.coords],
-    color='blue',
-    fill=True,
-    fill_opacity=0.1,
-    weight=2
-).add_to(m)
-
-# Add walkways as red polylines
-for segment in inside_walkways:
-    folium.PolyLine(
-        locations=[(lat, lon) for lat, lon in segment.coords],
-        color='red',
-        weight=3,
-        opacity=0.8
-    ).add_to(m)
-
-# Add nodes as small green circles
-for coord in walkway_nodes:
-    folium.CircleMarker(
-        location=coord,
-        radius=1,
-        color='green',
+def save_walkway_map(inside_walkways, walkway_nodes, path="sbu_walkways.html"):
+    """
+    Draws the campus boundary, the walkways and their nodes on a folium map saved to path.
+    """
+    # Center map at the campus centroid
+    campus_center = CAMPUS_POLYGON.centroid
+    m = folium.Map(location=[campus_center.y, campus_center.x], zoom_start=16)
+
+    # Add campus boundary
+    folium.Polygon(
+        locations=[(lat, lon) for lat, lon in CAMPUS_POLYGON.exterior.coords],
+        color='blue',
         fill=True,
-        fill_color='green',
-        fill_opacity=0.7
+        fill_opacity=0.1,
+        weight=2
     ).add_to(m)
 
-# Save the map
-m.save("sbu_walkways.html")
-print("Map saved as 'sbu_walkways.html'.")
+    # Add walkways as red polylines
+    for segment in inside_walkways:
+        folium.PolyLine(
+            locations=[(lat, lon) for lat, lon in segment.coords],
+            color='red',
+            weight=3,
+            opacity=0.8
+        ).add_to(m)
+
+    # Add nodes as small green circles
+    for coord in walkway_nodes:
+        folium.CircleMarker(
+            location=coord,
+            radius=1,
+            color='green',
+            fill=True,
+            fill_color='green',
+            fill_opacity=0.7
+        ).add_to(m)
+
+    # Save the map
+    m.save(path)
+    print(f"Map saved as '{path}'.")
+
+def main():
+    inside_walkways = filter_walkways(fetch_walkways())
+    walkway_nodes = walkway_nodes_along(inside_walkways)
+    build_walkway_graph(inside_walkways, walkway_nodes)
+    save_walkway_map(inside_walkways, walkway_nodes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import numpy as np
+import shapely
+import geodesy
+import metrics
+from djikstra import load_graph, snap_point, build_snap_overlay, search_lists, dijkstra_within, encode_coordinates
+from directions import RoutingError
+from route_cost import DEFAULT_PROFILE
+from graph_utils import CAMPUS_POLYGON
+
+# The reachable-area computation behind /api/isochrone, kept free of web framework code like
+# directions.py.
+
+# Walking speed in meters per minute, to turn a time budget into a cost budget.
+WALKING_SPEED = 80.0
+
+# Concave hull tightness (shapely.concave_hull ratio): 0 follows the reached walkways closely,
+# 1 gives the convex hull.
+HULL_RATIO = 0.3
+
+def find_isochrone(origin_coords, budget, profile=DEFAULT_PROFILE, closures=None):
+    """
+    Snaps origin onto the routing graph and finds everything reachable from it for at most
+    budget, a cost in meters under the named cost profile (walking length plus the profile's
+    penalties), avoiding the closures in force in the optional closures.ClosureSet.
+    Returns the reachable walkways inside the campus (see clip_pieces) as a list of (lat, lon)
+    arrays, edges reached part of the way being cut where the budget runs out.
+    Raises RoutingError if the graph cannot be loaded or the point cannot be snapped.
+    The query is counted in metrics.REGISTRY.
+    """
+    with metrics.query("isochrone", profile=profile, budget=budget):
+        try:
+            with metrics.stage("load_graph"):
+                graph = load_graph()
+        except Exception as e:
+            raise RoutingError(500, "Failed to load routing data") from e
+        with metrics.stage("snap_point"):
+            origin_snapped = snap_point(origin_coords, graph)
+        if origin_snapped is None:
+            raise RoutingError(404, "Could not snap provided coordinates onto the routing graph.")
+        with metrics.stage("build_snap_overlay"):
+            overlay, (origin_node,) = build_snap_overlay(graph, [origin_snapped], closures, profile)
+        with metrics.stage("search"):
+            settled = dijkstra_within(graph, origin_node, budget, overlay)
+        with metrics.stage("reachable_pieces"):
+            return clip_pieces(reachable_pieces(graph, settled, budget, overlay))
+
+def reachable_pieces(graph, settled, budget, overlay=None):
+    """
+    Turns the nodes settled within budget (from djikstra.dijkstra_within) into walkway geometry.
+    Each arc leaving a settled node is walked as far as the rest of the budget allows, its cost
+    (penalties included) spread evenly along it. A walkway reached from both ends is whole if
+    the two stretches meet, and two pieces otherwise.
+    Returns a list of (lat, lon) arrays in degrees.
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    # Per walkway (graph edge or pair of virtual arcs), the fraction of it reached from its
+    # start and from its end, in the direction its geometry is stored.
+    reached = {}
+
+    def walk(key, reverse, cost, left):
+        if not cost < float('inf'):
+            return
+        fraction = 1.0 if cost <= left else left / cost
+        ends = reached.setdefault(key, [0.0, 0.0])
+        ends[reverse] = max(ends[reverse], fraction)
+
+    for node, node_dist in settled.items():
+        left = budget - node_dist
+        if node < node_count:
+            for arc in range(offsets[node], offsets[node + 1]):
+                walk(("edge", int(graph.arc_edge[arc])), int(graph.arc_reverse[arc]), arc_cost[arc], left)
+        for arc, neighbor, weight in (overlay["adjacency"].get(node, ()) if overlay else ()):
+            twin = overlay["arcs"][arc]["twin"]
+            # Each pair of virtual arcs is stored as its lower-numbered (forward) arc.
+            walk(("virtual", min(arc, twin)), int(arc > twin), weight, left)
+
+    pieces = []
+    for (kind, ident), (forward, backward) in reached.items():
+        if kind == "edge":
+            start = int(graph.edge_geom_start[ident])
+            geometry = graph.coords[start:start + int(graph.edge_geom_count[ident])]
+        else:
+            geometry = overlay["arcs"][ident]["geometry"]
+        if forward + backward >= 1.0:
+            pieces.append(geometry)
+            continue
+        if forward > 0:
+            pieces.append(cut_polyline(geometry, forward))
+        if backward > 0:
+            pieces.append(cut_polyline(geometry[::-1], backward))
+    return pieces
+
+def cut_polyline(polyline, fraction):
+    """
+    Returns the first fraction (by length) of a polyline of (lat, lon) rows in degrees.
+    """
+    lengths = geodesy.consecutive_haversine(polyline[:, 0], polyline[:, 1])
+    walked = np.concatenate([[0.0], np.cumsum(lengths)])
+    target = fraction * walked[-1]
+    end = int(np.searchsorted(walked, target, side="right"))
+    if end >= len(polyline):
+        return polyline
+    t = (target - walked[end - 1]) / lengths[end - 1] if lengths[end - 1] > 0 else 0.0
+    point = polyline[end - 1] + t * (polyline[end] - polyline[end - 1])
+    return np.concatenate([polyline[:end], point[None, :]])
+
+def clip_pieces(pieces, area=CAMPUS_POLYGON):
+    """
+    Clips reachable walkways to area, a polygon of (lat, lon) vertices (by default the campus the
+    graph was fetched for). A few ways in the source data have vertices far outside it (scaled
+    wrongly), which would otherwise stretch the outline of the area across the globe.
+    Returns the parts inside as a list of (lat, lon) arrays.
+    """
+    if not pieces:
+        return pieces
+    points = np.concatenate(pieces)
+    inside = shapely.contains_xy(area, points[:, 0], points[:, 1])
+    if inside.all():
+        return pieces
+    clipped = []
+    start = 0
+    for piece in pieces:
+        piece_inside = inside[start:start + len(piece)]
+        start += len(piece)
+        if piece_inside.all():
+            clipped.append(piece)
+        elif len(piece) > 1:
+            for part in shapely.get_parts(shapely.intersection(shapely.LineString(piece), area)):
+                if isinstance(part, shapely.LineString) and not part.is_empty:
+                    clipped.append(shapely.get_coordinates(part))
+    return clipped
+
+def encode_pieces(pieces, precision=5):
+    """
+    Encodes reachable walkways as a list of encoded polylines (a multi-polyline).
+    """
+    return [encode_coordinates(piece, precision) for piece in pieces if len(piece) > 1]
+
+def hull_polygon(pieces, ratio=HULL_RATIO):
+    """
+    Returns the outline of the reachable area: the concave hull of every vertex of the reachable
+    walkways, as an array of (lat, lon) rows (closed ring), or an empty array if nothing but the
+    origin is reachable.
+    """
+    if not pieces:
+        return np.empty((0, 2))
+    hull = shapely.concave_hull(shapely.MultiPoint(np.concatenate(pieces)), ratio=ratio)
+    if not isinstance(hull, shapely.Polygon) or hull.is_empty:
+        return np.empty((0, 2))
+    return np.asarray(hull.exterior.coords)
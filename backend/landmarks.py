@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import heapq
+import weakref
+import numpy as np
+import graph_snapshot
+
+# Landmark (ALT) lower bounds for the "alt" search engine in djikstra.py.
+#
+# For a landmark L and any nodes v, t, the triangle inequality gives
+#   d(v, t) >= d(L, t) - d(L, v)   and   d(v, t) >= d(v, L) - d(t, L),
+# with d the real arc costs, stair penalties included. Distances from and to a few landmarks
+# on the edge of campus are precomputed, and the best of these bounds steers the search.
+LANDMARKS_PATH = "landmarks.snapshot"
+LANDMARKS_VERSION = 1
+LANDMARK_COUNT = 12
+
+# Global cache: graph -> landmark tables, for every graph still in use.
+LANDMARKS_CACHE = weakref.WeakKeyDictionary()
+
+def landmarks_fingerprint(graph):
+    """
+    Identifies the graph a landmarks file was built for.
+    """
+    return graph_snapshot.graph_fingerprint(graph, f"landmarks-{LANDMARKS_VERSION}-{LANDMARK_COUNT}")
+
+def select_landmarks(graph, count=LANDMARK_COUNT):
+    """
+    Picks landmarks spread around the largest connected part of the graph: first the node
+    farthest from its center, then repeatedly the node farthest (in the plane) from every
+    landmark picked so far.
+    """
+    from_first = shortest_distances(graph, int(np.argmax(np.bincount(_components(graph)))), reverse=False)
+    candidates = np.flatnonzero(np.isfinite(from_first))
+    x, y = graph.node_x[candidates], graph.node_y[candidates]
+    chosen = [int(np.argmax(np.hypot(x - x.mean(), y - y.mean())))]
+    nearest = np.hypot(x - x[chosen[0]], y - y[chosen[0]])
+    while len(chosen) < min(count, len(candidates)):
+        chosen.append(int(np.argmax(nearest)))
+        np.minimum(nearest, np.hypot(x - x[chosen[-1]], y - y[chosen[-1]]), out=nearest)
+    return candidates[chosen].astype(np.int32)
+
+def _components(graph):
+    """
+    Labels each node with the first node of its connected component.
+    """
+    label = np.full(graph.node_count, -1, dtype=np.int64)
+    offsets, targets = graph.offsets.tolist(), graph.targets.tolist()
+    for root in range(graph.node_count):
+        if label[root] >= 0:
+            continue
+        label[root] = root
+        stack = [root]
+        while stack:
+            u = stack.pop()
+            for arc in range(offsets[u], offsets[u + 1]):
+                if label[targets[arc]] < 0:
+                    label[targets[arc]] = root
+                    stack.append(targets[arc])
+    return label
+
+def shortest_distances(graph, source, reverse=False):
+    """
+    Returns the cost from source to every node (or from every node to source if reverse),
+    as a float64 array with inf for nodes out of reach.
+    """
+    offsets, targets, arc_cost, arc_twin = graph.search_lists()
+    dist = [float('inf')] * graph.node_count
+    dist[source] = 0.0
+    queue = [(0.0, source)]
+    while queue:
+        current_dist, current = heapq.heappop(queue)
+        if current_dist > dist[current]:
+            continue
+        for arc in range(offsets[current], offsets[current + 1]):
+            neighbor = targets[arc]
+            alt = current_dist + arc_cost[arc_twin[arc] if reverse else arc]
+            if alt < dist[neighbor]:
+                dist[neighbor] = alt
+                heapq.heappush(queue, (alt, neighbor))
+    return np.array(dist)
+
+def build_landmarks(graph, count=LANDMARK_COUNT):
+    """
+    Computes the landmark distance tables.
+    Returns a dict of arrays:
+      landmarks: the landmark nodes.
+      from_landmark, to_landmark: (landmarks, nodes) float32 tables of d(L, v) and d(v, L).
+      margin: how far float32 rounding may have moved any bound, subtracted from every bound.
+    """
+    landmarks = select_landmarks(graph, count)
+    from_landmark = np.array([shortest_distances(graph, int(L)) for L in landmarks])
+    to_landmark = np.array([shortest_distances(graph, int(L), reverse=True) for L in landmarks])
+    largest = max(np.max(t[np.isfinite(t)], initial=0.0) for t in (from_landmark, to_landmark))
+    # Each bound is a difference of two rounded values; a relative float64 slack covers the
+    # different summation order of costs along a route.
+    margin = 2 * largest * np.finfo(np.float32).eps + 1e-9 * largest
+    return {
+        "landmarks": landmarks,
+        "from_landmark": from_landmark.astype(np.float32),
+        "to_landmark": to_landmark.astype(np.float32),
+        "margin": np.array([margin]),
+    }
+
+def load_landmarks(graph):
+    """
+    Returns the landmark tables of graph, read from LANDMARKS_PATH when that was built for the
+    same topology and costs, and built (and saved) otherwise.
+    """
+    if graph in LANDMARKS_CACHE:
+        return LANDMARKS_CACHE[graph]
+    fingerprint = landmarks_fingerprint(graph)
+    tables = graph_snapshot.read_arrays(LANDMARKS_PATH, expected_hash=fingerprint)
+    if tables is None:
+        tables = build_landmarks(graph)
+        try:
+            graph_snapshot.write_arrays(tables, fingerprint, LANDMARKS_PATH)
+        except OSError as e:
+            print("Could not write landmarks:", e)
+    LANDMARKS_CACHE[graph] = tables
+    return tables
+
+def lower_bounds(tables, from_goal, to_goal, from_nodes, to_nodes):
+    """
+    Best landmark lower bounds on d(v, goal) for the nodes whose table columns are
+    from_nodes/to_nodes ((landmarks, n) arrays), given goal's columns from_goal/to_goal.
+    A landmark that reaches a node but not goal (or the other way round) proves goal out of
+    reach, which gives an infinite bound; a landmark that knows neither end gives none.
+    """
+    with np.errstate(invalid="ignore"):
+        forward = from_goal[:, None] - from_nodes
+        backward = to_nodes - to_goal[:, None]
+    bound = np.fmax(np.nan_to_num(forward, nan=0.0, posinf=np.inf, neginf=0.0),
+                    np.nan_to_num(backward, nan=0.0, posinf=np.inf, neginf=0.0)).max(axis=0, initial=0.0)
+    return np.maximum(bound - tables["margin"][0], 0.0)
+
+def main():
+    # Rebuild the landmark tables for the current routing graph.
+    import djikstra
+    graph = djikstra.load_graph()
+    tables = build_landmarks(graph)
+    graph_snapshot.write_arrays(tables, landmarks_fingerprint(graph), LANDMARKS_PATH)
+    size = tables["from_landmark"].nbytes + tables["to_landmark"].nbytes
+    print(f"Wrote {LANDMARKS_PATH} ({len(tables['landmarks'])} landmarks, {size} bytes of tables)")
+
+if __name__ == "__main__":
+    main()
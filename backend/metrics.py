@@ -0,0 +1,208 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+# Query instrumentation: per-query search counters (heap pushes and pops, nodes settled, edges
+# relaxed, snap candidates checked) and per-stage latencies, kept as totals and histograms for
+# the /metrics endpoint (Prometheus text format), plus a sampled debug log of single queries.
+#
+# The search loops count with local variables and report once per search (count), so the
+# instrumentation costs a few integer additions per settled node. Worker processes hand what
+# they counted back with each result (Metrics.drain and Metrics.merge).
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Counters a query accumulates; count() takes any of them as keyword arguments.
+SEARCH_COUNTERS = ("heap_pushes", "heap_pops", "nodes_settled", "edges_relaxed", "snap_candidates")
+
+# Fraction of queries written to the debug log (0 turns it off), and the file it goes to
+# (standard error when empty).
+DEBUG_SAMPLE_RATE = float(os.environ.get("METRICS_DEBUG_SAMPLE", "0"))
+DEBUG_LOG_PATH = os.environ.get("METRICS_DEBUG_LOG", "")
+
+# Prometheus type and help text of every metric.
+METRIC_HELP = {
+    "routing_queries_total": ("counter", "Routing queries answered, by kind."),
+    "routing_query_seconds": ("histogram", "Latency of whole routing queries, by kind."),
+    "routing_stage_seconds": ("histogram", "Latency of each stage of a routing query."),
+    "routing_heap_pushes_total": ("counter", "Priority queue pushes of the route searches, by query kind."),
+    "routing_heap_pops_total": ("counter", "Priority queue pops of the route searches, by query kind."),
+    "routing_nodes_settled_total": ("counter", "Nodes settled by the route searches, by query kind."),
+    "routing_edges_relaxed_total": ("counter", "Arcs relaxed by the route searches, by query kind."),
+    "routing_snap_candidates_total": ("counter", "Segments checked while snapping points, by query kind."),
+}
+
+logger = logging.getLogger("routing.queries")
+
+# The record of the query running in this thread (see query), or None.
+CURRENT_QUERY = contextvars.ContextVar("current_query", default=None)
+
+class Metrics:
+    """
+    Counters and histograms by metric name and labels, rendered in the Prometheus text format.
+    Safe to use from the server's worker threads.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count above the last, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = next((k for k, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    def drain(self):
+        """
+        Returns everything recorded so far as a plain (picklable) snapshot and starts over.
+        """
+        with self._lock:
+            snapshot = (self._counters, self._histograms)
+            self._counters, self._histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Adds a snapshot from drain, e.g. one taken in a worker process, to these metrics.
+        """
+        counters, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = list(values)
+                else:
+                    for k, value in enumerate(values):
+                        histogram[k] += value
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            series = sorted((key[1], value) for key, value in (counters if kind == "counter" else histograms).items()
+                            if key[0] == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind == "counter":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]!r}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+# The metrics of this process.
+REGISTRY = Metrics()
+
+def count(**counts):
+    """
+    Adds search counters (names from SEARCH_COUNTERS) to the query running in this thread, or
+    straight to the totals when there is none. Called once per search, not per step.
+    """
+    record = CURRENT_QUERY.get()
+    if record is not None:
+        totals = record["counts"]
+        for name, value in counts.items():
+            totals[name] += value
+        return
+    for name, value in counts.items():
+        REGISTRY.inc(f"routing_{name}_total", value, kind="other")
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage of a query (with-block) into the routing_stage_seconds histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        REGISTRY.observe("routing_stage_seconds", elapsed, stage=name)
+        record = CURRENT_QUERY.get()
+        if record is not None:
+            record["stages"][name] = record["stages"].get(name, 0.0) + elapsed
+
+@contextlib.contextmanager
+def query(kind, **details):
+    """
+    Runs a query (with-block) of the given kind: the searches and stages inside it are counted
+    towards it, and when it ends its counters go into the totals, its latency into
+    routing_query_seconds, and, for a sampled share of queries, the whole record (details
+    included) into the debug log. Yields the record, a dict.
+    """
+    record = {"kind": kind, **details, "counts": dict.fromkeys(SEARCH_COUNTERS, 0), "stages": {}}
+    token = CURRENT_QUERY.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - start
+        CURRENT_QUERY.reset(token)
+        REGISTRY.inc("routing_queries_total", kind=kind)
+        REGISTRY.observe("routing_query_seconds", elapsed, kind=kind)
+        for name, value in record["counts"].items():
+            if value:
+                REGISTRY.inc(f"routing_{name}_total", value, kind=kind)
+        if DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE:
+            record["seconds"] = elapsed
+            logger.debug(json.dumps(record, default=str))
+
+def configure_debug_log(sample_rate=DEBUG_SAMPLE_RATE, path=DEBUG_LOG_PATH):
+    """
+    Logs a sample_rate share of queries, one JSON record per line, to the file at path
+    (standard error if empty). A rate of 0 turns the debug log off.
+    """
+    global DEBUG_SAMPLE_RATE
+    DEBUG_SAMPLE_RATE = sample_rate
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    if sample_rate <= 0:
+        return
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+configure_debug_log()
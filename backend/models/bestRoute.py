@@ -1,24 +1,40 @@
 import numpy as np
 import joblib
-from costModel import extract_features
+from costModel import extract_features, route_feature_matrix
 
 # Load the trained linear regression model.
 model = joblib.load("trained_route_model.joblib")
 
+def score_routes(features):
+    """
+    Predicts the cost of every route from a feature matrix (one [distance, avg_slope, stairs]
+    row per route) with a single model call.
+    """
+    features = np.asarray(features, dtype=np.float64).reshape(-1, 3)
+    if len(features) == 0:
+        return np.zeros(0)
+    return model.predict(features)
+
 def select_best_route(candidate_routes):
     """
     Given a list of candidate route dictionaries,
-    extract the features for each route, predict its cost using
+    extract the features for each route, predict the costs of all of them at once using
     the trained model, and return the route with the lowest predicted cost.
     """
-    predictions = []
-    for route in candidate_routes:
-        features = extract_features(route)
-        predicted_cost = model.predict(np.array(features).reshape(1, -1))[0]
-        predictions.append(predicted_cost)
+    predictions = score_routes([extract_features(route) for route in candidate_routes])
     best_index = np.argmin(predictions)
     return candidate_routes[best_index]
 
+def select_best_path(graph, paths, overlay=None):
+    """
+    Given candidate paths on the routing graph as (cost, nodes, arcs) tuples, such as the
+    alternatives of topK_dijkstra.k_shortest_paths on a snap overlay, score them all at once
+    from the graph's per-arc feature table (costModel.arc_feature_table) and return the index
+    of the path with the lowest predicted cost.
+    """
+    predictions = score_routes(route_feature_matrix(graph, [arcs for cost, nodes, arcs in paths], overlay))
+    return int(np.argmin(predictions))
+
 if __name__ == "__main__":
     # Example candidate routes.
     candidate_routes = [
@@ -1,59 +1,34 @@
-import requests
+import weakref
 import numpy as np
-import math
-from route_cost import compute_manual_cost
-from config import GOOGLE_MAPS_API_KEY
-# You might read this key from an environment variable or config file
-GOOGLE_MAPS_ELEVATION_URL = "https://maps.googleapis.com/maps/api/elevation/json"
+import elevation
+import geodesy
 
-def haversine_distance(coord1, coord2):
-    """Calculate distance in meters between two (lat, lng) points."""
-    lat1, lon1 = coord1
-    lat2, lon2 = coord2
-    R = 6371000  # Earth radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    a = math.sin(delta_phi / 2)**2 + \
-        math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+# Per-arc feature tables of routing graphs (see arc_feature_table), made once per graph.
+FEATURE_TABLE_CACHE = weakref.WeakKeyDictionary()
 
 def get_elevation_for_path(path):
     """
     Given a path as a list of (lat, lng) tuples,
-    call the Google Elevation API to get elevations.
+    look up the elevation of every point in the local elevation model (see elevation.py).
+    Returns an array of heights in meters, NaN where unknown.
     """
-    locations = "|".join([f"{lat},{lng}" for lat, lng in path])
-    params = {
-        "locations": locations,
-        "key": GOOGLE_MAPS_API_KEY
-    }
-    response = requests.get(GOOGLE_MAPS_ELEVATION_URL, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if data["status"] == "OK":
-            elevations = [result["elevation"] for result in data["results"]]
-            return elevations
-        else:
-            raise Exception(f"Elevation API returned error: {data['status']}")
-    else:
-        raise Exception("Failed to fetch elevation data.")
+    lat, lon = np.array(path, dtype=np.float64).reshape(-1, 2).T
+    return elevation.sample(elevation.get_dem(), lat, lon)
 
 def compute_slope(elevations, path):
     """
     Compute the average slope (rise over run) along the path.
+    Segments with an unknown elevation at either end are left out.
     """
     if len(elevations) < 2:
         return 0
-    slopes = []
-    for i in range(len(elevations) - 1):
-        elev_diff = elevations[i+1] - elevations[i]
-        distance = haversine_distance(path[i], path[i+1])
-        if distance > 0:
-            slopes.append(elev_diff / distance)
-    return np.mean(slopes) if slopes else 0
+    lat, lon = np.array(path, dtype=np.float64).T
+    distances = geodesy.consecutive_haversine(lat, lon)
+    rises = np.diff(elevations)
+    moving = (distances > 0) & np.isfinite(rises)
+    if not moving.any():
+        return 0
+    return np.mean(rises[moving] / distances[moving])
 
 def extract_features(route):
     """
@@ -67,14 +42,71 @@ def extract_features(route):
     distance = route.get("distance", 0)
     path = route.get("path", [])
     stairs = route.get("stairs", 0)
-    try:
-        elevations = get_elevation_for_path(path)
-        avg_slope = compute_slope(elevations, path)
-    except Exception as e:
-        print("Error computing slope:", e)
-        avg_slope = 0
+    avg_slope = compute_slope(get_elevation_for_path(path), path)
     return [distance, avg_slope, stairs]
 
+def arc_feature_table(graph):
+    """
+    Returns the per-arc sums the route features are made of, as an (arc_count, 4) array with
+    columns: length in meters, sum of the segment slopes (rise over run, in travel direction),
+    number of segments with a length and a known slope, and 1 for a staircase arc.
+    Every column adds up along a route, so a route's features take one sum over its arcs
+    (see route_feature_matrix). Made once per routing graph.
+    """
+    table = FEATURE_TABLE_CACHE.get(graph)
+    if table is not None:
+        return table
+    coords, heights = graph.coords, graph.coord_elevation
+    lengths = np.zeros(len(coords))
+    rises = np.zeros(len(coords))
+    if len(coords) > 1:
+        lengths[:-1] = geodesy.consecutive_haversine(coords[:, 0], coords[:, 1])
+        rises[:-1] = np.diff(heights)
+    # Segment k joins vertices k and k + 1; the last vertex of an edge starts no segment of it.
+    last = graph.edge_geom_start + graph.edge_geom_count - 1
+    lengths[last] = 0.0
+    moving = (lengths > 0) & np.isfinite(rises)
+    slopes = np.zeros(len(coords))
+    slopes[moving] = rises[moving] / lengths[moving]
+    edge_slope = np.add.reduceat(slopes, graph.edge_geom_start)
+    edge_moving = np.add.reduceat(moving.astype(np.float64), graph.edge_geom_start)
+    edge = graph.arc_edge
+    table = np.column_stack([graph.edge_distance[edge],
+                             np.where(graph.arc_reverse, -edge_slope[edge], edge_slope[edge]),
+                             edge_moving[edge],
+                             graph.edge_stairs[edge].astype(np.float64)])
+    FEATURE_TABLE_CACHE[graph] = table
+    return table
+
+def route_feature_matrix(graph, routes, overlay=None):
+    """
+    Feature rows [distance, average slope, stairs count] (as extract_features) for routes given
+    as lists of arc ids on the routing graph, e.g. the paths of topK_dijkstra.k_shortest_paths,
+    with overlay the snap overlay they were found on. Slopes leave out segments of unknown
+    height; stairs counts the staircase arcs.
+    Returns a (len(routes), 3) array.
+    """
+    table = arc_feature_table(graph)
+    sums = np.zeros((len(routes), table.shape[1]))
+    for k, arcs in enumerate(routes):
+        arcs = np.asarray(arcs, dtype=np.int64)
+        sums[k] = table[arcs[arcs < graph.arc_count]].sum(axis=0)
+        for arc in arcs[arcs >= graph.arc_count].tolist():
+            sums[k] += _virtual_arc_features(overlay["arcs"][arc])
+    slope = np.divide(sums[:, 1], sums[:, 2], out=np.zeros(len(routes)), where=sums[:, 2] > 0)
+    return np.column_stack([sums[:, 0], slope, sums[:, 3]])
+
+def _virtual_arc_features(arc):
+    """
+    The arc_feature_table row of a virtual arc of a snap overlay.
+    """
+    geometry = arc["geometry"]
+    lengths = geodesy.consecutive_haversine(geometry[:, 0], geometry[:, 1])
+    rises = np.diff(elevation.sample(elevation.get_dem(), geometry[:, 0], geometry[:, 1]))
+    moving = (lengths > 0) & np.isfinite(rises)
+    return np.array([arc["distance"], float((rises[moving] / lengths[moving]).sum()),
+                     float(moving.sum()), float(arc["stairs"])])
+
 if __name__ == "__main__":
     # Sample test route
     sample_route = {
@@ -83,6 +115,4 @@ if __name__ == "__main__":
         "stairs": 1
     }
     features = extract_features(sample_route)
-    print("Extracted features:", features)
-    cost = compute_manual_cost(features)
-    print("Computed manual cost:", cost)
\ No newline at end of file
+    print("Extracted features:", features)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import json
+import os
+import numpy as np
+
+# Plain weights of the trained route model, which the routing server turns into its "model"
+# cost profile (route_cost.install_model_profile). Kept apart from costModel.py, which needs
+# the routing modules, so that trainLinearModel.py runs on its own.
+
+# Where the weights go: next to this file, which is where route_cost.MODEL_WEIGHTS_PATH
+# looks for them from the server's directory.
+MODEL_WEIGHTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "route_model_weights.json")
+
+def fold_linear_model(pipeline):
+    """
+    Folds a fitted StandardScaler + LinearRegression pipeline (as trainLinearModel.py makes) on
+    [distance, avg_slope, stairs] into plain weights, so that the predicted cost of a route is
+    intercept + per_meter * distance + per_slope * avg_slope + per_staircase * stairs.
+    Distance and stairs add up over the edges of a route, so those two weights price every edge.
+    Raises ValueError if they would make an edge cost nothing or less, which no search can use.
+    """
+    scaler, regression = pipeline.steps[0][1], pipeline.steps[-1][1]
+    mean = scaler.mean_ if getattr(scaler, "mean_", None) is not None else np.zeros(3)
+    scale = scaler.scale_ if getattr(scaler, "scale_", None) is not None else np.ones(3)
+    weights = np.ravel(regression.coef_) / scale
+    intercept = float(np.ravel(regression.intercept_)[0] - (weights * mean).sum())
+    per_meter, per_slope, per_staircase = (float(w) for w in weights)
+    if not per_meter > 0 or per_staircase < 0:
+        raise ValueError(f"The model prices a meter at {per_meter} and a staircase at {per_staircase}; "
+                         "routing needs a positive price per meter and no discount for stairs.")
+    return {"intercept": intercept, "per_meter": per_meter, "per_slope": per_slope, "per_staircase": per_staircase}
+
+def save_model_weights(weights, path=MODEL_WEIGHTS_PATH):
+    """
+    Writes the weights of fold_linear_model for the routing server, replacing the file atomically.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(weights, f, indent=2)
+    os.replace(tmp_path, path)
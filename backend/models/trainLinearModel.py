@@ -4,6 +4,7 @@ from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LinearRegression
 import joblib
+from modelWeights import fold_linear_model, save_model_weights
 
 # Example training data:
 # Features: [distance, avg_slope, stairs]
@@ -22,4 +23,8 @@ pipeline.fit(X_train, y_train)
 
 # Save the trained pipeline model to disk.
 joblib.dump(pipeline, "trained_route_model.joblib")
-print("Pipeline Linear Regression model trained and saved.")
\ No newline at end of file
+print("Pipeline Linear Regression model trained and saved.")
+
+# Fold it into the edge weights the routing server searches with (its "model" cost profile).
+save_model_weights(fold_linear_model(pipeline))
+print("Route model weights saved.")
\ No newline at end of file
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Default size and lifetime of the route cache used by /api/directions.
+ROUTE_CACHE_SIZE = 1024
+ROUTE_CACHE_TTL = 3600  # seconds
+
+# Snapped positions are rounded to steps of this many meters along their edge, so clicks a
+# step apart on the same walkway share a cache entry.
+POSITION_STEP = 2.0
+
+class RouteCache:
+    """
+    Bounded LRU cache with a time-to-live, for computed routes.
+    Entries also belong to a graph version: the first lookup with another version (the graph
+    was rebuilt) drops every entry. Safe to use from the server's worker threads.
+    """
+
+    def __init__(self, max_entries=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = None
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, version, key):
+        """
+        Returns the value cached for key under graph version, or None.
+        """
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, version, key, value):
+        """
+        Caches value for key under graph version, evicting the least recently used entry if full.
+        """
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters as a dict.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+def snap_position_key(graph, snap, step=POSITION_STEP):
+    """
+    Returns (edge, quantized position) for a snapped position from djikstra.snap_point.
+    The position is the fraction of the edge's segments walked (segment index + t), rounded
+    to about step meters of the edge's length.
+    """
+    edge = snap["edge"]
+    segments = int(graph.edge_geom_count[edge]) - 1
+    fraction = (snap["index"] + snap["t"]) / segments if segments > 0 else 0.0
+    steps = max(1, round(float(graph.edge_distance[edge]) / step))
+    return edge, round(fraction * steps)
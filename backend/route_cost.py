@@ -1,12 +1,46 @@
 import math
 import heapq
 import json
-from google_maps_util import get_elevation  # This function uses a polyline string to get elevation data
+import numpy as np
+import geodesy
 from typing import List, Dict
 
 # A very large cost to penalize staircase segments
 HUGE_PENALTY = 1e6
 
+# Named cost profiles. A profile prices an edge at its length plus a penalty in meters for each
+# feature it has that the user would rather avoid (inf makes such edges impassable):
+#   stairs  for an edge that touches a staircase,
+#   grade   per meter of length and per unit of the edge's steepest grade (rise over run),
+#   steep   for an edge steeper than max_grade (None for no limit).
+# The routing graph turns each profile into its own weight arrays once
+# (RoutingGraph.profile_costs), so the profile a request picks costs nothing per query.
+PROFILES = {
+    # Stairs only as a last resort.
+    "walker": {"stairs": HUGE_PENALTY, "grade": 0.0, "max_grade": None, "steep": 0.0},
+    # Never stairs; slopes are hard work, and ones steeper than an ADA ramp (1:12) are a last resort.
+    "wheelchair": {"stairs": math.inf, "grade": 10.0, "max_grade": 1 / 12, "steep": HUGE_PENALTY},
+    # A stroller can be carried up a flight of stairs, at the price of a long detour.
+    "stroller": {"stairs": 500.0, "grade": 5.0, "max_grade": None, "steep": 0.0},
+    # Stairs (with handrails) are fine, but a short detour around them or a steep slope is preferred.
+    "cane": {"stairs": 50.0, "grade": 2.0, "max_grade": None, "steep": 0.0},
+}
+
+# Profile of requests that do not name one; the graph's own arc_cost is priced with it.
+DEFAULT_PROFILE = "walker"
+
+# Weights of the trained route model (written by models/trainLinearModel.py, see
+# models/modelWeights.fold_linear_model), offered as the "model" cost profile when present.
+MODEL_WEIGHTS_PATH = "models/route_model_weights.json"
+MODEL_PROFILE = "model"
+
+# Edge of one staircase grid cell, in the 1e-9 degree units used by the OSM data.
+STAIR_CELL_SIZE = 10000
+
+# Cached staircase data so stairs.json is only read once per process.
+STAIRCASES_CACHE = None
+STAIR_INDEX_CACHE = None
+
 def haversine_distance(coord1: Dict[str, float], coord2: Dict[str, float]) -> float:
     """
     Calculate the haversine distance between two points (lat, lon) in meters.
@@ -16,23 +50,16 @@ def haversine_distance(coord1: Dict[str, float], coord2: Dict[str, float]) -> fl
     Returns:
         The haversine distance between the two coordinates in meters.
     """
-    lat1, lon1 = coord1["lat"], coord1["lon"]
-    lat2, lon2 = coord2["lat"], coord2["lon"]
-
-    lat1 = lat1 / 1e9
-    lon1 = lon1 / 1e9
-    lat2 = lat2 / 1e9
-    lon2 = lon2 / 1e9
-    R = 6371000  # radius of Earth in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    
-    return R * c
+    return float(geodesy.haversine(coord1["lat"] / 1e9, coord1["lon"] / 1e9,
+                                   coord2["lat"] / 1e9, coord2["lon"] / 1e9))
+
+def _degrees(coords: List[Dict[str, float]]):
+    """
+    Returns the latitudes and longitudes of dict-based coordinates as arrays in degrees.
+    """
+    lat = np.array([pt["lat"] for pt in coords], dtype=np.int64) / 1e9
+    lon = np.array([pt["lon"] for pt in coords], dtype=np.int64) / 1e9
+    return lat, lon
 
 def segment_overlaps_staircase(segment_coords: List[Dict[str, float]], staircase_coords: Dict[str, float], threshold: float) -> bool:
     """
@@ -48,11 +75,10 @@ def segment_overlaps_staircase(segment_coords: List[Dict[str, float]], staircase
     Returns:
         True if any point in segment_coords is within threshold meters of any staircase point.
     """
-    for coord in segment_coords:
-        for stair_pt in staircase_coords["refs"]:
-            if haversine_distance(coord, stair_pt) <= threshold:
-                return True
-    return False
+    if not segment_coords or not staircase_coords["refs"]:
+        return False
+    return bool((geodesy.pairwise_haversine(*_degrees(segment_coords), *_degrees(staircase_coords["refs"]))
+                 <= threshold).any())
 
 def segment_overlaps_any_staircase(segment_coords: List[Dict[str, float]], staircases: List[Dict[str, float]], threshold: float) -> bool:
     """
@@ -71,17 +97,153 @@ def segment_overlaps_any_staircase(segment_coords: List[Dict[str, float]], stair
             return True 
     return False
 
+def load_staircases() -> List[Dict]:
+    """
+    Loads stairs.json (a list of staircase ways, each with "way_id" and "refs").
+    The file is only read once; later calls return the cached list.
+    """
+    global STAIRCASES_CACHE
+    if STAIRCASES_CACHE is None:
+        STAIRCASES_CACHE = read_staircases()
+    return STAIRCASES_CACHE
+
+def read_staircases() -> List[Dict]:
+    """
+    Reads stairs.json from disk, bypassing the cache.
+    """
+    with open("stairs.json", "r") as f:
+        return json.load(f)
+
+def install_staircases(staircases: List[Dict], stair_index: Dict) -> None:
+    """
+    Replaces the cached staircase list and index (after stairs.json changed), both at once.
+    """
+    global STAIRCASES_CACHE, STAIR_INDEX_CACHE
+    STAIRCASES_CACHE, STAIR_INDEX_CACHE = staircases, stair_index
+
+def build_stair_index(staircases: List[Dict], threshold: float = 0.001) -> Dict:
+    """
+    Builds a lookup structure for staircase membership tests.
+
+    Args:
+        staircases: Staircase ways as loaded from stairs.json.
+        threshold: Distance in meters within which a point counts as touching a staircase.
+    Returns:
+        A dictionary with the staircase way ids, the staircase node ids and a uniform grid
+        (cell -> list of staircase points) used for the proximity fallback.
+    """
+    way_ids = set()
+    node_ids = set()
+    grid = {}
+    max_lat = 0.0
+    for staircase in staircases:
+        way_ids.add(staircase["way_id"])
+        for stair_pt in staircase["refs"]:
+            node_ids.add(stair_pt["id"])
+            cell = (stair_pt["lat"] // STAIR_CELL_SIZE, stair_pt["lon"] // STAIR_CELL_SIZE)
+            grid.setdefault(cell, []).append(stair_pt)
+            max_lat = max(max_lat, abs(stair_pt["lat"] / 1e9))
+    # Number of neighbouring cells that can hold a point within the threshold.
+    # Longitude degrees are the shortest at the highest latitude, so size the search for that.
+    meters_per_unit = geodesy.METERS_PER_DEGREE / 1e9 * math.cos(math.radians(min(max_lat, 89.0)))
+    reach = int(math.ceil(threshold / (meters_per_unit * STAIR_CELL_SIZE)))
+    return {"way_ids": way_ids, "node_ids": node_ids, "grid": grid, "reach": reach, "threshold": threshold}
+
+def get_stair_index() -> Dict:
+    """
+    Returns the staircase index built from stairs.json, building it on first use.
+    """
+    global STAIR_INDEX_CACHE
+    if STAIR_INDEX_CACHE is None:
+        STAIR_INDEX_CACHE = build_stair_index(load_staircases())
+    return STAIR_INDEX_CACHE
+
+def poly_touches_stairs(poly: List[Dict[str, float]], stair_index: Dict, way_id: int = None) -> bool:
+    """
+    Checks whether a polyline touches any staircase using a prebuilt stair index.
+
+    The OSM way id and the vertex ids are matched first; only when none of them is shared
+    with stairs.json are the nearby grid cells searched for a staircase point within the
+    index threshold. The answer is the same as segment_overlaps_any_staircase.
+    """
+    if way_id is not None and way_id in stair_index["way_ids"]:
+        return True
+    node_ids = stair_index["node_ids"]
+    for pt in poly:
+        if pt.get("id") in node_ids:
+            return True
+    grid = stair_index["grid"]
+    reach = stair_index["reach"]
+    # Every staircase point in the cells around any vertex; the exact distance check below
+    # only accepts pairs within the threshold, so pooling the cells changes nothing.
+    cells = set()
+    for pt in poly:
+        cell_lat = pt["lat"] // STAIR_CELL_SIZE
+        cell_lon = pt["lon"] // STAIR_CELL_SIZE
+        for i in range(cell_lat - reach, cell_lat + reach + 1):
+            for j in range(cell_lon - reach, cell_lon + reach + 1):
+                cells.add((i, j))
+    nearby = [stair_pt for cell in cells for stair_pt in grid.get(cell, ())]
+    if not nearby:
+        return False
+    distances = geodesy.pairwise_haversine(*_degrees(poly), *_degrees(nearby))
+    return bool((distances <= stair_index["threshold"]).any())
+
+def model_profile(weights: Dict[str, float]) -> Dict:
+    """
+    Turns the weights of the linear route model into a cost profile, in meters like the others:
+    the model prices a route at intercept + per_meter * distance + per_slope * avg_slope +
+    per_staircase * stairs, so a staircase costs per_staircase / per_meter meters.
+    The intercept never changes which route is best. The slope term is left out, so this
+    profile searches on distance and stairs only, for directions, matrices and isochrones
+    alike. avg_slope is the unweighted mean of the route's signed segment slopes
+    (costModel.compute_slope), which is not a sum over edges; an edge weight can only stand in
+    for it by charging climbs and descents alike, and on a sloped test DEM routes priced that
+    way scored no better under the model than routes that ignore slope.
+    """
+    return {"stairs": weights["per_staircase"] / weights["per_meter"], "grade": 0.0, "max_grade": None, "steep": 0.0}
+
+def install_model_profile(path: str = MODEL_WEIGHTS_PATH) -> None:
+    """
+    (Re)reads the route model weights into PROFILES[MODEL_PROFILE], or removes that profile if
+    there are none.
+    """
+    try:
+        with open(path, "r") as f:
+            PROFILES[MODEL_PROFILE] = model_profile(json.load(f))
+    except FileNotFoundError:
+        PROFILES.pop(MODEL_PROFILE, None)
+
+def stair_penalty(is_stairs: bool, profile: str = DEFAULT_PROFILE) -> float:
+    """
+    Returns the extra cost charged for traversing an edge with the given stairs flag.
+    """
+    return PROFILES[profile]["stairs"] if is_stairs else 0.0
+
+def edge_penalties(edge_stairs: np.ndarray, edge_distance: np.ndarray, edge_grade: np.ndarray,
+                   profile: str = DEFAULT_PROFILE) -> np.ndarray:
+    """
+    Returns the extra cost of every edge under a profile, given the edges' stairs flags,
+    lengths in meters and steepest grades. Also works on single values.
+    """
+    terms = PROFILES[profile]
+    penalty = np.where(edge_stairs, stair_penalty(True, profile), stair_penalty(False, profile))
+    if terms["grade"]:
+        penalty = penalty + terms["grade"] * np.multiply(edge_distance, edge_grade)
+    if terms["max_grade"] is not None:
+        penalty = penalty + np.where(np.greater(edge_grade, terms["max_grade"]), terms["steep"], 0.0)
+    return penalty
+
 def compute_edge_cost(poly: List[Dict[str, float]], staircase_threshold: float = 0.001) -> float:
     """
     Computes the cost for a segment based solely on its geometry and the staircase data.
 
     The segment (poly) is a list of dictionaries, each with keys "id", "lat", and "lon".  
-    The staircase data is read from "stairs.json" (which is expected to be a list of staircase segments,  
-    where each segment is itself a list of (lat, lon) tuples in degrees).
+    The staircase data is read once from "stairs.json" and kept in an index (see get_stair_index).
 
-    The function computes the total distance along the poly segment (using haversine_distance).  
     If any coordinate in the segment overlaps any staircase (within the given threshold in meters),  
-    a huge penalty is added.
+    a huge penalty is added. The routing graph precomputes this per edge in load_graph, so
+    this function is only needed for polylines that are not part of the graph.
 
     Parameters:
       poly: List of dictionaries representing coordinates, e.g.:
@@ -99,19 +261,9 @@ def compute_edge_cost(poly: List[Dict[str, float]], staircase_threshold: float =
     if not poly:
         return 0.0
 
-    # Build the list of coordinate dictionaries from poly.
-    segment_coords = [{"lat": pt["lat"], "lon": pt["lon"]} for pt in poly]
-
-    total_cost = 0.0
-    with open("stairs.json", "r") as f:
-        staircases = json.load(f)
-    
     # If any point in the segment is within staircase_threshold (meters) of any staircase point,
     # add a huge penalty.
-    if segment_overlaps_any_staircase(segment_coords, staircases, threshold=staircase_threshold):
-        total_cost += HUGE_PENALTY
-
-    return total_cost
+    return stair_penalty(poly_overlaps_staircase(poly, staircase_threshold))
 
 def poly_overlaps_staircase(poly: List[Dict[str, float]], staircase_threshold: float = 0.001) -> bool:
     """
@@ -133,11 +285,12 @@ def poly_overlaps_staircase(poly: List[Dict[str, float]], staircase_threshold: f
     if not poly:
         return False
 
-    # Build the list of coordinate dictionaries from poly.
-    segment_coords = [{"lat": pt["lat"], "lon": pt["lon"]} for pt in poly]
+    stair_index = get_stair_index()
+    if stair_index["threshold"] != staircase_threshold:
+        stair_index = build_stair_index(load_staircases(), staircase_threshold)
 
-    with open("stairs.json", "r") as f:
-        staircases = json.load(f)
-    
     # Check if any point in the segment is within staircase_threshold (meters) of any staircase point.
-    return segment_overlaps_any_staircase(segment_coords, staircases, threshold=staircase_threshold)
\ No newline at end of file
+    return poly_touches_stairs(poly, stair_index)
+
+# Offer the trained route model as a profile when its weights are present.
+install_model_profile()
@@ -1,14 +1,65 @@
 import os
 import json
 import math
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+from fastapi import FastAPI, HTTPException, Query, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from datetime import datetime
+from contextlib import asynccontextmanager
 # Import methods from djikstra.py
-from djikstra import load_graph, snap_point, dijkstra, combine_polylines, encode_polyline
+from djikstra import load_graph, reload_graph, snap_point, ENGINES, distance_matrix, encode_coordinates
+from graph_snapshot import source_stamp
+from closures import ClosureSet, ClosureError, CLOSURES_PATH, closed_edges
+from route_cost import PROFILES, DEFAULT_PROFILE
+from directions import find_routes, RoutingError
+from isochrone import find_isochrone, encode_pieces, hull_polygon, WALKING_SPEED
+from route_cache import RouteCache
+from routing_pool import RoutingPool, PoolSaturated, RouteTimeout
+import metrics
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    watcher = asyncio.create_task(watch_sources(RELOAD_POLL_INTERVAL)) if RELOAD_POLL_INTERVAL > 0 else None
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    # Stop the worker processes of /api/directions/async, if they were started.
+    if ROUTING_POOL is not None:
+        ROUTING_POOL.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Upper limit for the alternatives option of /api/directions.
+MAX_ALTERNATIVES = 10
+
+# Decimal digits allowed for encoded polylines (Google Maps decodes 5; 6 and 7 keep more of
+# the 1e-9 degree source data for clients that decode them).
+MAX_POLYLINE_PRECISION = 7
+
+# Highest map zoom level accepted for zoom-based route simplification.
+MAX_ZOOM = 22
+
+# Upper limit for the number of origins, and of destinations, in one /api/matrix request.
+MAX_MATRIX_POINTS = 100
+
+# Largest /api/isochrone budget, in meters of cost (a time budget is converted at WALKING_SPEED).
+MAX_ISOCHRONE_METERS = 5000
+
+# Computed routes of /api/directions: (encoded polyline, distance) per route, keyed by the
+# snapped positions of both ends and the request options, for the current graph version.
+ROUTE_CACHE = RouteCache()
+
+# Worker pool of /api/directions/async (see get_routing_pool).
+ROUTING_POOL = None
+
+# Temporary closures (see closures.py) every route and matrix avoids, kept in closures.json so
+# they survive restarts and reach every server process.
+CLOSURES = ClosureSet(CLOSURES_PATH)
+
+# Seconds between checks of formatted_data.json, stairs.json and elevation.npz for changes, which
+# reload the routing graph without a restart (0 turns the checks off; /api/admin/reload still works).
+RELOAD_POLL_INTERVAL = float(os.environ.get("ROUTING_RELOAD_INTERVAL", 10))
 
 # Allow CORS so your frontend can access the API.
 app.add_middleware(
@@ -19,9 +70,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def check_profile(profile):
+    """
+    Rejects an unknown cost profile name.
+    """
+    if profile not in PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown profile '{profile}'; expected one of: {', '.join(PROFILES)}")
+
+def parse_coordinate(text, detail="Coordinates must be provided as 'lat,lng'"):
+    """
+    Parses a 'lat,lng' query value into a (lat, lng) tuple; anything but exactly two finite
+    numbers is rejected with detail.
+    """
+    try:
+        coords = tuple(map(float, text.split(',')))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=detail) from e
+    if len(coords) != 2 or not all(math.isfinite(value) for value in coords):
+        raise HTTPException(status_code=400, detail=detail)
+    return coords
+
+def parse_directions_query(start, end, engine, alternatives, precision=5, simplify_tolerance=0.0, zoom=None,
+                           profile=DEFAULT_PROFILE):
+    """
+    Validates the /api/directions query parameters. Returns (start_coords, end_coords).
+    """
+    start_coords = parse_coordinate(start)
+    end_coords = parse_coordinate(end)
+    if not 1 <= alternatives <= MAX_ALTERNATIVES:
+        raise HTTPException(status_code=400, detail=f"alternatives must be between 1 and {MAX_ALTERNATIVES}")
+    if engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown engine '{engine}'; expected one of: {', '.join(ENGINES)}")
+    if not 1 <= precision <= MAX_POLYLINE_PRECISION:
+        raise HTTPException(status_code=400, detail=f"precision must be between 1 and {MAX_POLYLINE_PRECISION}")
+    if not simplify_tolerance >= 0:
+        raise HTTPException(status_code=400, detail="simplify_tolerance must be zero or more meters")
+    if zoom is not None and not 0 <= zoom <= MAX_ZOOM:
+        raise HTTPException(status_code=400, detail=f"zoom must be between 0 and {MAX_ZOOM}")
+    check_profile(profile)
+    return start_coords, end_coords
+
+def directions_response(start_coords, end_coords, computed):
+    """
+    Builds a mock Directions response that the frontend can work with, from the
+    (encoded polyline, distance) routes of directions.find_routes.
+    """
+    routes = []
+    for encoded, total_distance in computed:
+        routes.append({
+            "overview_polyline": {"points": encoded},
+            "legs": [
+                {
+                    "distance": {"value": total_distance},
+                    "start_address": f"{start_coords[0]},{start_coords[1]}",
+                    "end_address": f"{end_coords[0]},{end_coords[1]}"
+                }
+            ]
+        })
+    return {
+        "routes": routes,
+        "request": {
+            "travelMode": "WALKING",
+            "origin": f"{start_coords[0]},{start_coords[1]}",
+            "destination": f"{end_coords[0]},{end_coords[1]}"
+        }
+    }
+
 @app.get("/api/directions")
 def get_directions(start: str = Query(..., description="Start coordinate as 'lat,lng'"),
-                   end: str = Query(..., description="End coordinate as 'lat,lng'")):
+                   end: str = Query(..., description="End coordinate as 'lat,lng'"),
+                   engine: str = Query("dijkstra", description="Search engine: " + ", ".join(ENGINES)),
+                   alternatives: int = Query(
+                       1, description="Number of routes to return, best first (Yen's k shortest paths)"),
+                   precision: int = Query(5, description="Decimal digits of the encoded polyline"),
+                   simplify_tolerance: float = Query(
+                       0.0, description="Drop route vertices within this many meters of the simplified route"),
+                   zoom: int = Query(
+                       None, description="Map zoom level; simplifies the route to what that zoom can show"),
+                   profile: str = Query(DEFAULT_PROFILE, description="Cost profile: " + ", ".join(PROFILES))):
     """
     Calculates the best walking route between start and end coordinates using the custom graph and Dijkstra's algorithm.
     The result is transformed to mimic a Google Directions response so that your frontend's DirectionsRenderer can work.
@@ -29,56 +155,241 @@ def get_directions(start: str = Query(..., description="Start coordinate as 'lat
     NOTE: Ensure that any helper function in route_cost (such as convert_coord) extracts only the (lat, lon) 2-tuple,
     so that extra keys (like "id") do not cause unpacking errors.
     """
+    start_coords, end_coords = parse_directions_query(start, end, engine, alternatives,
+                                                      precision, simplify_tolerance, zoom, profile)
+    try:
+        computed = find_routes(start_coords, end_coords, engine, alternatives, ROUTE_CACHE,
+                               precision, simplify_tolerance, zoom, CLOSURES, profile)
+    except RoutingError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail) from e
+    return JSONResponse(content=directions_response(start_coords, end_coords, computed))
+
+@app.get("/api/directions/async")
+async def get_directions_async(start: str = Query(..., description="Start coordinate as 'lat,lng'"),
+                               end: str = Query(..., description="End coordinate as 'lat,lng'"),
+                               engine: str = Query(
+                                   "dijkstra", description="Search engine: " + ", ".join(ENGINES)),
+                               alternatives: int = Query(
+                                   1, description="Number of routes to return, best first (Yen's k shortest paths)"),
+                               precision: int = Query(5, description="Decimal digits of the encoded polyline"),
+                               simplify_tolerance: float = Query(
+                                   0.0, description="Drop route vertices within this many meters of the simplified route"),
+                               zoom: int = Query(
+                                   None, description="Map zoom level; simplifies the route to what that zoom can show"),
+                               profile: str = Query(
+                                   DEFAULT_PROFILE, description="Cost profile: " + ", ".join(PROFILES))):
+    """
+    Same as /api/directions, but the snapping and search run in a worker process (routing_pool.py),
+    so long routes do not hold up other requests and throughput grows with the number of cores.
+    Answers 503 when too many requests are already in flight and 504 when routing times out.
+    """
+    start_coords, end_coords = parse_directions_query(start, end, engine, alternatives,
+                                                      precision, simplify_tolerance, zoom, profile)
+    try:
+        computed = await get_routing_pool().find_routes(start_coords, end_coords, engine, alternatives,
+                                                        precision, simplify_tolerance, zoom, CLOSURES.state(), profile)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=503, detail="Routing is at capacity, retry shortly.",
+                            headers={"Retry-After": "1"}) from e
+    except RouteTimeout as e:
+        raise HTTPException(status_code=504, detail="Routing timed out.") from e
+    except RoutingError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail) from e
+    return JSONResponse(content=directions_response(start_coords, end_coords, computed))
+
+def get_routing_pool():
+    """
+    Returns the worker pool of /api/directions/async, starting it on first use.
+    """
+    global ROUTING_POOL
+    if ROUTING_POOL is None:
+        ROUTING_POOL = RoutingPool()
+    return ROUTING_POOL
+
+async def reload_routing(force=False):
+    """
+    Swaps in a graph rebuilt from the current source files (see djikstra.reload_graph) and
+    restarts the async workers on it. The rebuild runs in a thread, so requests keep being
+    served on the old graph meanwhile. Returns (graph, True if a new graph was swapped in).
+    """
+    graph, swapped = await asyncio.to_thread(reload_graph, force)
+    if swapped and ROUTING_POOL is not None:
+        ROUTING_POOL.reload()
+    return graph, swapped
+
+async def watch_sources(interval):
+    """
+    Reloads the routing graph whenever the source files change on disk.
+    """
+    stamp = source_stamp()
+    while True:
+        await asyncio.sleep(interval)
+        current = source_stamp()
+        if current == stamp:
+            continue
+        # A failed reload (say, a half-written file) is retried on the next change.
+        stamp = current
+        try:
+            graph, swapped = await reload_routing()
+            if swapped:
+                print("Reloaded the routing graph, version", graph.version)
+        except Exception as e:
+            print("Could not reload the routing graph:", e)
+
+@app.post("/api/admin/reload")
+async def post_reload(force: bool = Query(False, description="Rebuild even if the source files are unchanged")):
+    """
+    Rebuilds the routing graph from formatted_data.json, stairs.json and elevation.npz and swaps
+    it in without a restart. Requests already running finish on the old graph; no request is dropped.
+    With several server processes only the one answering reloads here; the source file checks
+    (ROUTING_RELOAD_INTERVAL) reload every process.
+    """
     try:
-        start_coords = tuple(map(float, start.split(',')))
-        end_coords = tuple(map(float, end.split(',')))
+        graph, swapped = await reload_routing(force)
     except Exception as e:
-        raise HTTPException(status_code=400, detail="Coordinates must be provided as 'lat,lng'") from e
+        raise HTTPException(status_code=500, detail=f"Reload failed, still serving the old graph: {e}") from e
+    return JSONResponse(content={"reloaded": swapped, "version": graph.version})
 
-    # Load the routing graph and nodes using the cached load_graph.
+@app.get("/api/closures")
+def get_closures():
+    """
+    Lists the closures in force, each with the number of graph edges it affects.
+    """
     try:
-        graph, graph_nodes = load_graph()
+        graph = load_graph()
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to load routing data") from e
+    closures = [{**closure, "edges": len(closed_edges(graph, closure))} for closure in CLOSURES.closures()]
+    return JSONResponse(content={"closures": closures})
 
-    # Snap the provided start and end onto the graph.
-    origin_snapped = snap_point(start_coords, graph, graph_nodes)
-    destination_snapped = snap_point(end_coords, graph, graph_nodes)
-    if origin_snapped is None or destination_snapped is None:
-        raise HTTPException(status_code=404, detail="Could not snap provided coordinates onto the routing graph.")
-        
-    # Run Dijkstra's algorithm between the snapped nodes.
-    total_distance, path, edges_in_path = dijkstra(graph, origin_snapped, destination_snapped)
-    if path is None or edges_in_path is None:
-        raise HTTPException(status_code=404, detail="No path found.")
-
-    # Combine the polyline segments and encode them using the Google Polyline Algorithm.
-    full_polyline = combine_polylines(edges_in_path)
-    if not full_polyline or len(full_polyline) == 0:
-        raise HTTPException(status_code=404, detail="No polyline found for the route.")
-    
-    # Convert each vertex dictionary to degrees.
-    points = [{"lat": pt["lat"] / 1e9, "lon": pt["lon"] / 1e9} for pt in full_polyline]
-    encoded = encode_polyline(points)
-    
-    # Build a mock Directions response that the frontend can work with.
+@app.post("/api/closures")
+def post_closure(closure: dict = Body(..., description="Closure with an id and any of ways, nodes and polygon ([[lat, lng], ...]); "
+                                                       "an optional penalty in meters makes the edges dearer instead of closing them")):
+    """
+    Closes walkways (or, with a penalty, discourages them) until the closure is deleted.
+    Routes computed from now on avoid them; a closure with an existing id replaces it.
+    """
+    try:
+        closure = CLOSURES.put(closure)
+    except ClosureError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    return JSONResponse(content=closure)
+
+@app.delete("/api/closures/{closure_id}")
+def delete_closure(closure_id: str):
+    """
+    Lifts a closure.
+    """
+    if not CLOSURES.remove(closure_id):
+        raise HTTPException(status_code=404, detail=f"No closure '{closure_id}'")
+    return JSONResponse(content={"deleted": closure_id})
+
+@app.get("/api/cache")
+def get_cache_stats():
+    """
+    Hit/miss statistics of the /api/directions route cache.
+    """
+    stats = ROUTE_CACHE.stats()
+    if ROUTING_POOL is not None:
+        stats["async_pool"] = ROUTING_POOL.stats()
+    return JSONResponse(content=stats)
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Routing query counters (heap pushes and pops, nodes settled, edges relaxed, snap candidates)
+    and per-stage latency histograms, in the Prometheus text format. Queries answered by the
+    async worker processes are included once they return.
+    """
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/isochrone")
+def get_isochrone(origin: str = Query(..., description="Origin coordinate as 'lat,lng'"),
+                  meters: float = Query(
+                      None, description="Budget in meters of walking (plus the profile's penalties)"),
+                  minutes: float = Query(
+                      None, description=f"Budget in minutes of walking at {WALKING_SPEED:g} m/min"),
+                  profile: str = Query(DEFAULT_PROFILE, description="Cost profile: " + ", ".join(PROFILES)),
+                  shape: str = Query(
+                      "lines", description="'lines' for the reachable walkways, 'polygon' for the outline of the "
+                                           "reachable area"),
+                  precision: int = Query(5, description="Decimal digits of the encoded polylines")):
+    """
+    Everything reachable from origin within a walking budget, found with a single search on the
+    chosen cost profile (so the wheelchair profile gives the step-free area). Returns the
+    reachable walkways as encoded polylines, walkways reached part of the way being cut where
+    the budget runs out, or the outline of the area as one encoded polygon ring.
+    """
+    origin_coords = parse_coordinate(origin)
+    if (meters is None) == (minutes is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of meters and minutes")
+    budget = meters if meters is not None else minutes * WALKING_SPEED
+    if not 0 <= budget <= MAX_ISOCHRONE_METERS:
+        raise HTTPException(status_code=400, detail=f"The budget must be between 0 and {MAX_ISOCHRONE_METERS} meters "
+                                                    f"({MAX_ISOCHRONE_METERS / WALKING_SPEED:g} minutes)")
+    if shape not in ("lines", "polygon"):
+        raise HTTPException(status_code=400, detail="shape must be 'lines' or 'polygon'")
+    if not 1 <= precision <= MAX_POLYLINE_PRECISION:
+        raise HTTPException(status_code=400, detail=f"precision must be between 1 and {MAX_POLYLINE_PRECISION}")
+    check_profile(profile)
+
+    try:
+        pieces = find_isochrone(origin_coords, budget, profile, CLOSURES)
+    except RoutingError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail) from e
+    response = {"origin": f"{origin_coords[0]},{origin_coords[1]}", "profile": profile, "budget_meters": budget}
+    if shape == "lines":
+        response["polylines"] = [{"points": encoded} for encoded in encode_pieces(pieces, precision)]
+    else:
+        response["polygon"] = {"points": encode_coordinates(hull_polygon(pieces), precision)}
+    return JSONResponse(content=response)
+
+@app.get("/api/matrix")
+def get_matrix(origins: str = Query(..., description="Origin coordinates as 'lat,lng|lat,lng|...'"),
+               destinations: str = Query(None, description="Destination coordinates as 'lat,lng|...' (default: the origins)"),
+               profile: str = Query(DEFAULT_PROFILE, description="Cost profile: " + ", ".join(PROFILES))):
+    """
+    Calculates walking distances from every origin to every destination in one request.
+    Every point is snapped once and each origin needs one search, instead of one /api/directions
+    call per pair. The result is shaped like a Google Distance Matrix response: one row per
+    origin, one element per destination.
+    """
+    detail = "Coordinates must be provided as 'lat,lng|lat,lng|...'"
+    origin_coords = [parse_coordinate(point, detail) for point in origins.split('|')]
+    destination_coords = ([parse_coordinate(point, detail) for point in destinations.split('|')]
+                          if destinations else origin_coords)
+    if len(origin_coords) > MAX_MATRIX_POINTS or len(destination_coords) > MAX_MATRIX_POINTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_MATRIX_POINTS} origins and {MAX_MATRIX_POINTS} destinations")
+    check_profile(profile)
+
+    with metrics.query("matrix", profile=profile, origins=len(origin_coords), destinations=len(destination_coords)):
+        try:
+            with metrics.stage("load_graph"):
+                graph = load_graph()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Failed to load routing data") from e
+
+        # Without destinations the origins' snaps serve as both.
+        with metrics.stage("snap_point"):
+            origin_snaps = [snap_point(point, graph) for point in origin_coords]
+            destination_snaps = [snap_point(point, graph) for point in destination_coords] if destinations else None
+        if any(snap is None for snap in origin_snaps + (destination_snaps or [])):
+            raise HTTPException(status_code=404, detail="Could not snap provided coordinates onto the routing graph.")
+
+        with metrics.stage("distance_matrix"):
+            matrix = distance_matrix(graph, origin_snaps, destination_snaps, CLOSURES, profile)
     response = {
-        "routes": [
+        "origin_addresses": [f"{lat},{lng}" for lat, lng in origin_coords],
+        "destination_addresses": [f"{lat},{lng}" for lat, lng in destination_coords],
+        "rows": [
             {
-                "overview_polyline": {"points": encoded},
-                "legs": [
-                    {
-                        "distance": {"value": total_distance},
-                        "start_address": f"{start_coords[0]},{start_coords[1]}",
-                        "end_address": f"{end_coords[0]},{end_coords[1]}"
-                    }
+                "elements": [
+                    {"distance": {"value": distance}, "status": "OK"} if distance is not None
+                    else {"status": "ZERO_RESULTS"}
+                    for distance in row
                 ]
             }
+            for row in matrix
         ],
-        "request": {
-            "travelMode": "WALKING",
-            "origin": f"{start_coords[0]},{start_coords[1]}",
-            "destination": f"{end_coords[0]},{end_coords[1]}"
-        }
     }
     return JSONResponse(content=response)
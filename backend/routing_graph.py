@@ -0,0 +1,267 @@
+import numpy as np
+import elevation
+import geodesy
+import route_cost
+import spatial_index
+
+# Planar distances are multiplied by this before use as a lower bound on walking cost,
+# covering float rounding and the curvature the projection ignores.
+HEURISTIC_SCALE = 1 - 1e-6
+
+class RoutingGraph:
+    """
+    Compact, array-backed walkway graph used by the routing engines.
+
+    Nodes are the junction vertices of formatted_data.json, numbered 0..N-1 in ascending
+    OSM id order, so node_ids is sorted and an OSM id is found with a binary search.
+    Every undirected edge e owns one slice coords[edge_geom_start[e]:+edge_geom_count[e]]
+    of the shared coordinate buffer, stored in the direction of the source data.
+    The directed arcs (two per edge) are kept in CSR form: the arcs leaving node u are
+    offsets[u]..offsets[u+1]-1, and an arc only refers to its edge and whether the edge
+    geometry is walked backwards, so both directions share one copy of the geometry.
+    arc_twin maps every arc to the arc walking the same edge the other way.
+    node_x/node_y are planar positions in meters (see project) for the A* heuristic, and
+    shortcut_edges lists the few edges that cost less than the planar distance between their
+    junctions (where the source data records a junction at two different positions).
+    Heights come from the local elevation model (see elevation.py): coord_elevation for every
+    vertex and node_elevation for every junction (NaN where unknown), and edge_grade is the
+    steepest grade along each edge (0 where unknown).
+    """
+
+    # Every attribute is a NumPy array; FIELDS is what snapshots and shared memory copy.
+    FIELDS = (
+        "node_ids", "node_lat", "node_lon", "node_x", "node_y", "projection", "shortcut_edges",
+        "offsets", "targets", "arc_edge", "arc_reverse", "arc_twin", "arc_cost",
+        "edge_u", "edge_v", "edge_way", "edge_distance", "edge_stairs", "edge_penalty",
+        "edge_geom_start", "edge_geom_count", "coords", "coord_ids",
+        "seg_arc", "seg_pos", "node_elevation", "coord_elevation", "edge_grade",
+    )
+
+    def __init__(self, arrays, segment_index):
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+        self.segment_index = segment_index
+        self.node_count = len(self.node_ids)
+        self.arc_count = len(self.targets)
+        self.edge_count = len(self.edge_u)
+        # Stamp of the data the graph was built from (set by djikstra.load_graph); caches of
+        # results computed on the graph are keyed by it.
+        self.version = None
+        self._search_lists = None
+        self._profiles = {}
+
+    def node_index(self, osm_id):
+        """
+        Returns the dense index of the node with the given OSM id, or None if it is not a junction.
+        """
+        i = int(np.searchsorted(self.node_ids, osm_id))
+        if i < self.node_count and self.node_ids[i] == osm_id:
+            return i
+        return None
+
+    def arc_source(self, arc):
+        """
+        Returns the node an arc leaves from.
+        """
+        edge = self.arc_edge[arc]
+        return int(self.edge_v[edge] if self.arc_reverse[arc] else self.edge_u[edge])
+
+    def arc_geometry(self, arc):
+        """
+        Returns the (lat, lon) vertices of an arc in travel order, as a view into coords.
+        """
+        edge = self.arc_edge[arc]
+        start = self.edge_geom_start[edge]
+        geometry = self.coords[start:start + self.edge_geom_count[edge]]
+        return geometry[::-1] if self.arc_reverse[arc] else geometry
+
+    def project(self, lat, lon):
+        """
+        Returns the planar (x, y) position in meters of a point given in degrees.
+        """
+        return lon * self.projection[0], lat * self.projection[1]
+
+    def search_lists(self):
+        """
+        Returns (offsets, targets, arc_cost, arc_twin) as Python lists.
+        The search loops run in the interpreter, where indexing a list is several times faster
+        than indexing a NumPy array, so this small copy of the topology is made once per graph.
+        """
+        if self._search_lists is None:
+            self._search_lists = (self.offsets.tolist(), self.targets.tolist(), self.arc_cost.tolist(),
+                                  self.arc_twin.tolist())
+        return self._search_lists
+
+    def profile_costs(self, profile=route_cost.DEFAULT_PROFILE):
+        """
+        Returns the weights of a cost profile (see route_cost.PROFILES), made once per graph: a dict
+        with the edge_penalty and arc_cost arrays, arc_cost_list (arc_cost as a Python list for the
+        search loops), the profile's shortcut_edges, and dearer, True if no arc costs less than
+        with the default profile (so lower bounds made for the graph's own costs still hold).
+        """
+        costs = self._profiles.get(profile)
+        if costs is not None:
+            return costs
+        if profile == route_cost.DEFAULT_PROFILE:
+            costs = {"edge_penalty": self.edge_penalty, "arc_cost": self.arc_cost,
+                     "arc_cost_list": self.search_lists()[2], "shortcut_edges": self.shortcut_edges, "dearer": True}
+        else:
+            edge_penalty = route_cost.edge_penalties(self.edge_stairs, self.edge_distance, self.edge_grade, profile)
+            arc_cost = self.edge_distance[self.arc_edge] + edge_penalty[self.arc_edge]
+            costs = {"edge_penalty": edge_penalty, "arc_cost": arc_cost, "arc_cost_list": arc_cost.tolist(),
+                     "shortcut_edges": _shortcut_edges(self.edge_u, self.edge_v, self.node_x, self.node_y,
+                                                       self.edge_distance + edge_penalty),
+                     "dearer": bool((arc_cost >= self.arc_cost).all())}
+        self._profiles[profile] = costs
+        return costs
+
+    def nbytes(self):
+        """
+        Total size in bytes of the arrays behind the graph and its segment index.
+        """
+        return (sum(getattr(self, name).nbytes for name in self.FIELDS) +
+                sum(array.nbytes for array in self.segment_index.values()))
+
+def build_routing_graph(segments, stair_index, dem=None):
+    """
+    Builds a RoutingGraph from the segments of formatted_data.json.
+    Each edge is tagged for stairs once here (see route_cost.poly_touches_stairs), and every
+    vertex gets its height from the elevation model dem (see elevation.load_dem; None leaves
+    them unknown).
+    """
+    edge_start_ids, edge_end_ids, edge_way, edge_distance, edge_stairs = [], [], [], [], []
+    edge_geom_start, edge_geom_count = [], []
+    coord_lat, coord_lon, coord_ids = [], [], []
+    for seg in segments:
+        for edge in seg["edges"]:
+            poly = edge["polyline"]
+            edge_start_ids.append(edge["start"]["id"])
+            edge_end_ids.append(edge["end"]["id"])
+            edge_way.append(seg["way_id"])
+            edge_distance.append(edge["distance"])
+            edge_stairs.append(route_cost.poly_touches_stairs(poly, stair_index, seg["way_id"]))
+            edge_geom_start.append(len(coord_ids))
+            edge_geom_count.append(len(poly))
+            for pt in poly:
+                coord_lat.append(pt["lat"])
+                coord_lon.append(pt["lon"])
+                coord_ids.append(pt["id"])
+
+    # Junction ids in the order they are first seen (start then end of each edge);
+    # a full scan of the old dict-based graph visited nodes in this order.
+    endpoint_ids = np.empty(2 * len(edge_start_ids), dtype=np.int64)
+    endpoint_ids[0::2] = edge_start_ids
+    endpoint_ids[1::2] = edge_end_ids
+    node_ids, first_seen = np.unique(endpoint_ids, return_index=True)
+    edge_u = np.searchsorted(node_ids, edge_start_ids).astype(np.int32)
+    edge_v = np.searchsorted(node_ids, edge_end_ids).astype(np.int32)
+    edge_count = len(edge_u)
+    node_count = len(node_ids)
+
+    coords = np.empty((len(coord_ids), 2))
+    coords[:, 0] = np.array(coord_lat, dtype=np.int64) / 1e9
+    coords[:, 1] = np.array(coord_lon, dtype=np.int64) / 1e9
+    edge_geom_start = np.array(edge_geom_start, dtype=np.int64)
+    node_lat = np.empty(node_count)
+    node_lon = np.empty(node_count)
+    node_lat[edge_u] = coords[edge_geom_start, 0]
+    node_lon[edge_u] = coords[edge_geom_start, 1]
+    edge_geom_count = np.array(edge_geom_count, dtype=np.int32)
+    last = edge_geom_start + edge_geom_count - 1
+    node_lat[edge_v] = coords[last, 0]
+    node_lon[edge_v] = coords[last, 1]
+
+    coord_elevation = elevation.sample(dem, coords[:, 0], coords[:, 1])
+    node_elevation = np.empty(node_count)
+    node_elevation[edge_u] = coord_elevation[edge_geom_start]
+    node_elevation[edge_v] = coord_elevation[last]
+    edge_grade = elevation.edge_grades(coords, coord_elevation, edge_geom_start, edge_geom_count)
+
+    edge_stairs = np.array(edge_stairs, dtype=bool)
+    edge_distance = np.array(edge_distance, dtype=np.float64)
+    edge_penalty = route_cost.edge_penalties(edge_stairs, edge_distance, edge_grade)
+
+    # Arcs are interleaved (forward, reverse) per edge, then stably grouped by source node,
+    # so each node keeps its arcs in the order the source data listed them.
+    arc_source = np.empty(2 * edge_count, dtype=np.int32)
+    arc_source[0::2] = edge_u
+    arc_source[1::2] = edge_v
+    order = np.argsort(arc_source, kind="stable")
+    all_targets = np.empty(2 * edge_count, dtype=np.int32)
+    all_targets[0::2] = edge_v
+    all_targets[1::2] = edge_u
+    all_edges = np.repeat(np.arange(edge_count, dtype=np.int32), 2)
+    all_reverse = np.tile(np.array([False, True]), edge_count)
+    offsets = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(arc_source, minlength=node_count), out=offsets[1:])
+    targets = all_targets[order]
+    arc_edge = all_edges[order]
+    arc_reverse = all_reverse[order]
+    # order[p] is the interleaved position of CSR arc p; its twin sits at interleaved position ^ 1.
+    position = np.empty(2 * edge_count, dtype=np.int64)
+    position[order] = np.arange(2 * edge_count)
+    arc_twin = position[order ^ 1].astype(np.int32)
+    arc_cost = edge_distance[arc_edge] + edge_penalty[arc_edge]
+
+    # Equirectangular projection scaled at the northernmost junction, so that planar distances
+    # never exceed the haversine distance anywhere in the graph.
+    # projection holds the meters per degree of longitude and of latitude.
+    reference_lat = np.abs(node_lat).max()
+    projection = np.array(geodesy.equirectangular(1.0, 1.0, reference_lat))
+    node_x, node_y = geodesy.equirectangular(node_lat, node_lon, reference_lat)
+    shortcut_edges = _shortcut_edges(edge_u, edge_v, node_x, node_y, edge_distance + edge_penalty)
+
+    arrays = {
+        "node_ids": node_ids, "node_lat": node_lat, "node_lon": node_lon,
+        "node_x": node_x, "node_y": node_y, "projection": projection, "shortcut_edges": shortcut_edges,
+        "offsets": offsets, "targets": targets, "arc_edge": arc_edge,
+        "arc_reverse": arc_reverse, "arc_twin": arc_twin, "arc_cost": arc_cost,
+        "edge_u": edge_u, "edge_v": edge_v, "edge_way": np.array(edge_way, dtype=np.int64),
+        "edge_distance": edge_distance, "edge_stairs": edge_stairs, "edge_penalty": edge_penalty,
+        "edge_geom_start": edge_geom_start, "edge_geom_count": edge_geom_count,
+        "coords": coords, "coord_ids": np.array(coord_ids, dtype=np.int64),
+        "node_elevation": node_elevation, "coord_elevation": coord_elevation, "edge_grade": edge_grade,
+    }
+    arrays.update(_segments_in_scan_order(arrays, np.argsort(first_seen, kind="stable")))
+    seg_geometry = _segment_endpoints(arrays)
+    return RoutingGraph(arrays, spatial_index.build_segment_index(*seg_geometry))
+
+def _shortcut_edges(edge_u, edge_v, node_x, node_y, edge_cost):
+    """
+    Returns the ids of the edges that cost less than the planar distance between their junctions.
+    """
+    planar = np.hypot(node_x[edge_u] - node_x[edge_v], node_y[edge_u] - node_y[edge_v])
+    return np.flatnonzero(edge_cost < HEURISTIC_SCALE * planar).astype(np.int32)
+
+def _segments_in_scan_order(arrays, scan_nodes):
+    """
+    Lists every segment of every unique edge as (arc, position along the arc).
+    Each edge is taken once, in the direction from the smaller to the larger node id, and
+    nodes are visited in first-seen order, which reproduces the old full-scan snapping order.
+    Self-loops are skipped, like the old scan did.
+    """
+    seg_arc, seg_pos = [], []
+    offsets = arrays["offsets"]
+    targets = arrays["targets"]
+    counts = arrays["edge_geom_count"][arrays["arc_edge"]]
+    for u in scan_nodes.tolist():
+        for arc in range(offsets[u], offsets[u + 1]):
+            if u < targets[arc]:
+                n = int(counts[arc]) - 1
+                seg_arc.extend([arc] * n)
+                seg_pos.extend(range(n))
+    return {"seg_arc": np.array(seg_arc, dtype=np.int32), "seg_pos": np.array(seg_pos, dtype=np.int32)}
+
+def _segment_endpoints(arrays):
+    """
+    Returns the (a_lat, a_lon, b_lat, b_lon) arrays of every listed segment, in arc direction.
+    """
+    seg_arc = arrays["seg_arc"]
+    edge = arrays["arc_edge"][seg_arc]
+    start = arrays["edge_geom_start"][edge]
+    last = start + arrays["edge_geom_count"][edge] - 1
+    reverse = arrays["arc_reverse"][seg_arc]
+    a = np.where(reverse, last - arrays["seg_pos"], start + arrays["seg_pos"])
+    b = np.where(reverse, a - 1, a + 1)
+    coords = arrays["coords"]
+    return coords[a, 0], coords[a, 1], coords[b, 0], coords[b, 1]
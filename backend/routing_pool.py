@@ -0,0 +1,132 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+import closures
+import directions
+import djikstra
+import metrics
+import route_cache
+from route_cost import DEFAULT_PROFILE
+
+# Worker processes for the async directions endpoint. Routing is pure-Python CPU work that
+# holds the GIL, so it runs in separate processes, each with its own copy of the graph.
+ROUTING_WORKERS = int(os.environ.get("ROUTING_WORKERS", os.cpu_count() or 1))
+
+# Requests allowed in flight (queued or running) per worker before new ones are turned away.
+MAX_PENDING_PER_WORKER = 4
+
+# Seconds a request may wait for its routes, queueing included.
+ROUTE_TIMEOUT = 10.0
+
+# Route cache of a worker process (set up by _init_worker).
+WORKER_CACHE = None
+
+# Closures in force in a worker process, as handed over with each request.
+WORKER_CLOSURES = None
+
+class PoolSaturated(Exception):
+    """
+    Raised when the pool already has its maximum number of requests in flight.
+    """
+
+class RouteTimeout(Exception):
+    """
+    Raised when routes were not found within the pool's timeout.
+    """
+
+def _init_worker():
+    # Load the graph once per worker, before its first request.
+    global WORKER_CACHE, WORKER_CLOSURES
+    # A forked worker starts with a copy of the server's metrics; only its own go back.
+    metrics.REGISTRY.drain()
+    djikstra.load_graph()
+    WORKER_CACHE = route_cache.RouteCache()
+    WORKER_CLOSURES = closures.ClosureSet()
+
+def _find_routes(start_coords, end_coords, engine, alternatives, precision, simplify_tolerance, zoom,
+                 closures_state, profile):
+    # The closures travel with every request; costs are only recomputed when they change.
+    WORKER_CLOSURES.replace(*closures_state)
+    try:
+        routes = directions.find_routes(start_coords, end_coords, engine, alternatives, WORKER_CACHE,
+                                        precision, simplify_tolerance, zoom, WORKER_CLOSURES, profile)
+    except directions.RoutingError as e:
+        # What the worker counted goes back with the error too.
+        e.metrics = metrics.REGISTRY.drain()
+        raise
+    return routes, metrics.REGISTRY.drain()
+
+class RoutingPool:
+    """
+    A process pool running directions.find_routes, with a bound on requests in flight and a
+    timeout per request. Use from a single event loop.
+    """
+
+    def __init__(self, workers=ROUTING_WORKERS, max_pending=None, timeout=ROUTE_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else MAX_PENDING_PER_WORKER * workers
+        self.timeout = timeout
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+    async def find_routes(self, start_coords, end_coords, engine="dijkstra", alternatives=1,
+                          precision=5, simplify_tolerance=0.0, zoom=None, closures_state=("", []),
+                          profile=DEFAULT_PROFILE):
+        """
+        Runs directions.find_routes in a worker, with the closures of closures_state (from
+        closures.ClosureSet.state) in force.
+        Raises PoolSaturated without queueing if max_pending requests are in flight, RouteTimeout
+        after timeout seconds, and whatever find_routes raises (RoutingError).
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PoolSaturated()
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(_find_routes, start_coords, end_coords, engine, alternatives,
+                                       precision, simplify_tolerance, zoom, closures_state, profile)
+        self.pending += 1
+        # A timed-out request keeps its worker busy until it finishes, so it stays counted until then.
+        future.add_done_callback(lambda f: self._release_from(loop))
+        try:
+            routes, worker_metrics = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError as e:
+            self.timed_out += 1
+            raise RouteTimeout() from e
+        except directions.RoutingError as e:
+            metrics.REGISTRY.merge(getattr(e, "metrics", ({}, {})))
+            raise
+        metrics.REGISTRY.merge(worker_metrics)
+        return routes
+
+    def _release_from(self, loop):
+        # Runs in the executor's thread; the count itself is only touched on the event loop.
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # the loop is already closed
+
+    def _release(self):
+        self.pending -= 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    def reload(self):
+        """
+        Replaces the worker processes after djikstra.reload_graph, so requests from now on run on
+        the new graph. Requests already queued or running finish in the old workers.
+        """
+        old = self._executor
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        old.shutdown(wait=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import sys
+import tempfile
+import graph_snapshot
+
+# Serving the routing graph to many server worker processes from one copy in memory.
+# A launcher process builds (or loads) the graph once and publishes it as a snapshot file on a
+# memory-backed file system (/dev/shm where there is one); workers find its path in the
+# SHARED_GRAPH_ENV environment variable and map it read-only (see djikstra.load_graph), so
+# they all use the same physical pages and never rebuild the graph themselves.
+SHARED_GRAPH_ENV = "ROUTING_GRAPH_SHARED"
+
+def shared_directory():
+    """
+    Returns the directory published graphs go to.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+def publish_graph(graph, source, path=None):
+    """
+    Writes the graph to a snapshot file for workers to attach to and returns its path.
+    The caller removes the file once the workers are done.
+    """
+    if path is None:
+        path = os.path.join(shared_directory(), f"seawolf-routing-{os.getpid()}.snapshot")
+    graph_snapshot.write_snapshot(graph, source, path)
+    return path
+
+def attach_graph(path):
+    """
+    Maps a published graph read-only and returns (source hash, RoutingGraph), or None if
+    there is no usable graph at path.
+    """
+    try:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    unpacked = graph_snapshot.unpack_arrays(buffer)
+    if unpacked is None:
+        return None
+    source, arrays = unpacked
+    return source, graph_snapshot.graph_from_arrays(arrays)
+
+def main():
+    # Build the graph once, publish it, and run the API with several uvicorn workers on it:
+    #   python shared_graph.py [workers] [port]
+    import uvicorn
+    import djikstra
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else (os.cpu_count() or 1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    graph = djikstra.load_graph()
+    path = publish_graph(graph, graph.version)
+    print(f"Published the routing graph at {path} ({os.path.getsize(path)} bytes)")
+    os.environ[SHARED_GRAPH_ENV] = path
+    try:
+        uvicorn.run("routingBeta:app", host="0.0.0.0", port=port, workers=workers)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
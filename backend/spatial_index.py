@@ -0,0 +1,160 @@
+import math
+import numpy as np
+import geodesy
+
+# Edge of one grid cell in degrees (about 55 m of latitude on campus).
+SEGMENT_CELL_SIZE = 0.0005
+
+# Distances within this many meters of the best candidate are re-checked exactly by the caller.
+SHORTLIST_TOLERANCE = 1e-6
+
+# Rings searched around the query cell before falling back to checking every segment
+# (the search also falls back once a ring has more cells than the grid has occupied cells).
+MAX_RING_RADIUS = 64
+
+def build_segment_index(a_lat, a_lon, b_lat, b_lon, cell_size=SEGMENT_CELL_SIZE):
+    """
+    Builds a uniform-grid index over line segments A -> B (coordinates in degrees).
+    Every segment is listed in each cell its bounding box overlaps. Only occupied cells are
+    stored, in CSR form: grid_keys holds their sorted cell keys and the segments of the cell
+    grid_keys[k] are grid_items[grid_start[k]:grid_start[k + 1]], in ascending segment id order.
+    The index is a dict of NumPy arrays only.
+    """
+    a_lat, a_lon, b_lat, b_lon = (np.asarray(x, dtype=np.float64) for x in (a_lat, a_lon, b_lat, b_lon))
+    index = {"a_lat": a_lat, "a_lon": a_lon, "b_lat": b_lat, "b_lon": b_lon}
+    if len(a_lat) == 0:
+        index.update({"grid_keys": np.zeros(0, dtype=np.int64), "grid_start": np.zeros(1, dtype=np.int64),
+                      "grid_items": np.zeros(0, dtype=np.int32),
+                      "grid_shape": np.zeros(4, dtype=np.int64), "grid_params": np.array([cell_size, 0.0])})
+        return index
+    row_lo = np.floor(np.minimum(a_lat, b_lat) / cell_size).astype(np.int64)
+    row_hi = np.floor(np.maximum(a_lat, b_lat) / cell_size).astype(np.int64)
+    col_lo = np.floor(np.minimum(a_lon, b_lon) / cell_size).astype(np.int64)
+    col_hi = np.floor(np.maximum(a_lon, b_lon) / cell_size).astype(np.int64)
+    min_row, min_col = int(row_lo.min()), int(col_lo.min())
+    nrows = int(row_hi.max()) - min_row + 1
+    ncols = int(col_hi.max()) - min_col + 1
+    # Expand every segment into the cells of its bounding box.
+    width = col_hi - col_lo + 1
+    counts = (row_hi - row_lo + 1) * width
+    seg = np.repeat(np.arange(len(a_lat), dtype=np.int32), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row_lo[seg] + k // width[seg]
+    cols = col_lo[seg] + k % width[seg]
+    cell = (rows - min_row) * ncols + (cols - min_col)
+    order = np.lexsort((seg, cell))
+    grid_keys, counts = np.unique(cell, return_counts=True)
+    grid_start = np.zeros(len(grid_keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=grid_start[1:])
+    max_abs_lat = float(max(np.abs(a_lat).max(), np.abs(b_lat).max()))
+    index.update({
+        "grid_keys": grid_keys,
+        "grid_start": grid_start,
+        "grid_items": seg[order],
+        "grid_shape": np.array([min_row, min_col, nrows, ncols], dtype=np.int64),
+        "grid_params": np.array([cell_size, max_abs_lat]),
+    })
+    return index
+
+def nearest_segments(index, P):
+    """
+    Finds the segments closest to point P (lat, lon in degrees).
+
+    Grid rings around P's cell are searched outwards until the best distance found is
+    smaller than the distance to any cell not yet searched. Points too far from every segment
+    for that to end quickly fall back to checking all segments.
+    Returns the ids (ascending) of every segment within SHORTLIST_TOLERANCE meters of the best
+    distance, so the caller can pick the winner with exact scalar math.
+    """
+    if len(index["a_lat"]) == 0:
+        return []
+    min_row, min_col, nrows, ncols = index["grid_shape"].tolist()
+    cs, max_abs_lat = index["grid_params"].tolist()
+    grid_keys = index["grid_keys"]
+    grid_start = index["grid_start"]
+    grid_items = index["grid_items"]
+    row0 = math.floor(P[0] / cs) - min_row
+    col0 = math.floor(P[1] / cs) - min_col
+    # Smallest ground distance covered by one cell, with a little slack for the flat-earth approximation.
+    cell_meters = cs * geodesy.METERS_PER_DEGREE * math.cos(math.radians(min(max_abs_lat, 89.0))) * 0.99
+    found_ids = []
+    found_d = []
+    best = math.inf
+    # Start at the first ring that reaches the grid.
+    radius = max(0, -row0, row0 - (nrows - 1), -col0, col0 - (ncols - 1))
+    first_radius = radius
+    while True:
+        if radius - first_radius > MAX_RING_RADIUS or 8 * radius > len(grid_keys):
+            found_ids = [np.arange(len(index["a_lat"]))]
+            Q_lat, Q_lon, t = geodesy.project_onto_segments(P[0], P[1], index["a_lat"], index["a_lon"],
+                                                            index["b_lat"], index["b_lon"])
+            found_d = [geodesy.haversine(P[0], P[1], Q_lat, Q_lon)]
+            best = float(found_d[0].min())
+            break
+        rows, cols = _ring_cells(row0, col0, radius, nrows, ncols)
+        keys = rows * ncols + cols
+        k = np.searchsorted(grid_keys, keys)
+        hit = k < len(grid_keys)
+        hit[hit] = grid_keys[k[hit]] == keys[hit]
+        k = k[hit]
+        if len(k):
+            ids = np.unique(np.concatenate([grid_items[grid_start[c]:grid_start[c + 1]] for c in k.tolist()]))
+            Q_lat, Q_lon, t = geodesy.project_onto_segments(P[0], P[1], index["a_lat"][ids], index["a_lon"][ids],
+                                                            index["b_lat"][ids], index["b_lon"][ids])
+            d = geodesy.haversine(P[0], P[1], Q_lat, Q_lon)
+            found_ids.append(ids)
+            found_d.append(d)
+            best = min(best, float(d.min()))
+        covers_grid = (row0 - radius <= 0 and row0 + radius >= nrows - 1 and
+                       col0 - radius <= 0 and col0 + radius >= ncols - 1)
+        if best <= radius * cell_meters or covers_grid:
+            break
+        radius += 1
+    if not found_ids:
+        return []
+    ids = np.concatenate(found_ids)
+    d = np.concatenate(found_d)
+    return np.unique(ids[d <= best + SHORTLIST_TOLERANCE]).tolist()
+
+def segments_in_box(index, min_lat, min_lon, max_lat, max_lon):
+    """
+    Returns the ids (ascending) of the segments listed in any grid cell overlapping the box,
+    which includes every segment that crosses the box (and some that only come near it).
+    """
+    if len(index["a_lat"]) == 0:
+        return np.zeros(0, dtype=np.int32)
+    min_row, min_col, nrows, ncols = index["grid_shape"].tolist()
+    cs = float(index["grid_params"][0])
+    row_lo = max(math.floor(min_lat / cs) - min_row, 0)
+    row_hi = min(math.floor(max_lat / cs) - min_row, nrows - 1)
+    col_lo = max(math.floor(min_lon / cs) - min_col, 0)
+    col_hi = min(math.floor(max_lon / cs) - min_col, ncols - 1)
+    if row_lo > row_hi or col_lo > col_hi:
+        return np.zeros(0, dtype=np.int32)
+    rows, cols = np.meshgrid(np.arange(row_lo, row_hi + 1), np.arange(col_lo, col_hi + 1), indexing="ij")
+    keys = (rows * ncols + cols).ravel()
+    grid_keys = index["grid_keys"]
+    k = np.searchsorted(grid_keys, keys)
+    hit = k < len(grid_keys)
+    hit[hit] = grid_keys[k[hit]] == keys[hit]
+    starts, stops = index["grid_start"][k[hit]], index["grid_start"][k[hit] + 1]
+    if not len(starts):
+        return np.zeros(0, dtype=np.int32)
+    return np.unique(np.concatenate([index["grid_items"][a:b] for a, b in zip(starts.tolist(), stops.tolist())]))
+
+def _ring_cells(row0, col0, radius, nrows, ncols):
+    """
+    Returns the (rows, cols) arrays of the cells at Chebyshev distance radius from (row0, col0),
+    clipped to the grid.
+    """
+    if radius == 0:
+        rows, cols = np.array([row0]), np.array([col0])
+    else:
+        span = np.arange(-radius, radius + 1)
+        side = np.arange(-radius + 1, radius)
+        rows = np.concatenate([np.full(len(span), row0 - radius), np.full(len(span), row0 + radius),
+                               row0 + side, row0 + side])
+        cols = np.concatenate([col0 + span, col0 + span,
+                               np.full(len(side), col0 - radius), np.full(len(side), col0 + radius)])
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    return rows[inside], cols[inside]
@@ -1,302 +1,154 @@
 #!/usr/bin/env python3
 import json
 import heapq
-import math
-import copy
-
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Compute the haversine distance (in meters) between two points given in degrees.
-    """
-    R = 6371000  # Earth's radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def project_point_onto_segment(P, A, B):
-    """
-    Projects point P onto segment AB.
-    P, A, B are tuples (lat, lon) in degrees.
-    Uses an equirectangular approximation (with scaling by cos(P.lat)).
-    Returns (projected_point, t) where t is the parameter (clamped to [0,1]).
-    """
-    lat_rad = math.radians(P[0])
-    cos_lat = math.cos(lat_rad)
-    def to_xy(point):
-        lat, lon = point
-        return (lon * cos_lat, lat)
-    Pxy = to_xy(P)
-    Axy = to_xy(A)
-    Bxy = to_xy(B)
-    Ax, Ay = Axy
-    Bx, By = Bxy
-    Px, Py = Pxy
-    dx = Bx - Ax
-    dy = By - Ay
-    if dx == 0 and dy == 0:
-        return A, 0
-    t = ((Px - Ax) * dx + (Py - Ay) * dy) / (dx * dx + dy * dy)
-    t = max(0, min(1, t))
-    Qx = Ax + t * dx
-    Qy = Ay + t * dy
-    Qlon = Qx / cos_lat
-    Qlat = Qy
-    return (Qlat, Qlon), t
-
-def compute_polyline_distance(polyline):
-    """
-    Given a polyline (list of vertices with "lat" and "lon" as integers),
-    compute the total distance in meters.
-    """
-    total = 0.0
-    for i in range(len(polyline) - 1):
-        A = polyline[i]
-        B = polyline[i+1]
-        A_lat = A["lat"] / 1e9
-        A_lon = A["lon"] / 1e9
-        B_lat = B["lat"] / 1e9
-        B_lon = B["lon"] / 1e9
-        total += haversine(A_lat, A_lon, B_lat, B_lon)
-    return total
-
-def remove_edge_from_graph(graph, u, v, poly):
-    """
-    Removes from graph[u] the edge going to v that has a polyline equal to poly.
-    """
-    if u in graph:
-        new_edges = []
-        for edge in graph[u]:
-            neighbor, weight, p = edge
-            if neighbor == v and p == poly:
-                continue
-            new_edges.append(edge)
-        graph[u] = new_edges
-
-def add_edge_to_graph(graph, u, v, poly, distance):
-    """
-    Adds an edge from u to v with the given polyline and weight.
-    """
-    graph.setdefault(u, []).append((v, distance, poly))
-
-def load_graph():
-    """
-    Loads formatted_data.json and builds an undirected graph.
-    Each junction vertex (identified by its "id") is a node.
-    Each edge becomes bidirectional with a weight (distance) and its polyline.
-    For the reverse direction, the polyline is stored in reverse.
-    """
-    with open("formatted_data.json", "r") as f:
-        segments = json.load(f)
-    graph = {}   # node_id -> list of (neighbor_id, distance, polyline)
-    nodes = {}   # node_id -> (lat, lon) in degrees
-    for seg in segments:
-        for edge in seg["edges"]:
-            start = edge["start"]
-            end = edge["end"]
-            start_id = start["id"]
-            end_id = end["id"]
-            d = edge["distance"]
-            if start_id not in nodes:
-                nodes[start_id] = (start["lat"] / 1e9, start["lon"] / 1e9)
-            if end_id not in nodes:
-                nodes[end_id] = (end["lat"] / 1e9, end["lon"] / 1e9)
-            graph.setdefault(start_id, []).append((end_id, d, edge["polyline"]))
-            graph.setdefault(end_id, []).append((start_id, d, list(reversed(edge["polyline"]))))
-    return graph, nodes
-
-def dijkstra(graph, start, goal):
-    """
-    Standard Dijkstra algorithm.
-    Returns a tuple: (total_distance, list_of_node_ids, list_of_polyline_segments used).
-    """
-    dist = {node: float('inf') for node in graph}
-    previous = {node: None for node in graph}
-    edge_used = {node: None for node in graph}
-    dist[start] = 0
-    queue = [(0, start)]
+import weakref
+import numpy as np
+import metrics
+from djikstra import load_graph, load_nodes, snap_point, build_snap_overlay, combine_polylines, encode_coordinates, search_lists
+
+# Global cache: graph -> duplicate arcs, for every graph still in use.
+DUPLICATES_CACHE = weakref.WeakKeyDictionary()
+
+def restricted_dijkstra(graph, start, goal, overlay=None, banned_arcs=frozenset(), banned_nodes=frozenset()):
+    """
+    Dijkstra over a RoutingGraph (and optional snap overlay, see djikstra.dijkstra) that skips
+    the arcs in banned_arcs and never enters the nodes in banned_nodes, so Yen's algorithm can
+    search with parts of the graph removed without copying it.
+    Returns a tuple: (total_distance, list_of_node_indices, list_of_arc_ids used).
+    """
+    offsets, targets, arc_cost, arc_twin = search_lists(graph, overlay)
+    node_count = graph.node_count
+    overlay_adjacency = overlay["adjacency"] if overlay else {}
+    dist = {start: 0.0}
+    previous = {start: None}  # node -> (previous node, arc used to reach it)
+    queue = [(0.0, start)]
+    pops = stale = relaxed = 0
     while queue:
         current_dist, current = heapq.heappop(queue)
+        pops += 1
         if current == goal:
             break
         if current_dist > dist[current]:
+            stale += 1
             continue
-        for neighbor, weight, poly in graph[current]:
-            alt = current_dist + weight
-            if alt < dist[neighbor]:
-                dist[neighbor] = alt
-                previous[neighbor] = current
-                edge_used[neighbor] = poly
-                heapq.heappush(queue, (alt, neighbor))
-    if dist[goal] == float('inf'):
+        if current < node_count:
+            first, last = offsets[current], offsets[current + 1]
+            relaxed += last - first
+            arcs = ((arc, targets[arc], arc_cost[arc]) for arc in range(first, last))
+        else:
+            arcs = ()
+        virtual_arcs = overlay_adjacency.get(current, ())
+        relaxed += len(virtual_arcs)
+        for source in (arcs, virtual_arcs):
+            for arc, neighbor, weight in source:
+                if arc in banned_arcs or neighbor in banned_nodes:
+                    continue
+                alt = current_dist + weight
+                if alt < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = alt
+                    previous[neighbor] = (current, arc)
+                    heapq.heappush(queue, (alt, neighbor))
+    metrics.count(heap_pushes=pops + len(queue), heap_pops=pops, nodes_settled=pops - stale, edges_relaxed=relaxed)
+    if goal not in dist:
         return None, None, None
-    path = []
-    edges_in_path = []
-    node = goal
-    while node is not None:
+    path = [goal]
+    arcs_in_path = []
+    step = previous[goal]
+    while step is not None:
+        node, arc = step
         path.append(node)
-        node = previous[node]
+        arcs_in_path.append(arc)
+        step = previous[node]
     path.reverse()
-    for i in range(1, len(path)):
-        edges_in_path.append(edge_used[path[i]])
-    return dist[goal], path, edges_in_path
-
-def combine_polylines(polylines):
-    """
-    Combines a list of polyline segments (each a list of vertices) into one continuous polyline,
-    removing duplicate junction vertices.
-    """
-    if not polylines:
-        return []
-    combined = polylines[0][:]
-    for poly in polylines[1:]:
-        combined.extend(poly[1:])
-    return combined
-
-def encode_polyline(points):
-    """
-    Encodes a polyline using the Google Encoded Polyline Algorithm.
-    Points is a list of dicts with "lat" and "lon" (in degrees).
-    """
-    def encode_coordinate(coordinate):
-        coordinate = int(round(coordinate * 1e5))
-        coordinate = coordinate << 1
-        if coordinate < 0:
-            coordinate = ~coordinate
-        encoded = ""
-        while coordinate >= 0x20:
-            encoded += chr((0x20 | (coordinate & 0x1f)) + 63)
-            coordinate >>= 5
-        encoded += chr(coordinate + 63)
-        return encoded
-    result = ""
-    prev_lat = 0
-    prev_lon = 0
-    for point in points:
-        lat = point["lat"]
-        lon = point["lon"]
-        d_lat = lat - prev_lat
-        d_lon = lon - prev_lon
-        result += encode_coordinate(d_lat)
-        result += encode_coordinate(d_lon)
-        prev_lat = lat
-        prev_lon = lon
-    return result
-
-def load_nodes():
-    """
-    Loads nodes.json, which contains a list of all unique nodes.
-    """
-    with open("nodes.json", "r") as f:
-        nodes_list = json.load(f)
-    return nodes_list
-
-def snap_point(P, graph, nodes):
-    """
-    Snaps point P (tuple (lat, lon) in degrees) onto the closest point on any edge in the graph.
-    Iterates over each unique edge (using u < v to avoid duplicates), projects P onto each segment,
-    and selects the one with minimum haversine distance.
-    Then splits that edge by inserting a new node at the projected point,
-    updating the graph (in both directions) accordingly.
-    Returns the new node's id.
-    """
-    best_distance = float('inf')
-    best_edge_info = None  # (u, v, poly, segment_index, t)
-    for u in graph:
-        for (v, weight, poly) in graph[u]:
-            if u < v:
-                for i in range(len(poly) - 1):
-                    A = poly[i]
-                    B = poly[i+1]
-                    A_lat = A["lat"] / 1e9
-                    A_lon = A["lon"] / 1e9
-                    B_lat = B["lat"] / 1e9
-                    B_lon = B["lon"] / 1e9
-                    proj, t = project_point_onto_segment(P, (A_lat, A_lon), (B_lat, B_lon))
-                    d = haversine(P[0], P[1], proj[0], proj[1])
-                    if d < best_distance:
-                        best_distance = d
-                        best_edge_info = (u, v, poly, i, t)
-    if best_edge_info is None:
-        return None
-    u, v, poly, i, t = best_edge_info
-    A = poly[i]
-    B = poly[i+1]
-    A_lat = A["lat"] / 1e9
-    A_lon = A["lon"] / 1e9
-    B_lat = B["lat"] / 1e9
-    B_lon = B["lon"] / 1e9
-    snapped_lat = A_lat + t * (B_lat - A_lat)
-    snapped_lon = A_lon + t * (B_lon - A_lon)
-    snapped_lat_int = round(snapped_lat * 1e9)
-    snapped_lon_int = round(snapped_lon * 1e9)
-    new_id = max(nodes.keys()) + 1 if nodes else 1
-    new_vertex = {"id": new_id, "lat": snapped_lat_int, "lon": snapped_lon_int}
-    nodes[new_id] = (snapped_lat, snapped_lon)
-    new_polyline1 = poly[:i+1] + [new_vertex]
-    new_polyline2 = [new_vertex] + poly[i+1:]
-    d1 = compute_polyline_distance(new_polyline1)
-    d2 = compute_polyline_distance(new_polyline2)
-    remove_edge_from_graph(graph, u, v, poly)
-    remove_edge_from_graph(graph, v, u, list(reversed(poly)))
-    add_edge_to_graph(graph, u, new_id, new_polyline1, d1)
-    add_edge_to_graph(graph, new_id, u, list(reversed(new_polyline1)), d1)
-    add_edge_to_graph(graph, new_id, v, new_polyline2, d2)
-    add_edge_to_graph(graph, v, new_id, list(reversed(new_polyline2)), d2)
-    return new_id
-
-def k_shortest_paths(graph, start, goal, K):
-    """
-    Uses a variant of Yen's algorithm to compute up to K shortest paths from start to goal.
-    Each path is a tuple: (total_distance, path (list of node IDs), edges (list of polyline segments)).
-    """
-    A = []  # list of shortest paths found
-    B = []  # candidate paths
-    initial = dijkstra(graph, start, goal)
+    arcs_in_path.reverse()
+    return dist[goal], path, arcs_in_path
+
+def arc_costs(graph, arcs, overlay=None):
+    """
+    Returns the cost of each arc in a list (graph or virtual).
+    """
+    arc_cost = search_lists(graph, overlay)[2]
+    return [arc_cost[arc] if arc < graph.arc_count else overlay["arcs"][arc]["cost"] for arc in arcs]
+
+def duplicate_arcs(graph):
+    """
+    Returns {arc: tuple of all its duplicates} for arcs that join the same nodes along the same
+    geometry as another arc (the source data lists a few edges twice); such arcs only ever give
+    the same route again. Cached per graph.
+    """
+    if graph in DUPLICATES_CACHE:
+        return DUPLICATES_CACHE[graph]
+    duplicates = {}
+    offsets, targets = graph.offsets.tolist(), graph.targets.tolist()
+    for u in range(graph.node_count):
+        by_target = {}
+        for arc in range(offsets[u], offsets[u + 1]):
+            by_target.setdefault(targets[arc], []).append(arc)
+        for arcs in by_target.values():
+            for arc in arcs:
+                same = tuple(other for other in arcs
+                             if np.array_equal(graph.arc_geometry(other), graph.arc_geometry(arc)))
+                if len(same) > 1:
+                    duplicates[arc] = same
+    DUPLICATES_CACHE[graph] = duplicates
+    return duplicates
+
+def k_shortest_paths(graph, start, goal, K, overlay=None):
+    """
+    Uses Yen's algorithm to compute up to K shortest loopless paths from start to goal.
+    For each accepted path, every node from where it left its parent path on is a spur node
+    (Lawler's refinement: earlier spur nodes would only repeat candidates of the parent). The
+    spur search bans the next arc (and its duplicates) of every accepted path sharing the root
+    path, and the root path's nodes, instead of removing them from a copy of the graph.
+    Root costs come from the accepted path's running costs, and candidates sit in a heap,
+    deduplicated by their arc sequence with duplicate arcs counted as one.
+    Each path is a tuple: (total_distance, path (list of node indices), arcs (list of arc ids)).
+    """
+    initial = restricted_dijkstra(graph, start, goal, overlay)
     if initial[0] is None:
-        return A
-    A.append(initial)
-    for k in range(1, K):
-        for i in range(len(A[-1][1]) - 1):
-            spur_node = A[-1][1][i]
-            root_path = A[-1][1][:i+1]
-            root_edges = A[-1][2][:i]
-            graph_copy = copy.deepcopy(graph)
-            for candidate in A:
-                if len(candidate[1]) > i and candidate[1][:i+1] == root_path:
-                    u = candidate[1][i]
-                    v = candidate[1][i+1]
-                    poly = candidate[2][i]
-                    remove_edge_from_graph(graph_copy, u, v, poly)
-                    remove_edge_from_graph(graph_copy, v, u, list(reversed(poly)))
-            for node in root_path[:-1]:
-                if node in graph_copy:
-                    del graph_copy[node]
-                for key in list(graph_copy.keys()):
-                    graph_copy[key] = [edge for edge in graph_copy[key] if edge[0] != node]
-            spur_result = dijkstra(graph_copy, spur_node, goal)
-            if spur_result[0] is not None:
-                spur_distance, spur_path, spur_edges = spur_result
-                root_distance = sum(compute_polyline_distance(edge) for edge in root_edges) if root_edges else 0
-                total_distance = root_distance + spur_distance
-                total_path = root_path[:-1] + spur_path
-                total_edges = root_edges + spur_edges
-                candidate = (total_distance, total_path, total_edges)
-                if candidate not in B:
-                    B.append(candidate)
+        return []
+    duplicates = duplicate_arcs(graph)
+
+    def route_key(arcs):
+        return tuple(duplicates[arc][0] if arc in duplicates else arc for arc in arcs)
+
+    A = [initial]
+    deviations = [0]  # index of the first spur node worth trying for each accepted path
+    B = []  # heap of (total_distance, arcs tuple, path, spur index)
+    seen = {route_key(initial[2])}
+    while len(A) < K:
+        distance, path, arcs = A[-1]
+        prefix = [0.0]
+        for cost in arc_costs(graph, arcs, overlay):
+            prefix.append(prefix[-1] + cost)
+        for i in range(deviations[-1], len(path) - 1):
+            root_path = path[:i + 1]
+            root_arcs = arcs[:i]
+            banned_arcs = set()
+            for other in A:
+                if len(other[2]) > i and other[1][:i + 1] == root_path:
+                    banned_arcs.update(duplicates.get(other[2][i], (other[2][i],)))
+            banned_nodes = set(root_path[:-1])
+            spur_distance, spur_path, spur_arcs = restricted_dijkstra(
+                graph, path[i], goal, overlay, banned_arcs, banned_nodes)
+            if spur_distance is None:
+                continue
+            total_arcs = tuple(root_arcs + spur_arcs)
+            if route_key(total_arcs) in seen:
+                continue
+            seen.add(route_key(total_arcs))
+            heapq.heappush(B, (prefix[i] + spur_distance, total_arcs, root_path[:-1] + spur_path, i))
         if not B:
             break
-        B.sort(key=lambda x: x[0])
-        A.append(B.pop(0))
+        total_distance, total_arcs, total_path, spur_index = heapq.heappop(B)
+        A.append((total_distance, total_path, list(total_arcs)))
+        deviations.append(spur_index)
     return A
 
 def main():
-    # Load graph and nodes from formatted_data.json.
-    graph, graph_nodes = load_graph()
-    if not graph:
+    # Load the routing graph.
+    graph = load_graph()
+    if graph.edge_count == 0:
         print("Graph is empty.")
         return
 
@@ -312,18 +164,19 @@ def main():
     ######################################################
 
     # Snap origin and destination onto the graph.
-    origin_node = snap_point(origin, graph, graph_nodes)
-    destination_node = snap_point(destination, graph, graph_nodes)
-    if origin_node is None or destination_node is None:
+    origin_snap = snap_point(origin, graph)
+    destination_snap = snap_point(destination, graph)
+    if origin_snap is None or destination_snap is None:
         print("Could not snap origin or destination to the graph.")
         return
+    overlay, (origin_node, destination_node) = build_snap_overlay(graph, [origin_snap, destination_snap])
 
     print(f"Using snapped origin node: {origin_node}")
     print(f"Using snapped destination node: {destination_node}")
 
     # Compute the top 5 shortest paths.
     K = 5
-    paths = k_shortest_paths(graph, origin_node, destination_node, K)
+    paths = k_shortest_paths(graph, origin_node, destination_node, K, overlay)
     if not paths:
         print("No path found.")
         return
@@ -331,10 +184,8 @@ def main():
     print(f"Found {len(paths)} paths:")
     top_paths_json = []  # This will store our output for each path.
     for idx, (total_distance, path_nodes, edges_in_path) in enumerate(paths, 1):
-        full_polyline = combine_polylines(edges_in_path)
-        # Convert each vertex's lat and lon to degrees.
-        points = [{"lat": point["lat"] / 1e9, "lon": point["lon"] / 1e9} for point in full_polyline]
-        encoded = encode_polyline(points)
+        full_polyline = combine_polylines(graph, edges_in_path, overlay)
+        encoded = encode_coordinates(full_polyline)
         print(f"Path {idx}: Total distance = {total_distance:.2f} meters")
         print(f"Encoded polyline: {encoded}\n")
         # Append the encoded polyline (and total distance, if desired) to our JSON output.
@@ -348,12 +199,11 @@ def main():
         json.dump(top_paths_json, f, indent=2)
 
     # Optionally, you may still output the best (first) path separately.
-    best_polyline = combine_polylines(paths[0][2])
-    points = [{"lat": point["lat"] / 1e9, "lon": point["lon"] / 1e9} for point in best_polyline]
-    best_encoded = encode_polyline(points)
+    best_polyline = combine_polylines(graph, paths[0][2], overlay)
+    best_encoded = encode_coordinates(best_polyline)
     with open("best_path_polyline.json", "w") as f:
         json.dump({"encoded_polyline": best_encoded}, f, indent=2)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()